@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django import forms
+from django.db import transaction
 from .models import Event, EventRegistration
+from .registration import cancel_registration, promote_waitlist, register_for_event
 
 
 class EventAdminForm(forms.ModelForm):
@@ -37,13 +39,14 @@ class EventAdminForm(forms.ModelForm):
 
 class EventAdmin(admin.ModelAdmin):
     form = EventAdminForm
-    list_display = ('title', 'date', 'location', 'status', 'is_featured', 'is_registration_open', 'attendees')
+    list_display = ('title', 'date', 'location', 'status', 'is_featured', 'is_registration_open', 'attendees', 'capacity')
     list_filter = ('status', 'is_featured', 'is_registration_open')
     search_fields = ('title', 'description', 'location')
-    readonly_fields = ('created_at', 'updated_at')
+    # attendees is a counter maintained by events.registration
+    readonly_fields = ('attendees', 'created_at', 'updated_at')
     fieldsets = (
         (None, {'fields': ('title', 'description', 'date', 'time', 'location', 'image')}),
-        ('Settings', {'fields': ('status', 'is_featured', 'is_registration_open', 'attendees')}),
+        ('Settings', {'fields': ('status', 'is_featured', 'is_registration_open', 'attendees', 'capacity')}),
         ('Important Reminders', {
             'fields': ('reminder_1', 'reminder_2', 'reminder_3', 'reminder_4', 'reminder_5'),
             'description': 'Add important reminders for attendees (e.g., what to bring, dress code, etc.). Leave empty fields blank.'
@@ -51,17 +54,53 @@ class EventAdmin(admin.ModelAdmin):
         ('Administration', {'fields': ('created_by',)}),
         ('Timestamps', {'fields': ('created_at', 'updated_at')}),
     )
+    
+    def save_model(self, request, obj, form, change):
+        if not change:
+            return super().save_model(request, obj, form, change)
+        
+        # Leave attendees out of the UPDATE; registrations change it concurrently
+        obj.save(update_fields=[
+            field.name for field in obj._meta.concrete_fields
+            if not field.primary_key and field.name != 'attendees'
+        ])
+        if 'capacity' in form.changed_data:
+            promote_waitlist(obj.id)
 
 
 class EventRegistrationAdmin(admin.ModelAdmin):
-    list_display = ('event', 'user', 'registration_date', 'attended')
-    list_filter = ('attended', 'registration_date')
+    list_display = ('event', 'user', 'registration_date', 'status', 'attended')
+    list_filter = ('status', 'attended', 'registration_date')
     search_fields = ('event__title', 'user__name', 'user__email')
+    # status follows the event's seat counter, see events.registration
+    readonly_fields = ('status',)
     fieldsets = (
-        (None, {'fields': ('event', 'user', 'attended')}),
+        (None, {'fields': ('event', 'user', 'status', 'attended')}),
         ('Dates', {'fields': ('registration_date',)}),
     )
 
+    def save_model(self, request, obj, form, change):
+        # Adds and moves take a seat through the event's counter, or join the waitlist
+        if change and not {'event', 'user'} & set(form.changed_data):
+            obj.save(update_fields=['attended'])
+            return
+
+        with transaction.atomic():
+            if change:
+                cancel_registration(obj)
+            registration = register_for_event(obj.event, obj.user, attended=obj.attended)
+        obj.pk = registration.pk
+        obj.status = registration.status
+        obj.registration_date = registration.registration_date
+        obj._state.adding = False
+
+    def delete_model(self, request, obj):
+        cancel_registration(obj)
+
+    def delete_queryset(self, request, queryset):
+        for registration in queryset.order_by('pk'):
+            cancel_registration(registration)
+
 
 admin.site.register(Event, EventAdmin)
 admin.site.register(EventRegistration, EventRegistrationAdmin)
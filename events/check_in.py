@@ -0,0 +1,253 @@
+"""
+Offline-capable QR check-in.
+
+Each confirmed registration has a compact check-in token: its registration, event and
+user IDs plus a truncated HMAC-SHA256 over them, base64url encoded to fit in a QR code.
+A token is verified with one HMAC and no database access, so a scan takes microseconds.
+
+Verified scans are appended to a local journal file (one JSON line per scan) instead of
+being written to the database at the door. sync_journal later replays the journal in
+batches through bulk_check_in, which is idempotent, and only then moves its saved offset
+forward. If the database or network is unavailable the sync just stops and is retried,
+while scans keep being accepted into the journal. Once a sync has caught up, the synced
+lines are cut from the front of the journal so it does not grow without bound.
+
+The journal is a file on the host that served the scan. With several app hosts, each
+one keeps its own journal, so the sync_check_ins command must run on every host that
+serves check-ins, or the scans accepted there are never marked as attended.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import logging
+import os
+import struct
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils import timezone
+
+from .registration import bulk_check_in
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; appends from several processes are then not coordinated
+    fcntl = None
+
+logger = logging.getLogger('events.check_in')
+
+# Journal of accepted scans; the synced offset is kept next to it in <journal>.offset
+EVENTS_CHECK_IN_JOURNAL = getattr(
+    settings, 'EVENTS_CHECK_IN_JOURNAL', os.path.join(settings.BASE_DIR, 'logs', 'check_in_journal.jsonl')
+)
+
+TOKEN_IDS = struct.Struct('>QQQ')
+TOKEN_MAC_BYTES = 12
+TOKEN_KEY = hashlib.sha256(b'events.check_in.token:' + settings.SECRET_KEY.encode()).digest()
+
+CheckInToken = namedtuple('CheckInToken', ['registration_id', 'event_id', 'user_id'])
+
+
+class InvalidCheckInToken(Exception):
+    """Raised when a check-in token is malformed or its signature does not match"""
+
+
+def token_mac(payload):
+    return hmac.new(TOKEN_KEY, payload, hashlib.sha256).digest()[:TOKEN_MAC_BYTES]
+
+
+def make_check_in_token(registration):
+    """
+    Build the check-in token of a registration
+
+    Returns:
+        str: A 48 character base64url token
+    """
+    payload = TOKEN_IDS.pack(registration.id, registration.event_id, registration.user_id)
+    return base64.urlsafe_b64encode(payload + token_mac(payload)).decode()
+
+
+def verify_check_in_token(token):
+    """
+    Check a token's signature without touching the database
+
+    Returns:
+        CheckInToken: The IDs the token was issued for
+
+    Raises:
+        InvalidCheckInToken: If the token is malformed or was not signed by this site
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token.encode())
+    except (AttributeError, ValueError, binascii.Error):
+        raise InvalidCheckInToken('Malformed check-in token.')
+    if len(raw) != TOKEN_IDS.size + TOKEN_MAC_BYTES:
+        raise InvalidCheckInToken('Malformed check-in token.')
+
+    payload, mac = raw[:TOKEN_IDS.size], raw[TOKEN_IDS.size:]
+    if not hmac.compare_digest(mac, token_mac(payload)):
+        raise InvalidCheckInToken('Invalid check-in token signature.')
+    return CheckInToken(*TOKEN_IDS.unpack(payload))
+
+
+class CheckInJournal:
+    """
+    Append-only file of accepted scans, synced to the database in batches
+
+    Each scan batch is appended under an exclusive file lock (where the platform has
+    fcntl), so writers in several processes do not interleave with each other or with
+    compaction. Only one sync should run at a time.
+
+    Args:
+        path: Journal file; defaults to EVENTS_CHECK_IN_JOURNAL
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or EVENTS_CHECK_IN_JOURNAL)
+        self.offset_path = f"{self.path}.offset"
+        self._lock = threading.Lock()
+
+    def append(self, tokens):
+        """
+        Record verified scans
+
+        Args:
+            tokens (list): CheckInToken tuples from verify_check_in_token
+        """
+        if not tokens:
+            return
+        scanned_at = timezone.now().isoformat()
+        lines = ''.join(
+            json.dumps({'registration': token.registration_id, 'event': token.event_id,
+                        'user': token.user_id, 'scanned_at': scanned_at}) + '\n'
+            for token in tokens
+        )
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._open_locked('a') as journal:
+            journal.write(lines)
+
+    @contextmanager
+    def _open_locked(self, mode):
+        """
+        Open the journal holding an exclusive lock on it
+
+        If the journal was compacted (replaced) while waiting for the lock, the new
+        file is opened instead, so nothing is written to the discarded one.
+        """
+        with self._lock:
+            while True:
+                journal = open(self.path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'}))
+                if fcntl is not None:
+                    fcntl.flock(journal, fcntl.LOCK_EX)
+                try:
+                    current = os.fstat(journal.fileno()).st_ino == os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    break
+                journal.close()
+            try:
+                yield journal
+            finally:
+                # Closing the file releases the lock
+                journal.close()
+
+    def compact(self):
+        """
+        Cut the synced scans from the front of the journal
+
+        Returns:
+            int: Number of bytes removed
+        """
+        offset = self.synced_offset()
+        if not offset:
+            return 0
+
+        try:
+            with self._open_locked('rb') as journal:
+                journal.seek(offset)
+                temporary = f"{self.path}.tmp"
+                with open(temporary, 'wb') as compacted:
+                    compacted.write(journal.read())
+                # Resetting the offset first means a crash at worst syncs old scans again,
+                # which bulk_check_in ignores
+                self.save_offset(0)
+                os.replace(temporary, self.path)
+        except FileNotFoundError:
+            return 0
+        return offset
+
+    def synced_offset(self):
+        try:
+            with open(self.offset_path, encoding='utf-8') as offset_file:
+                return int(offset_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save_offset(self, offset):
+        temporary = f"{self.offset_path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as offset_file:
+            offset_file.write(str(offset))
+        os.replace(temporary, self.offset_path)
+
+    def pending(self, limit):
+        """
+        Read up to ``limit`` scans after the synced offset
+
+        Returns:
+            tuple: (registration_ids, end_offset) where end_offset is the file
+                position after the last complete line read
+        """
+        offset = self.synced_offset()
+        registration_ids = []
+        try:
+            journal = open(self.path, 'rb')
+        except FileNotFoundError:
+            return registration_ids, offset
+
+        with journal:
+            journal.seek(offset)
+            while len(registration_ids) < limit:
+                line = journal.readline()
+                if not line.endswith(b'\n'):
+                    # End of file, or a line still being written
+                    break
+                offset += len(line)
+                try:
+                    registration_ids.append(int(json.loads(line)['registration']))
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f"Skipping unreadable check-in journal line at offset {offset - len(line)}")
+        return registration_ids, offset
+
+    def sync(self, batch_size=500):
+        """
+        Mark journaled scans as attended, one batch at a time, then compact the journal
+
+        The offset is saved after each batch, so a failure leaves the unsynced scans
+        to be retried by the next sync. Any exception from the database is raised.
+
+        Returns:
+            tuple: (scans, checked_in) synced by this call
+        """
+        scans = checked_in = 0
+        while True:
+            registration_ids, end_offset = self.pending(batch_size)
+            if end_offset == self.synced_offset():
+                break
+            if registration_ids:
+                changed, _ = bulk_check_in(registration_ids=registration_ids, chunk_size=batch_size)
+                checked_in += changed
+                scans += len(registration_ids)
+            self.save_offset(end_offset)
+
+        self.compact()
+        if scans:
+            logger.info(f"Synced {scans} journaled check-ins, {checked_in} newly attended")
+        return scans, checked_in
+
+
+check_in_journal = CheckInJournal()
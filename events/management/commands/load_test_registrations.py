@@ -0,0 +1,110 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.utils import timezone
+
+from events.models import Event, EventRegistration
+from events.registration import register_for_event
+
+LOAD_TEST_EMAIL_DOMAIN = 'registration-load-test.jkuelc.local'
+
+
+class EventFull(Exception):
+    pass
+
+
+def legacy_register(event_id, user):
+    """The old check-then-insert registration path with a capacity check bolted on, kept as the baseline"""
+    with transaction.atomic():
+        event = Event.objects.get(id=event_id)
+        if EventRegistration.objects.filter(event=event, user=user).exists():
+            raise IntegrityError('Already registered')
+        if event.capacity is not None and event.attendees >= event.capacity:
+            raise EventFull()
+        EventRegistration.objects.create(event=event, user=user)
+        event.attendees = EventRegistration.objects.filter(event=event).count()
+        event.save()
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test registration for one hot event, comparing the old check-then-insert '
+        'path with admission by conditional update. Reports confirmed, waitlisted and '
+        'overbooked registrations and registrations/sec for each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--capacity', type=int, default=50,
+                            help='Seats of the hot event')
+        parser.add_argument('--registrants', type=int, default=300,
+                            help='Number of users registering per run')
+        parser.add_argument('--threads', type=int, default=16,
+                            help='Number of concurrent registrants')
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        organizer, _ = User.objects.get_or_create(
+            email=f'organizer@{LOAD_TEST_EMAIL_DOMAIN}', defaults={'name': 'Registration Load Test'}
+        )
+        registrants = User.objects.bulk_create([
+            User(email=f'registrant{i}@{LOAD_TEST_EMAIL_DOMAIN}', name=f'Registrant {i}')
+            for i in range(options['registrants'])
+        ])
+        self.stdout.write(
+            f"{options['registrants']} registrants for {options['capacity']} seats, {options['threads']} threads"
+        )
+        self.stdout.write(
+            f"{'mode':<8} {'confirmed':>10} {'waitlist':>9} {'full':>6} {'errors':>7} {'overbook':>9} {'reg/s':>8}"
+        )
+
+        try:
+            for mode in ('legacy', 'admit'):
+                self.run_mode(mode, organizer, registrants, options)
+        finally:
+            # Cascades to the load test events and registrations
+            User.objects.filter(email__endswith=f'@{LOAD_TEST_EMAIL_DOMAIN}').delete()
+
+    def run_mode(self, mode, organizer, registrants, options):
+        event = Event.objects.create(
+            title=f'Registration load test ({mode})', description='Load test event',
+            date=timezone.now().date() + timedelta(days=7), time='9:00 AM', location='Load test',
+            image='https://example.com/load-test.png', capacity=options['capacity'], created_by=organizer
+        )
+        start = threading.Barrier(options['threads'])
+
+        def register(user):
+            try:
+                start.wait(timeout=0.5)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                if mode == 'legacy':
+                    legacy_register(event.id, user)
+                    return 'CONFIRMED'
+                return register_for_event(event, user).status
+            except EventFull:
+                return 'full'
+            except (IntegrityError, OperationalError):
+                # e.g. SQLite "database is locked" under write contention
+                return 'errors'
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            outcomes = list(executor.map(register, registrants))
+        elapsed = time.perf_counter() - started
+
+        confirmed = EventRegistration.objects.filter(event=event, status='CONFIRMED').count()
+        overbooked = max(0, confirmed - options['capacity'])
+        registered = len(outcomes) - outcomes.count('errors')
+        style = self.style.ERROR if overbooked else self.style.SUCCESS
+        self.stdout.write(style(
+            f"{mode:<8} {confirmed:>10} {outcomes.count('WAITLISTED'):>9} {outcomes.count('full'):>6} "
+            f"{outcomes.count('errors'):>7} {overbooked:>9} {registered / elapsed:>8.1f}"
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from events.registration import reconcile_attendees
+
+
+class Command(BaseCommand):
+    help = 'Reset the attendee count of events whose count no longer matches their registrations'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the events whose count has drifted')
+    
+    def handle(self, *args, **options):
+        drifted = reconcile_attendees(dry_run=options['dry_run'])
+        
+        for event_id, (attendees, actual) in sorted(drifted.items()):
+            self.stdout.write(f"Event {event_id}: counted {attendees}, registered {actual}")
+        
+        if options['dry_run']:
+            self.stdout.write(f"{len(drifted)} events have a drifted attendee count")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Reconciled the attendee count of {len(drifted)} events"))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+from events.check_in import check_in_journal
+
+
+class Command(BaseCommand):
+    help = (
+        'Mark the check-ins scanned into the local journal as attended, then drop them from '
+        'the journal. Each app host journals the scans it served, so run this on every host.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Scans synced per database round trip')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running, syncing every this many seconds')
+    
+    def handle(self, *args, **options):
+        if options['interval'] is None:
+            scans, checked_in = check_in_journal.sync(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Synced {scans} scans, {checked_in} newly attended"))
+            return
+        
+        while True:
+            try:
+                scans, checked_in = check_in_journal.sync(batch_size=options['batch_size'])
+                if scans:
+                    self.stdout.write(f"Synced {scans} scans, {checked_in} newly attended")
+            except DatabaseError as e:
+                # Unsynced scans stay in the journal for the next attempt
+                self.stderr.write(f"Check-in sync failed, will retry: {e}")
+            time.sleep(options['interval'])
@@ -16,7 +16,8 @@ class Event(models.Model):
     time = models.CharField(max_length=50)  # Storing as string for flexibility (e.g., "9:00 AM - 4:00 PM")
     location = models.CharField(max_length=255)
     image = models.URLField()
-    attendees = models.PositiveIntegerField(default=0)
+    attendees = models.PositiveIntegerField(default=0)  # Confirmed registrations, see events.registration
+    capacity = models.PositiveIntegerField(null=True, blank=True, help_text="Maximum confirmed attendees; leave empty for no limit")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='UPCOMING')
     is_featured = models.BooleanField(default=False)
     is_registration_open = models.BooleanField(default=True)
@@ -36,18 +37,34 @@ class Event(models.Model):
     @property
     def is_past(self):
         return self.date < timezone.now().date()
+    
+    @property
+    def seats_remaining(self):
+        if self.capacity is None:
+            return None
+        return max(0, self.capacity - self.attendees)
 
 
 class EventRegistration(models.Model):
+    STATUS_CHOICES = (
+        ('CONFIRMED', 'Confirmed'),
+        ('WAITLISTED', 'Waitlisted'),
+    )
+    
     event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='registrations')
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='event_registrations')
     registration_date = models.DateTimeField(default=timezone.now)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='CONFIRMED')
     attended = models.BooleanField(default=False)
     
     class Meta:
         verbose_name = 'Event Registration'
         verbose_name_plural = 'Event Registrations'
         unique_together = ('event', 'user')
+        indexes = [
+            # Waitlist promotion, first come first served
+            models.Index(fields=['event', 'status', 'registration_date']),
+        ]
     
     def __str__(self):
         return f"{self.user.name} - {self.event.title}"
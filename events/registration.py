@@ -0,0 +1,265 @@
+"""
+Event registration with capacity and a waitlist.
+``Event.attendees`` counts the event's confirmed registrations. A registrant is admitted
+by one conditional UPDATE, ``attendees = attendees + 1 WHERE attendees < capacity``, in
+the same transaction as the registration insert, so a rush of registrations for a full
+event can never overbook it and nobody has to count the registrations table. Registrants
+who are not admitted are waitlisted, and promote_waitlist confirms them in bulk, first
+come first served, when seats free up. reconcile_attendees repairs any drift in the
+counter (e.g. from rows changed outside these functions) with one grouped query.
+
+bulk_register and bulk_check_in enroll or check in many users at once with a few
+queries per chunk of IDs instead of a request per attendee.
+"""
+import logging
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Event, EventRegistration
+from payment.models import Notification
+
+logger = logging.getLogger('events.registration')
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@transaction.atomic
+def register_for_event(event, user, **fields):
+    """
+    Register a user for an event, confirmed if a seat is left and waitlisted otherwise
+
+    Returns:
+        EventRegistration: The new registration
+
+    Raises:
+        IntegrityError: If the user is already registered for the event
+    """
+    admitted = Event.objects.filter(
+        Q(capacity__isnull=True) | Q(attendees__lt=F('capacity')), pk=event.pk
+    ).update(attendees=F('attendees') + 1)
+
+    fields['status'] = 'CONFIRMED' if admitted else 'WAITLISTED'
+    return EventRegistration.objects.create(event=event, user=user, **fields)
+
+
+@transaction.atomic
+def cancel_registration(registration):
+    """Delete a registration, giving its seat to the waitlist if it had one"""
+    current = EventRegistration.objects.select_for_update().filter(pk=registration.pk).first()
+    if current is None:
+        return
+
+    current.delete()
+    if current.status == 'CONFIRMED':
+        Event.objects.filter(pk=current.event_id, attendees__gt=0).update(
+            attendees=F('attendees') - 1
+        )
+        promote_waitlist(current.event_id)
+
+
+@transaction.atomic
+def promote_waitlist(event_id):
+    """
+    Confirm as many waitlisted registrations as the event has free seats
+
+    The event row is locked while seats are handed out, so concurrent cancellations
+    cannot promote the same registrants twice. Promoted users are notified.
+
+    Returns:
+        int: Number of registrations promoted
+    """
+    event = Event.objects.select_for_update().get(pk=event_id)
+
+    waitlist = EventRegistration.objects.filter(
+        event_id=event_id, status='WAITLISTED'
+    ).order_by('registration_date', 'id')
+    if event.capacity is not None:
+        free_seats = event.capacity - event.attendees
+        if free_seats <= 0:
+            return 0
+        waitlist = waitlist[:free_seats]
+
+    waitlisted = list(waitlist.values_list('id', 'user_id'))
+    if not waitlisted:
+        return 0
+
+    promoted = EventRegistration.objects.filter(
+        pk__in=[registration_id for registration_id, _ in waitlisted], status='WAITLISTED'
+    ).update(status='CONFIRMED')
+    Event.objects.filter(pk=event_id).update(attendees=F('attendees') + promoted)
+
+    Notification.objects.bulk_create([
+        Notification(
+            user_id=user_id,
+            title='Event Registration Confirmed',
+            content=f'A seat has opened up for {event.title}. Your registration is now confirmed.',
+            type='EVENT',
+            reference_id=str(event_id)
+        )
+        for _, user_id in waitlisted
+    ])
+
+    logger.info(f"Promoted {promoted} waitlisted registrations for event {event_id}")
+    return promoted
+
+
+def reconcile_attendees(dry_run=False):
+    """
+    Reset the attendee counter of every event whose count has drifted.
+    This should be run as a scheduled task (see the reconcile_attendees management command).
+
+    Drifted events are found with one grouped COUNT over confirmed registrations, then
+    fixed with one UPDATE that recounts each of them in a subquery, so registrations
+    made in between are not overwritten with a stale count.
+
+    Args:
+        dry_run: Only report the events that have drifted
+
+    Returns:
+        dict: Event id -> (recorded attendees, actual confirmed registrations) of drifted events
+    """
+    drifted = {
+        event_id: (attendees, actual)
+        for event_id, attendees, actual in Event.objects.annotate(
+            actual=Count('registrations', filter=Q(registrations__status='CONFIRMED'))
+        ).exclude(attendees=F('actual')).values_list('id', 'attendees', 'actual')
+    }
+
+    if drifted and not dry_run:
+        registrations = EventRegistration.objects.filter(
+            event=OuterRef('pk'), status='CONFIRMED'
+        ).order_by().values('event')
+        count = registrations.annotate(count=Count('id')).values('count')
+        Event.objects.filter(pk__in=drifted).update(
+            attendees=Coalesce(Subquery(count), Value(0))
+        )
+        logger.info(f"Reconciled attendee counts of {len(drifted)} events")
+
+    return drifted
+
+
+@transaction.atomic
+def bulk_register(event, user_ids, chunk_size=500):
+    """
+    Register a cohort of users for an event
+
+    The event row is locked while seats are handed out. Users are confirmed in the
+    order given while seats remain and waitlisted after that, with one INSERT per chunk
+    and one counter UPDATE. Users already registered are left as they are.
+
+    Args:
+        event: The Event
+        user_ids (list): IDs of the users to register
+        chunk_size: Number of IDs per query
+
+    Returns:
+        list: One dict per distinct user ID with its 'user' ID and a 'status' of
+            CONFIRMED, WAITLISTED, already_registered or not_found
+    """
+    event = Event.objects.select_for_update().get(pk=event.pk)
+    user_ids = list(dict.fromkeys(user_ids))
+
+    existing_users = set()
+    registered = set()
+    for chunk in chunked(user_ids, chunk_size):
+        existing_users.update(get_user_model().objects.filter(pk__in=chunk).values_list('pk', flat=True))
+        registered.update(
+            EventRegistration.objects.filter(event=event, user_id__in=chunk).values_list('user_id', flat=True)
+        )
+
+    new_users = [user_id for user_id in user_ids if user_id in existing_users and user_id not in registered]
+    seats = len(new_users) if event.capacity is None else max(0, event.capacity - event.attendees)
+    statuses = {
+        user_id: 'CONFIRMED' if position < seats else 'WAITLISTED'
+        for position, user_id in enumerate(new_users)
+    }
+
+    EventRegistration.objects.bulk_create(
+        [EventRegistration(event=event, user_id=user_id, status=status) for user_id, status in statuses.items()],
+        batch_size=chunk_size
+    )
+    confirmed = min(seats, len(new_users))
+    if confirmed:
+        Event.objects.filter(pk=event.pk).update(attendees=F('attendees') + confirmed)
+
+    results = []
+    for user_id in user_ids:
+        if user_id in statuses:
+            status = statuses[user_id]
+        elif user_id in registered:
+            status = 'already_registered'
+        else:
+            status = 'not_found'
+        results.append({'user': user_id, 'status': status})
+
+    logger.info(f"Bulk registered {len(statuses)} users for event {event.pk}, {confirmed} confirmed")
+    return results
+
+
+def bulk_check_in(event=None, registration_ids=(), user_ids=(), chunk_size=500):
+    """
+    Mark many registrations as attended
+
+    Each chunk of IDs costs one SELECT, to report an outcome per ID, and one
+    ``UPDATE ... SET attended = true WHERE id IN (...)``. Checking in someone who is
+    already checked in changes nothing, so a batch can safely be sent again.
+
+    Args:
+        event: The Event; required with user_ids, optional with registration_ids
+        registration_ids (list): IDs of registrations to check in
+        user_ids (list): IDs of users registered for ``event`` to check in
+        chunk_size: Number of IDs per query
+
+    Returns:
+        tuple: (checked_in, results) where checked_in is the number of registrations
+            changed, and results holds one dict per distinct ID with its 'registration'
+            or 'user' ID and a 'status' of checked_in, already_checked_in, waitlisted
+            or not_found
+    """
+    if user_ids and event is None:
+        raise ValueError('An event is required to check in by user ID')
+
+    checked_in = 0
+    results = []
+    for key, ids in (('registration', registration_ids), ('user', user_ids)):
+        lookup = 'pk__in' if key == 'registration' else 'user_id__in'
+        for chunk in chunked(list(dict.fromkeys(ids)), chunk_size):
+            registrations = EventRegistration.objects.filter(**{lookup: chunk})
+            if event is not None:
+                registrations = registrations.filter(event=event)
+            found = {
+                (registration_id if key == 'registration' else user_id): (registration_id, status, attended)
+                for registration_id, user_id, status, attended in registrations.values_list(
+                    'id', 'user_id', 'status', 'attended'
+                )
+            }
+
+            to_check_in = [
+                registration_id for registration_id, status, attended in found.values()
+                if status == 'CONFIRMED' and not attended
+            ]
+            if to_check_in:
+                checked_in += EventRegistration.objects.filter(
+                    pk__in=to_check_in, attended=False
+                ).update(attended=True)
+
+            for item_id in chunk:
+                if item_id not in found:
+                    status = 'not_found'
+                else:
+                    _, registration_status, attended = found[item_id]
+                    if registration_status != 'CONFIRMED':
+                        status = 'waitlisted'
+                    elif attended:
+                        status = 'already_checked_in'
+                    else:
+                        status = 'checked_in'
+                results.append({key: item_id, 'status': status})
+
+    logger.info(f"Bulk checked in {checked_in} registrations")
+    return checked_in, results
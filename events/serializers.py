@@ -1,34 +1,52 @@
 from rest_framework import serializers
+from django.db import IntegrityError
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from .models import Event, EventRegistration
+from .registration import register_for_event
 
 User = get_user_model()
 
+# Most IDs accepted by one bulk registration or check-in request
+BULK_MAX_IDS = 10000
 
-class EventListSerializer(serializers.ModelSerializer):
+
+class IsPastMixin:
+    """Serializes Event.is_past reading the clock once per response rather than once per event"""
+    
+    def get_is_past(self, obj):
+        # The context is shared by every row of a many=True serializer
+        if 'today' not in self.context:
+            self.context['today'] = timezone.now().date()
+        return obj.date < self.context['today']
+
+
+class EventListSerializer(IsPastMixin, serializers.ModelSerializer):
     """Serializer for listing events"""
     
     created_by_name = serializers.ReadOnlyField(source='created_by.name')
-    is_past = serializers.ReadOnlyField()
+    is_past = serializers.SerializerMethodField()
+    seats_remaining = serializers.ReadOnlyField()
     
     class Meta:
         model = Event
-        fields = ['id', 'title', 'date', 'time', 'location', 'image', 'attendees',
+        fields = ['id', 'title', 'date', 'time', 'location', 'image', 'attendees', 'capacity', 'seats_remaining',
                   'status', 'is_featured', 'is_registration_open', 'created_by_name', 'is_past']
         read_only_fields = ['id', 'attendees', 'created_at', 'updated_at']
 
 
-class EventDetailSerializer(serializers.ModelSerializer):
+class EventDetailSerializer(IsPastMixin, serializers.ModelSerializer):
     """Serializer for detailed event information"""
     
     created_by = serializers.SerializerMethodField()
-    is_past = serializers.ReadOnlyField()
+    is_past = serializers.SerializerMethodField()
+    seats_remaining = serializers.ReadOnlyField()
     registrations_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Event
         fields = ['id', 'title', 'description', 'date', 'time', 'location', 'image', 
-                  'attendees', 'status', 'is_featured', 'is_registration_open', 
+                  'attendees', 'capacity', 'seats_remaining', 'status', 'is_featured', 'is_registration_open', 
                   'created_by', 'is_past', 'registrations_count', 'created_at', 'updated_at', 'important_reminders']
         read_only_fields = ['id', 'created_at', 'updated_at', 'registrations_count']
     
@@ -42,6 +60,9 @@ class EventDetailSerializer(serializers.ModelSerializer):
         return None
     
     def get_registrations_count(self, obj):
+        # Annotated by EventViewSet.get_queryset
+        if hasattr(obj, 'registrations_count'):
+            return obj.registrations_count
         return obj.registrations.count()
 
 
@@ -50,7 +71,7 @@ class EventCreateSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Event
-        fields = ['title', 'description', 'date', 'time', 'location', 'image', 
+        fields = ['title', 'description', 'date', 'time', 'location', 'image', 'capacity',
                   'is_featured', 'is_registration_open', 'created_by', 'important_reminders']
     
     def validate_created_by(self, value):
@@ -67,8 +88,15 @@ class EventUpdateSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Event
-        fields = ['title', 'description', 'date', 'time', 'location', 'image', 
+        fields = ['title', 'description', 'date', 'time', 'location', 'image', 'capacity',
                   'status', 'is_featured', 'is_registration_open', 'important_reminders']
+    
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # Leave attendees out of the UPDATE; registrations change it concurrently
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
 
 
 class EventRegistrationSerializer(serializers.ModelSerializer):
@@ -79,12 +107,21 @@ class EventRegistrationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = EventRegistration
-        fields = ['id', 'event', 'user', 'user_name', 'event_title', 'registration_date', 'attended']
-        read_only_fields = ['id', 'registration_date', 'user']
+        fields = ['id', 'event', 'user', 'user_name', 'event_title', 'registration_date', 'status', 'attended']
+        read_only_fields = ['id', 'registration_date', 'user', 'status']
+    
+    def get_fields(self):
+        fields = super().get_fields()
+        # The seat is counted on the event registered for, so a registration cannot be moved
+        if self.instance is not None:
+            fields['event'].read_only = True
+        return fields
     
     def validate(self, attrs):
         event = attrs.get('event')
-        user = self.context['request'].user
+        if event is None:
+            # Updates leave the event as it is
+            return attrs
         
         # Check if the event is open for registration
         if not event.is_registration_open:
@@ -94,16 +131,17 @@ class EventRegistrationSerializer(serializers.ModelSerializer):
         if event.is_past:
             raise serializers.ValidationError("Cannot register for past events.")
         
-        # Check if the user is already registered
-        if EventRegistration.objects.filter(event=event, user=user).exists():
-            raise serializers.ValidationError("You are already registered for this event.")
-        
         return attrs
     
     def create(self, validated_data):
         # Automatically set the user to the authenticated user
         validated_data['user'] = self.context['request'].user
-        return super().create(validated_data)
+        
+        # Duplicates are caught by the (event, user) unique constraint rather than a pre-check
+        try:
+            return register_for_event(**validated_data)
+        except IntegrityError:
+            raise serializers.ValidationError("You are already registered for this event.")
 
 
 class EventAttendanceUpdateSerializer(serializers.ModelSerializer):
@@ -112,3 +150,37 @@ class EventAttendanceUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = EventRegistration
         fields = ['attended']
+
+
+class BulkRegistrationSerializer(serializers.Serializer):
+    """Serializer for enrolling a cohort of users in an event (admin only)"""
+    
+    event = serializers.PrimaryKeyRelatedField(queryset=Event.objects.all())
+    user_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False,
+                                     max_length=BULK_MAX_IDS)
+
+
+class BulkCheckInSerializer(serializers.Serializer):
+    """Serializer for checking in many attendees at once (admin only)"""
+    
+    event = serializers.PrimaryKeyRelatedField(queryset=Event.objects.all(), required=False)
+    registration_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False,
+                                             max_length=BULK_MAX_IDS)
+    user_ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False,
+                                     max_length=BULK_MAX_IDS)
+    
+    def validate(self, attrs):
+        if not attrs.get('registration_ids') and not attrs.get('user_ids'):
+            raise serializers.ValidationError("Provide registration_ids or user_ids.")
+        if attrs.get('user_ids') and not attrs.get('event'):
+            raise serializers.ValidationError({"event": "An event is required to check in by user ID."})
+        return attrs
+
+
+class CheckInScanSerializer(serializers.Serializer):
+    """Serializer for a batch of scanned check-in tokens"""
+    
+    # An event ID, compared with the tokens as is to keep scans free of database reads
+    event = serializers.IntegerField(min_value=1, required=False)
+    tokens = serializers.ListField(child=serializers.CharField(max_length=64), allow_empty=False,
+                                   max_length=BULK_MAX_IDS)
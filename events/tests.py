@@ -1,3 +1,411 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin import AdminSite
+from django.contrib.auth import get_user_model
+from django.db import OperationalError, connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from payment.models import Notification
+
+from . import check_in
+from .admin import EventRegistrationAdmin
+from .models import Event, EventRegistration
+from .registration import (
+    bulk_check_in, cancel_registration, promote_waitlist, reconcile_attendees, register_for_event
+)
+
+User = get_user_model()
+
+
+def create_event(user, title='Leadership Summit', **fields):
+    return Event.objects.create(
+        title=title, description=title, date=timezone.now().date() + timedelta(days=7),
+        time='9:00 AM - 4:00 PM', location='Main Hall', image='https://example.com/event.png',
+        created_by=user, **fields
+    )
+
+
+def create_members(count, start=0):
+    return [
+        User.objects.create_user(email=f'member{i}@example.com', name=f'Member {i}', password='pass')
+        for i in range(start, start + count)
+    ]
+
+
+class AttendeeCounterTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(email='organizer@example.com', name='Organizer', password='pass')
+        self.event = create_event(self.organizer)
+
+    def test_register_and_cancel_move_the_counter(self):
+        members = create_members(3)
+        registrations = [register_for_event(self.event, member) for member in members]
+        cancel_registration(registrations[0])
+        cancel_registration(registrations[0])
+
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 2)
+
+    def test_reconcile_fixes_drift_in_one_pass(self):
+        other = create_event(self.organizer, title='Workshop')
+        register_for_event(self.event, self.organizer)
+        Event.objects.filter(pk=self.event.pk).update(attendees=7)
+        Event.objects.filter(pk=other.pk).update(attendees=3)
+
+        self.assertEqual(reconcile_attendees(dry_run=True), {self.event.pk: (7, 1), other.pk: (3, 0)})
+        reconcile_attendees()
+
+        self.assertEqual(
+            dict(Event.objects.values_list('pk', 'attendees')),
+            {self.event.pk: 1, other.pk: 0}
+        )
+        self.assertEqual(reconcile_attendees(), {})
+
+
+class CapacityWaitlistTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(email='organizer@example.com', name='Organizer',
+                                                  password='pass', role='ADMIN')
+        self.event = create_event(self.organizer, capacity=2)
+        self.members = create_members(4)
+
+    def test_registrations_beyond_capacity_are_waitlisted(self):
+        statuses = [register_for_event(self.event, member).status for member in self.members]
+
+        self.event.refresh_from_db()
+        self.assertEqual(statuses, ['CONFIRMED', 'CONFIRMED', 'WAITLISTED', 'WAITLISTED'])
+        self.assertEqual((self.event.attendees, self.event.seats_remaining), (2, 0))
+
+    def test_cancelling_promotes_the_earliest_waitlisted(self):
+        registrations = [register_for_event(self.event, member) for member in self.members]
+
+        cancel_registration(registrations[0])
+
+        self.assertEqual(
+            list(EventRegistration.objects.order_by('id').values_list('status', flat=True)),
+            ['CONFIRMED', 'CONFIRMED', 'WAITLISTED']
+        )
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 2)
+        self.assertTrue(Notification.objects.filter(user=self.members[2], type='EVENT').exists())
+
+    def test_raising_capacity_promotes_in_bulk(self):
+        for member in self.members:
+            register_for_event(self.event, member)
+        client = APIClient()
+        client.force_authenticate(self.organizer)
+
+        response = client.patch(reverse('event-detail', args=[self.event.pk]), {'capacity': 10}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(EventRegistration.objects.filter(status='WAITLISTED').exists())
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 4)
+        self.assertEqual(promote_waitlist(self.event.pk), 0)
+
+    def test_duplicate_registration_is_rejected_by_the_constraint(self):
+        client = APIClient()
+        client.force_authenticate(self.members[0])
+        url = reverse('eventregistration-list')
+
+        first = client.post(url, {'event': self.event.pk}, format='json')
+        second = client.post(url, {'event': self.event.pk}, format='json')
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.data['status'], 'CONFIRMED')
+        self.assertEqual(second.status_code, 400)
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 1)
+
+    def test_admin_adds_and_deletes_go_through_the_counter(self):
+        model_admin = EventRegistrationAdmin(EventRegistration, AdminSite())
+        registrations = []
+        for member in self.members[:3]:
+            registration = EventRegistration(event=self.event, user=member)
+            model_admin.save_model(None, registration, None, change=False)
+            registrations.append(registration)
+
+        self.assertEqual([registration.status for registration in registrations],
+                         ['CONFIRMED', 'CONFIRMED', 'WAITLISTED'])
+
+        model_admin.delete_model(None, registrations[0])
+        self.assertEqual(EventRegistration.objects.get(pk=registrations[2].pk).status, 'CONFIRMED')
+
+        model_admin.delete_queryset(None, EventRegistration.objects.filter(event=self.event))
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 0)
+
+
+class BulkRegistrationTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(email='organizer@example.com', name='Organizer',
+                                                  password='pass', role='ADMIN')
+        self.event = create_event(self.organizer, capacity=3)
+        self.members = create_members(4)
+        self.client = APIClient()
+        self.client.force_authenticate(self.organizer)
+
+    def test_bulk_register_fills_seats_then_waitlists(self):
+        register_for_event(self.event, self.members[0])
+        user_ids = [member.id for member in self.members] + [self.members[1].id, 999999]
+
+        response = self.client.post(reverse('eventregistration-bulk-register'),
+                                    {'event': self.event.pk, 'user_ids': user_ids}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['already_registered', 'CONFIRMED', 'CONFIRMED', 'WAITLISTED', 'not_found'])
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.attendees, 3)
+        self.assertEqual(reconcile_attendees(dry_run=True), {})
+
+    def test_bulk_check_in_is_idempotent_with_per_id_outcomes(self):
+        registrations = [register_for_event(self.event, member) for member in self.members]
+        url = reverse('eventregistration-bulk-check-in')
+        payload = {
+            'event': self.event.pk,
+            'registration_ids': [registrations[0].id, 999999],
+            'user_ids': [self.members[1].id, self.members[3].id],
+        }
+
+        first = self.client.post(url, payload, format='json')
+        second = self.client.post(url, payload, format='json')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data['checked_in'], 2)
+        self.assertEqual([result['status'] for result in first.data['results']],
+                         ['checked_in', 'not_found', 'checked_in', 'waitlisted'])
+        self.assertEqual(second.data['checked_in'], 0)
+        self.assertEqual([result['status'] for result in second.data['results']],
+                         ['already_checked_in', 'not_found', 'already_checked_in', 'waitlisted'])
+        self.assertEqual(EventRegistration.objects.filter(attended=True).count(), 2)
+
+    def test_bulk_check_in_costs_two_queries_per_chunk(self):
+        Event.objects.filter(pk=self.event.pk).update(capacity=None)
+        members = create_members(4, start=4) + self.members[1:]
+        registrations = [register_for_event(self.event, member) for member in members]
+
+        with CaptureQueriesContext(connection) as queries:
+            checked_in, _ = bulk_check_in(registration_ids=[r.id for r in registrations], chunk_size=4)
+
+        self.assertEqual(checked_in, len(registrations))
+        self.assertEqual(len(queries), 4)
+
+    def test_check_in_by_user_needs_an_event(self):
+        response = self.client.post(reverse('eventregistration-bulk-check-in'),
+                                    {'user_ids': [self.members[0].id]}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+
+class CheckInTokenTests(TestCase):
+    def setUp(self):
+        self.organizer = User.objects.create_user(email='organizer@example.com', name='Organizer',
+                                                  password='pass', role='ADMIN')
+        self.event = create_event(self.organizer)
+        self.registrations = [register_for_event(self.event, member) for member in create_members(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.organizer)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = check_in.CheckInJournal(os.path.join(directory.name, 'journal.jsonl'))
+        patcher = mock.patch.object(check_in, 'check_in_journal', self.journal)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tokens_verify_without_database_access(self):
+        tokens = [check_in.make_check_in_token(registration) for registration in self.registrations]
+
+        with self.assertNumQueries(0):
+            verified = [check_in.verify_check_in_token(token) for token in tokens * 100]
+
+        registration = self.registrations[0]
+        self.assertEqual(verified[0], (registration.id, self.event.id, registration.user_id))
+        tampered = tokens[0][:-2] + ('AA' if tokens[0][-2:] != 'AA' else 'BB')
+        for token in (tampered, 'not-a-token', tokens[0][:20]):
+            with self.assertRaises(check_in.InvalidCheckInToken):
+                check_in.verify_check_in_token(token)
+
+    def test_scans_are_journaled_then_synced(self):
+        tokens = [check_in.make_check_in_token(registration) for registration in self.registrations]
+        other_event = create_event(self.organizer, title='Workshop')
+        other = register_for_event(other_event, self.organizer)
+        url = reverse('eventregistration-scan')
+
+        response = self.client.post(url, {
+            'event': self.event.pk,
+            'tokens': tokens[:2] + [check_in.make_check_in_token(other), 'garbage'],
+        }, format='json')
+
+        self.assertEqual([result['status'] for result in response.data['results']],
+                         ['accepted', 'accepted', 'wrong_event', 'invalid'])
+        self.assertFalse(EventRegistration.objects.filter(attended=True).exists())
+
+        # A scan repeated at the door is harmless
+        self.client.post(url, {'tokens': tokens[:1]}, format='json')
+        self.assertEqual(self.journal.sync(batch_size=2), (3, 2))
+        self.assertEqual(self.journal.sync(), (0, 0))
+        self.assertEqual(
+            set(EventRegistration.objects.filter(attended=True).values_list('id', flat=True)),
+            {self.registrations[0].id, self.registrations[1].id}
+        )
+
+    def test_failed_sync_is_retried(self):
+        self.journal.append([check_in.verify_check_in_token(check_in.make_check_in_token(self.registrations[0]))])
+
+        with mock.patch.object(check_in, 'bulk_check_in', side_effect=OperationalError('network down')):
+            with self.assertRaises(OperationalError):
+                self.journal.sync()
+        self.assertEqual(self.journal.synced_offset(), 0)
+
+        self.assertEqual(self.journal.sync(), (1, 1))
+
+    def test_sync_compacts_the_journal(self):
+        scan = check_in.verify_check_in_token(check_in.make_check_in_token(self.registrations[0]))
+        self.journal.append([scan, scan])
+        self.assertEqual(self.journal.sync(), (2, 1))
+
+        self.assertEqual(os.path.getsize(self.journal.path), 0)
+        self.assertEqual(self.journal.synced_offset(), 0)
+
+        self.journal.append([check_in.verify_check_in_token(check_in.make_check_in_token(self.registrations[1]))])
+        self.assertEqual(self.journal.sync(), (1, 1))
+
+    def test_waitlisted_registrations_get_no_token(self):
+        Event.objects.filter(pk=self.event.pk).update(capacity=3)
+        waitlisted = register_for_event(self.event, self.organizer)
+
+        response = self.client.get(reverse('eventregistration-check-in-token', args=[waitlisted.pk]))
+
+        self.assertEqual(response.status_code, 400)
+
+
+class EventQueryCountTests(TestCase):
+    def setUp(self):
+        self.member = User.objects.create_user(email='member@example.com', name='Member', password='pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.member)
+
+    def add_events(self, count):
+        for i in range(count):
+            organizer = User.objects.create_user(email=f'organizer{Event.objects.count()}@example.com',
+                                                 name='Organizer', password='pass')
+            for event in (create_event(organizer, title=f'Talk {i}'), create_event(self.member, title=f'Meetup {i}')):
+                register_for_event(event, self.member)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_lists_run_a_constant_number_of_queries(self):
+        for name in ('event-list', 'event-my-events', 'event-registered'):
+            self.add_events(2)
+            before = self.count_queries(reverse(name))
+            self.add_events(3)
+            self.assertEqual(self.count_queries(reverse(name)), before, name)
+
+    def test_detail_reads_the_event_in_one_query(self):
+        self.add_events(1)
+        event = Event.objects.first()
+        register_for_event(event, User.objects.create_user(email='guest@example.com', name='Guest', password='pass'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('event-detail', args=[event.pk]))
+
+        self.assertEqual(response.data['registrations_count'], 2)
+        self.assertEqual(response.data['created_by']['id'], event.created_by_id)
+
+    def test_clock_is_read_once_per_response(self):
+        self.add_events(3)
+
+        with mock.patch('django.utils.timezone.now', wraps=timezone.now) as now:
+            response = self.client.get(reverse('event-list'))
+
+        self.assertEqual(now.call_count, 1)
+        self.assertFalse(response.data['results'][0]['is_past'])
+
+
+def retry_locked(func, *args, attempts=50):
+    """Call func, retrying while SQLite refuses the write because the database is locked"""
+    for attempt in range(attempts):
+        try:
+            return func(*args)
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+
+class ConcurrentAttendeeCounterTests(TransactionTestCase):
+    def test_counter_stays_exact_under_concurrent_registrations(self):
+        organizer = User.objects.create_user(email='organizer@example.com', name='Organizer', password='pass')
+        event = create_event(organizer)
+        members = create_members(24)
+        start = threading.Barrier(8)
+
+        def register_then_maybe_cancel(index):
+            try:
+                start.wait(timeout=1)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                registration = retry_locked(register_for_event, event, members[index])
+                if index % 3 == 0:
+                    retry_locked(cancel_registration, registration)
+                return True
+            except OperationalError:
+                # SQLite kept refusing the writer; the counter must still match
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            succeeded = sum(executor.map(register_then_maybe_cancel, range(len(members))))
+
+        # A storm where most threads error proves nothing about the counter
+        self.assertGreaterEqual(succeeded, len(members) // 2)
+        event.refresh_from_db()
+        self.assertEqual(event.attendees, EventRegistration.objects.filter(event=event).count())
+        self.assertEqual(reconcile_attendees(dry_run=True), {})
+
+    def test_hot_event_is_never_overbooked(self):
+        organizer = User.objects.create_user(email='organizer@example.com', name='Organizer', password='pass')
+        event = create_event(organizer, capacity=5)
+        members = create_members(20)
+        start = threading.Barrier(8)
+
+        def register(member):
+            try:
+                start.wait(timeout=1)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                retry_locked(register_for_event, event, member)
+                return True
+            except OperationalError:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            registered = sum(executor.map(register, members))
+
+        self.assertGreaterEqual(registered, len(members) // 2)
+        self.assertEqual(EventRegistration.objects.filter(event=event).count(), registered)
+        event.refresh_from_db()
+        confirmed = EventRegistration.objects.filter(event=event, status='CONFIRMED').count()
+        self.assertEqual(confirmed, 5)
+        self.assertEqual(event.attendees, confirmed)
@@ -2,12 +2,16 @@ from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
+from django.db.models import Count
 from django.utils import timezone
 
 from .models import Event, EventRegistration
+from . import check_in
+from .registration import bulk_check_in, bulk_register, cancel_registration, promote_waitlist
 from .serializers import (
     EventListSerializer, EventDetailSerializer, EventCreateSerializer, 
-    EventUpdateSerializer, EventRegistrationSerializer, EventAttendanceUpdateSerializer
+    EventUpdateSerializer, EventRegistrationSerializer, EventAttendanceUpdateSerializer,
+    BulkRegistrationSerializer, BulkCheckInSerializer, CheckInScanSerializer
 )
 from users.permissions import IsAdminOrManager, IsAdminOrManagerOrOwner
 
@@ -40,7 +44,9 @@ class EventViewSet(viewsets.ModelViewSet):
         return [permissions.IsAuthenticated(), IsAdminOrManager()]
     
     def get_queryset(self):
-        queryset = self.queryset
+        queryset = self.queryset.select_related('created_by')
+        if self.action == 'retrieve':
+            queryset = queryset.annotate(registrations_count=Count('registrations'))
         
         # Filter by status if provided
         status_param = self.request.query_params.get('status', None)
@@ -70,6 +76,13 @@ class EventViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    def perform_update(self, serializer):
+        event = serializer.save()
+        
+        # A raised (or removed) capacity frees seats for the waitlist
+        if 'capacity' in serializer.validated_data:
+            promote_waitlist(event.id)
+    
     @action(detail=False, methods=['get'])
     def my_events(self, request):
         """
@@ -81,14 +94,14 @@ class EventViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        queryset = Event.objects.filter(created_by=request.user).order_by('date')
+        queryset = Event.objects.filter(created_by=request.user).select_related('created_by').order_by('date')
         page = self.paginate_queryset(queryset)
         
         if page is not None:
-            serializer = EventListSerializer(page, many=True)
+            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         
-        serializer = EventListSerializer(queryset, many=True)
+        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
     
     @action(detail=False, methods=['get'])
@@ -104,14 +117,14 @@ class EventViewSet(viewsets.ModelViewSet):
         
         # Get all event IDs the user is registered for
         registrations = EventRegistration.objects.filter(user=request.user).values_list('event_id', flat=True)
-        queryset = Event.objects.filter(id__in=registrations).order_by('date')
+        queryset = Event.objects.filter(id__in=registrations).select_related('created_by').order_by('date')
         
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = EventListSerializer(page, many=True)
+            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         
-        serializer = EventListSerializer(queryset, many=True)
+        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
 
@@ -137,7 +150,7 @@ class EventRegistrationViewSet(viewsets.ModelViewSet):
             return [permissions.IsAuthenticated()]
         
         # For other actions, require admin/manager permissions
-        if self.action in ['update', 'partial_update', 'update_attendance']:
+        if self.action in ['update', 'partial_update', 'update_attendance', 'bulk_register', 'bulk_check_in', 'scan']:
             return [permissions.IsAuthenticated(), IsAdminOrManager()]
         
         # For list and retrieve, only require authentication
@@ -165,28 +178,16 @@ class EventRegistrationViewSet(viewsets.ModelViewSet):
         return queryset
     
     def perform_create(self, serializer):
-        # Save the registration
-        registration = serializer.save()
-        
-        # Update event attendee count
-        event = registration.event
-        event.attendees = EventRegistration.objects.filter(event=event).count()
-        event.save()
+        # The serializer registers the user and bumps the event's attendee count
+        serializer.save()
     
     def perform_destroy(self, instance):
         # Check if user can delete this registration
         if self.request.user.role not in ['ADMIN', 'MANAGER'] and instance.user != self.request.user:
             raise permissions.PermissionDenied("You can only delete your own registrations.")
         
-        # Save the event before deleting the registration
-        event = instance.event
-        
-        # Delete the registration
-        instance.delete()
-        
-        # Update event attendee count
-        event.attendees = EventRegistration.objects.filter(event=event).count()
-        event.save()
+        # Delete the registration and decrement the event attendee count
+        cancel_registration(instance)
     
     @action(detail=True, methods=['patch'])
     def update_attendance(self, request, pk=None):
@@ -201,3 +202,84 @@ class EventRegistrationViewSet(viewsets.ModelViewSet):
             return Response(serializer.data)
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    @action(detail=False, methods=['post'])
+    def bulk_register(self, request):
+        """
+        Register a cohort of users for an event in one request (admin only)
+        
+        Accepts {"event": id, "user_ids": [...]}. Users are confirmed while seats
+        remain and waitlisted after that; users already registered are skipped.
+        """
+        serializer = BulkRegistrationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        results = bulk_register(serializer.validated_data['event'], serializer.validated_data['user_ids'])
+        return Response({'results': results})
+    
+    @action(detail=False, methods=['post'])
+    def bulk_check_in(self, request):
+        """
+        Mark many registrations as attended in one request (admin only)
+        
+        Accepts {"registration_ids": [...]} and/or {"event": id, "user_ids": [...]}.
+        Sending the same IDs again is harmless; each ID gets its own outcome.
+        """
+        serializer = BulkCheckInSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        checked_in, results = bulk_check_in(
+            event=serializer.validated_data.get('event'),
+            registration_ids=serializer.validated_data.get('registration_ids', []),
+            user_ids=serializer.validated_data.get('user_ids', [])
+        )
+        return Response({'checked_in': checked_in, 'results': results})
+    
+    @action(detail=True, methods=['get'])
+    def check_in_token(self, request, pk=None):
+        """
+        Get the QR check-in token of a confirmed registration
+        """
+        registration = self.get_object()
+        if registration.status != 'CONFIRMED':
+            return Response(
+                {"detail": "Only confirmed registrations can be checked in."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response({'registration': registration.id, 'token': check_in.make_check_in_token(registration)})
+    
+    @action(detail=False, methods=['post'])
+    def scan(self, request):
+        """
+        Accept scanned check-in tokens at the door (admin only)
+        
+        Accepts {"tokens": [...]} and an optional "event" the tokens must be for.
+        Tokens are verified without database access and valid scans are journaled;
+        the sync_check_ins command marks them as attended.
+        """
+        serializer = CheckInScanSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        event_id = serializer.validated_data.get('event')
+        accepted = []
+        results = []
+        for token in serializer.validated_data['tokens']:
+            try:
+                scanned = check_in.verify_check_in_token(token)
+            except check_in.InvalidCheckInToken as e:
+                results.append({'token': token, 'status': 'invalid', 'detail': str(e)})
+                continue
+            
+            if event_id is not None and scanned.event_id != event_id:
+                results.append({'token': token, 'registration': scanned.registration_id, 'status': 'wrong_event'})
+                continue
+            
+            accepted.append(scanned)
+            results.append({'token': token, 'registration': scanned.registration_id, 'status': 'accepted'})
+        
+        check_in.check_in_journal.append(accepted)
+        return Response({'accepted': len(accepted), 'results': results})
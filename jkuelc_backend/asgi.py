@@ -3,6 +3,10 @@ ASGI config for jkuelc_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run it with an ASGI server (e.g. ``uvicorn jkuelc_backend.asgi:application``) so that
+async views such as ``payment.async_views.initiate_order_payment_async`` run natively on
+the event loop instead of in a worker thread.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
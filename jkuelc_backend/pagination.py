@@ -0,0 +1,18 @@
+"""
+Pagination classes shared by the apps.
+"""
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """
+    Keyset pagination on (created_at, id), newest first.
+    
+    Each page is fetched with ``WHERE created_at < <cursor> ORDER BY created_at DESC, id DESC
+    LIMIT n`` instead of COUNT(*) and OFFSET, so a deep page costs the same as the first.
+    Clients can pick the page size with ``page_size`` up to ``max_page_size``.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
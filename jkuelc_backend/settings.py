@@ -95,6 +95,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Use a shared backend (e.g. Redis or Memcached) in production so that all
+# gunicorn workers share cached values such as the M-Pesa access token.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -181,12 +193,34 @@ CSRF_TRUSTED_ORIGINS = [
 CORS_ALLOW_CREDENTIALS = True
 
 # M-Pesa Daraja API Settings
-MPESA_ENVIRONMENT = 'sandbox'  # Change to 'production' for live environment
+MPESA_ENVIRONMENT = 'sandbox'  # Change to 'production' for live environment, or 'simulator' for load tests
 MPESA_CONSUMER_KEY = 'your_consumer_key'  # Replace with your key
 MPESA_CONSUMER_SECRET = 'your_consumer_secret'  # Replace with your secret
 MPESA_SHORTCODE = 'your_shortcode'  # Business Shortcode
 MPESA_PASSKEY = 'your_passkey'  # Online passkey from Safaricom
 MPESA_CALLBACK_URL = ''  # To be configured per environment
+MPESA_SIMULATOR_URL = 'http://127.0.0.1:8089'  # Used when MPESA_ENVIRONMENT is 'simulator'
+MPESA_TOKEN_REFRESH_MARGIN = 300  # Refresh the OAuth token this many seconds before it expires
+MPESA_HTTP_POOL_SIZE = 10  # Keep-alive connections per worker
+MPESA_CONNECT_TIMEOUT = 5  # Seconds
+MPESA_READ_TIMEOUT = 30  # Seconds
+MPESA_MAX_RETRIES = 2  # Retries for idempotent calls (token, STK query)
+MPESA_RETRY_BACKOFF = 0.5  # Base backoff delay in seconds, jittered
+MPESA_RECONCILE_MIN_AGE = 120  # Seconds a transaction must be pending before reconcile_mpesa queries it
+MPESA_RECONCILE_BATCH_SIZE = 100
+MPESA_RECONCILE_CONCURRENCY = 5  # Concurrent STK status queries
+MPESA_CALLBACK_DEDUP_TTL = 60 * 60 * 24  # Seconds a processed CheckoutRequestID is remembered
+MPESA_CALLBACK_MODE = 'inline'  # 'queue' stores callbacks for the process_mpesa_callbacks worker
+MPESA_CALLBACK_MAX_ATTEMPTS = 5  # Attempts before a failing queued callback is left for inspection
+
+# Merchandise settings
+MERCHANDISE_STOCK_HOLD_TTL = 15 * 60  # Seconds an unpaid order holds its stock; extended when an STK push is sent
+MERCHANDISE_CATALOG_LIST_TTL = 60  # Seconds a cached public catalog page is served
+MERCHANDISE_CATALOG_DETAIL_TTL = 300  # Seconds a cached public item detail is served
+MERCHANDISE_CATALOG_INDEX_MAX_AGE = 5  # Seconds a worker's catalog index is kept; bounds how long a worker misses others' writes under LocMemCache
+
+# Events settings
+EVENTS_CHECK_IN_JOURNAL = BASE_DIR / 'logs' / 'check_in_journal.jsonl'  # Scans accepted at the door, synced by sync_check_ins
 
 # Logging configuration
 LOGGING = {
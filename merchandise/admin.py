@@ -1,5 +1,6 @@
-from django.contrib import admin
-from .models import Merchandise, Order, OrderItem
+from django.contrib import admin, messages
+from .models import Merchandise, Order, OrderItem, StockHold
+from .stock import InsufficientStockError, change_order_status
 
 
 class OrderItemInline(admin.TabularInline):
@@ -8,6 +9,13 @@ class OrderItemInline(admin.TabularInline):
     readonly_fields = ('subtotal',)
 
 
+class StockHoldInline(admin.TabularInline):
+    model = StockHold
+    extra = 0
+    readonly_fields = ('merchandise', 'quantity', 'status', 'expires_at')
+    can_delete = False
+
+
 class MerchandiseAdmin(admin.ModelAdmin):
     list_display = ('name', 'price', 'category', 'stock', 'in_stock', 'featured', 'rating')
     list_filter = ('category', 'featured', 'created_at')
@@ -32,7 +40,21 @@ class OrderAdmin(admin.ModelAdmin):
         ('Shipping', {'fields': ('shipping_address',)}),
         ('Timestamps', {'fields': ('created_at', 'updated_at')}),
     )
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, StockHoldInline]
+
+    def save_model(self, request, obj, form, change):
+        if not change or 'status' not in form.changed_data:
+            super().save_model(request, obj, form, change)
+            return
+
+        # Save the other fields, then move the status with the order's stock holds
+        status = obj.status
+        obj.status = form.initial['status']
+        super().save_model(request, obj, form, change)
+        try:
+            change_order_status(obj, status)
+        except InsufficientStockError as e:
+            self.message_user(request, f"Status not changed: {e}", level=messages.ERROR)
 
 
 admin.site.register(Merchandise, MerchandiseAdmin)
@@ -0,0 +1,237 @@
+"""
+Sales analytics rollups.
+
+Revenue and units sold per item per day (DailyItemSales), and the number and sum of
+completed payments per day, type and method (DailyPaymentTotal), are maintained
+incrementally when a payment is completed, so analytics never scan orders or payments.
+
+Each rollup row is bumped with ``col = col + n`` UPDATEs, and only created on the first
+sale of the day, so concurrent payments cannot lose each other's counts. A sale is
+counted on the local date its payment was completed; rebuild_rollups recomputes the
+same figures from orders and payments (see the backfill_sales_rollups command).
+"""
+import logging
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import DailyItemSales, OrderItem
+from payment.models import DailyPaymentTotal, Payment
+from payment.reports import date_range
+
+logger = logging.getLogger('merchandise.analytics')
+
+
+def increment_rollup(model, keys, create=True, **amounts):
+    """
+    Add ``amounts`` to the rollup row identified by ``keys``, creating it if needed
+
+    Args:
+        model: DailyItemSales or DailyPaymentTotal
+        keys (dict): Values of the model's unique fields
+        create: Whether to create a missing row; False for subtractions
+        **amounts: Counter field -> amount to add, negative to subtract
+    """
+    increments = {field: F(field) + amount for field, amount in amounts.items()}
+    if model.objects.filter(**keys).update(**increments) or not create:
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **amounts)
+    except IntegrityError:
+        # Another payment created the row first
+        model.objects.filter(**keys).update(**increments)
+
+
+def apply_payment(payment, day, sign):
+    """Add (sign=1) or subtract (sign=-1) a completed payment in the rollups of ``day``"""
+    create = sign > 0
+
+    increment_rollup(
+        DailyPaymentTotal,
+        {'date': day, 'payment_type': payment.payment_type, 'payment_method': payment.payment_method or ''},
+        create=create,
+        count=sign,
+        amount=sign * payment.amount
+    )
+
+    if payment.payment_type != 'ORDER' or not payment.order_id:
+        return
+
+    lines = (
+        OrderItem.objects.filter(order_id=payment.order_id)
+        .values('merchandise_id')
+        .annotate(units=Sum('quantity'), revenue=Sum(F('quantity') * F('unit_price')))
+        .order_by('merchandise_id')
+    )
+    for line in lines:
+        increment_rollup(
+            DailyItemSales,
+            {'date': day, 'merchandise_id': line['merchandise_id']},
+            create=create,
+            units=sign * line['units'],
+            revenue=sign * line['revenue'],
+            orders=sign
+        )
+
+
+def record_completed_payment(payment, day=None):
+    """
+    Add a payment that has just been completed to the rollups
+
+    Must be called once per transition to COMPLETED, in the transaction making it.
+
+    Args:
+        payment: The completed Payment
+        day: Date to count the sale on; defaults to today
+    """
+    apply_payment(payment, day or timezone.localdate(), 1)
+
+
+def record_payment_status_change(payment, was_completed, completed_at=None):
+    """
+    Keep the rollups in step with a saved change of a payment's status
+
+    Call it in the transaction that saved the payment, with the payment row locked
+    (select_for_update) since before its old status was read.
+
+    Args:
+        payment: The saved Payment
+        was_completed: Whether the payment was COMPLETED before the change
+        completed_at: The payment's updated_at before the change; a payment leaving
+            COMPLETED is subtracted from the rollups of that day
+    """
+    if payment.status == 'COMPLETED' and not was_completed:
+        record_completed_payment(payment)
+    elif was_completed and payment.status != 'COMPLETED':
+        day = timezone.localdate(completed_at) if completed_at else timezone.localdate()
+        apply_payment(payment, day, -1)
+
+
+def rebuild_rollups(start_date=None, end_date=None, batch_size=1000):
+    """
+    Recompute the rollups for a range of dates from orders and payments
+
+    A completed payment is counted on the date it was last updated, which is the
+    date it was completed unless it was edited afterwards. Run this while payments
+    are quiet; increments made during the rebuild may be lost.
+
+    Args:
+        start_date, end_date: Inclusive range of dates; None leaves that end open
+        batch_size: Rows inserted per query
+
+    Returns:
+        tuple: (item_rows, payment_rows) created
+    """
+    start, end = date_range(start_date, end_date)
+
+    payments = Payment.objects.filter(status='COMPLETED')
+    if start:
+        payments = payments.filter(updated_at__gte=start)
+    if end:
+        payments = payments.filter(updated_at__lt=end)
+
+    payment_totals = (
+        payments.annotate(day=TruncDate('updated_at'), method=Coalesce('payment_method', Value('')))
+        .values('day', 'payment_type', 'method')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+        .order_by()
+    )
+    # Driven from the completed payments, so each one adds its order's items exactly once,
+    # like record_completed_payment, however many other payments the order has
+    item_totals = (
+        payments.filter(payment_type='ORDER', order__isnull=False)
+        .annotate(day=TruncDate('updated_at'), item=F('order__items__merchandise_id'))
+        .values('day', 'item')
+        .annotate(
+            units=Sum('order__items__quantity'),
+            revenue=Sum(F('order__items__quantity') * F('order__items__unit_price')),
+            orders=Count('id', distinct=True)
+        )
+        .order_by()
+    )
+
+    item_rollups = [
+        DailyItemSales(date=row['day'], merchandise_id=row['item'],
+                       units=row['units'], revenue=row['revenue'], orders=row['orders'])
+        for row in item_totals
+        if row['item'] is not None
+    ]
+    payment_rollups = [
+        DailyPaymentTotal(date=row['day'], payment_type=row['payment_type'], payment_method=row['method'],
+                          count=row['count'], amount=row['amount'])
+        for row in payment_totals
+    ]
+
+    with transaction.atomic():
+        for model in (DailyItemSales, DailyPaymentTotal):
+            stale = model.objects.all()
+            if start_date:
+                stale = stale.filter(date__gte=start_date)
+            if end_date:
+                stale = stale.filter(date__lte=end_date)
+            stale.delete()
+        DailyItemSales.objects.bulk_create(item_rollups, batch_size=batch_size)
+        DailyPaymentTotal.objects.bulk_create(payment_rollups, batch_size=batch_size)
+
+    logger.info(f"Rebuilt sales rollups: {len(item_rollups)} item rows, {len(payment_rollups)} payment rows")
+    return len(item_rollups), len(payment_rollups)
+
+
+def sales_summary(start_date, end_date, top=10):
+    """
+    Sales analytics for an inclusive range of dates, read from the rollups only
+
+    Returns:
+        dict: Totals, a per-day series, the ``top`` items by revenue and payment
+            totals per type and method
+    """
+    item_sales = DailyItemSales.objects.filter(date__gte=start_date, date__lte=end_date)
+    payment_totals = DailyPaymentTotal.objects.filter(date__gte=start_date, date__lte=end_date)
+    order_payments = payment_totals.filter(payment_type='ORDER')
+
+    totals = item_sales.aggregate(revenue=Sum('revenue'), units=Sum('units'))
+    paid_orders = order_payments.aggregate(count=Sum('count'))['count']
+
+    daily = {
+        row['date']: {'date': row['date'], 'revenue': row['revenue'], 'units': row['units'], 'paid_orders': 0}
+        for row in item_sales.values('date').annotate(revenue=Sum('revenue'), units=Sum('units')).order_by('date')
+    }
+    for row in order_payments.values('date').annotate(count=Sum('count')).order_by('date'):
+        day = daily.setdefault(row['date'], {'date': row['date'], 'revenue': 0, 'units': 0, 'paid_orders': 0})
+        day['paid_orders'] = row['count']
+
+    items = (
+        item_sales.values('merchandise_id', 'merchandise__name')
+        .annotate(units=Sum('units'), revenue=Sum('revenue'), orders=Sum('orders'))
+        .order_by('-revenue', 'merchandise_id')[:top]
+    )
+    payments = (
+        payment_totals.values('payment_type', 'payment_method')
+        .annotate(count=Sum('count'), amount=Sum('amount'))
+        .order_by('payment_type', 'payment_method')
+    )
+
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'totals': {
+            'revenue': totals['revenue'] or 0,
+            'units': totals['units'] or 0,
+            'paid_orders': paid_orders or 0,
+        },
+        'daily': [daily[day] for day in sorted(daily)],
+        'items': [
+            {
+                'merchandise_id': row['merchandise_id'],
+                'name': row['merchandise__name'],
+                'units': row['units'],
+                'revenue': row['revenue'],
+                'orders': row['orders'],
+            }
+            for row in items
+        ],
+        'payments': list(payments),
+    }
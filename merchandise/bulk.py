@@ -0,0 +1,237 @@
+"""
+Bulk merchandise stock updates, imports and exports.
+A batch is validated in full before anything is written: if any row is invalid nothing
+is applied and every row's result is returned. Valid batches are written with
+bulk_create/bulk_update in chunks inside one transaction. Exports are generated row by
+row so they can be streamed.
+"""
+import codecs
+import csv
+import json
+import logging
+from django.db import transaction
+from django.utils import timezone
+
+from .catalog_cache import bump_catalog_stock, bump_catalog_version
+from .models import Merchandise
+from .serializers import MerchandiseUpdateSerializer, StockUpdateRowSerializer
+
+logger = logging.getLogger('merchandise.bulk')
+
+FILE_FORMATS = ('csv', 'jsonl')
+EXPORT_FIELDS = ['id', 'name', 'description', 'price', 'image', 'category', 'stock', 'featured', 'rating']
+IMPORT_FIELDS = EXPORT_FIELDS[1:]
+
+
+class BulkFormatError(Exception):
+    """Raised when an import file cannot be parsed"""
+
+
+def parse_rows(stream, file_format):
+    """
+    Read merchandise rows from a binary file-like object
+
+    Args:
+        stream: Binary file-like object (an upload, or a file opened in binary mode),
+            read line by line
+        file_format (str): 'csv' (with a header row) or 'jsonl' (one JSON object per line)
+
+    Returns:
+        list: One dict per row. Empty CSV cells are left out.
+
+    Raises:
+        BulkFormatError: If the file is not valid for its format
+    """
+    if file_format not in FILE_FORMATS:
+        raise BulkFormatError(f"Unsupported format '{file_format}', use one of: {', '.join(FILE_FORMATS)}")
+
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    try:
+        if file_format == 'csv':
+            return [
+                {key: value for key, value in row.items() if key and value not in ('', None)}
+                for row in csv.DictReader(lines)
+            ]
+
+        rows = []
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise BulkFormatError(f"Line {line_number} is not a JSON object")
+            rows.append(row)
+        return rows
+    except (UnicodeDecodeError, csv.Error, ValueError) as e:
+        raise BulkFormatError(str(e))
+
+
+def apply_stock_updates(rows, chunk_size=500):
+    """
+    Set the stock of many items at once
+
+    Args:
+        rows (list): ``{'id': ..., 'stock': ...}`` dicts
+        chunk_size: Number of rows per UPDATE
+
+    Returns:
+        tuple: (applied, results) where applied is False if any row was invalid, and
+            results holds one dict per row with its 1-based 'row' number and 'status'
+    """
+    ids = [row.get('id') for row in rows if isinstance(row, dict)]
+    existing = Merchandise.objects.in_bulk([int(i) for i in ids if str(i).isdigit()])
+
+    results = []
+    changed = {}
+    for number, row in enumerate(rows, start=1):
+        serializer = StockUpdateRowSerializer(data=row)
+        if not serializer.is_valid():
+            results.append({'row': number, 'status': 'error', 'errors': serializer.errors})
+            continue
+
+        merchandise = existing.get(serializer.validated_data['id'])
+        if merchandise is None:
+            results.append({'row': number, 'id': serializer.validated_data['id'], 'status': 'error',
+                            'errors': {'id': ['Merchandise not found.']}})
+            continue
+
+        merchandise.stock = serializer.validated_data['stock']
+        changed[merchandise.id] = merchandise
+        results.append({'row': number, 'id': merchandise.id, 'status': 'updated', 'stock': merchandise.stock})
+
+    if any(result['status'] == 'error' for result in results):
+        return False, results
+
+    now = timezone.now()
+    for merchandise in changed.values():
+        merchandise.updated_at = now
+    with transaction.atomic():
+        Merchandise.objects.bulk_update(list(changed.values()), ['stock', 'updated_at'], batch_size=chunk_size)
+        bump_catalog_stock(changed)
+
+    logger.info(f"Bulk updated stock of {len(changed)} merchandise items")
+    return True, results
+
+
+def import_merchandise(rows, created_by, chunk_size=500):
+    """
+    Create or update merchandise from import rows
+
+    Rows with an ``id`` update that item (only the given fields change); rows
+    without one create a new item owned by ``created_by``. Updated items are
+    re-read with SELECT ... FOR UPDATE before they are written, and only the
+    fields a row supplies are written, so an import that leaves out ``stock``
+    cannot undo concurrent stock reservations.
+
+    Args:
+        rows (list): Dicts with any of IMPORT_FIELDS, plus an optional id
+        created_by: User recorded as the creator of new items
+        chunk_size: Number of rows per INSERT or UPDATE
+
+    Returns:
+        tuple: (applied, results) as for apply_stock_updates, with a status of
+            'created', 'updated' or 'error' per row
+    """
+    ids = [row.get('id') for row in rows if isinstance(row, dict)]
+    existing = Merchandise.objects.in_bulk([int(i) for i in ids if str(i).isdigit()])
+
+    results = []
+    to_create = []
+    to_update = {}
+    for number, row in enumerate(rows, start=1):
+        data = {field: row[field] for field in IMPORT_FIELDS if field in row}
+        row_id = row.get('id')
+
+        if row_id not in (None, ''):
+            merchandise = existing.get(int(row_id)) if str(row_id).isdigit() else None
+            if merchandise is None:
+                results.append({'row': number, 'id': row_id, 'status': 'error',
+                                'errors': {'id': ['Merchandise not found.']}})
+                continue
+            serializer = MerchandiseUpdateSerializer(merchandise, data=data, partial=True)
+        else:
+            merchandise = None
+            serializer = MerchandiseUpdateSerializer(data=data)
+
+        if not serializer.is_valid():
+            results.append({'row': number, 'status': 'error', 'errors': serializer.errors})
+            continue
+
+        if merchandise is None:
+            to_create.append((number, Merchandise(created_by=created_by, **serializer.validated_data)))
+            results.append({'row': number, 'status': 'created'})
+        else:
+            to_update.setdefault(merchandise.id, {}).update(serializer.validated_data)
+            results.append({'row': number, 'id': merchandise.id, 'status': 'updated'})
+
+    if any(result['status'] == 'error' for result in results):
+        return False, results
+
+    now = timezone.now()
+    with transaction.atomic():
+        locked = Merchandise.objects.select_for_update().in_bulk(sorted(to_update))
+        missing = set(to_update) - set(locked)
+        if missing:
+            # Deleted since the rows were validated
+            for result in results:
+                if result.get('id') in missing:
+                    result.update(status='error', errors={'id': ['Merchandise not found.']})
+            return False, results
+
+        # bulk_update writes one set of fields, so items are grouped by the fields given
+        by_fields = {}
+        for merchandise_id, changes in to_update.items():
+            merchandise = locked[merchandise_id]
+            for field, value in changes.items():
+                setattr(merchandise, field, value)
+            merchandise.updated_at = now
+            by_fields.setdefault(tuple(sorted(changes)), []).append(merchandise)
+
+        created = Merchandise.objects.bulk_create([item for _, item in to_create], batch_size=chunk_size)
+        for fields, items in by_fields.items():
+            Merchandise.objects.bulk_update(items, list(fields) + ['updated_at'], batch_size=chunk_size)
+        bump_catalog_version()
+
+    # Report the ids of new items where the database returns them
+    created_ids = {number: item.id for (number, _), item in zip(to_create, created)}
+    for result in results:
+        if result['row'] in created_ids:
+            result['id'] = created_ids[result['row']]
+
+    logger.info(f"Imported merchandise: {len(to_create)} created, {len(to_update)} updated")
+    return True, results
+
+
+class Echo:
+    """File-like object whose write returns the value, so csv.writer can feed a generator"""
+
+    def write(self, value):
+        return value
+
+
+def export_merchandise(file_format, queryset=None, chunk_size=500):
+    """
+    Yield the catalog as CSV or JSONL, one line at a time
+
+    Args:
+        file_format (str): 'csv' or 'jsonl'
+        queryset: Merchandise to export, all items by default
+        chunk_size: Rows fetched from the database at a time
+
+    Yields:
+        str: Lines of the export
+    """
+    if queryset is None:
+        queryset = Merchandise.objects.order_by('id')
+    rows = queryset.values_list(*EXPORT_FIELDS).iterator(chunk_size=chunk_size)
+
+    if file_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow(row)
+    elif file_format == 'jsonl':
+        for row in rows:
+            yield json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n'
+    else:
+        raise BulkFormatError(f"Unsupported format '{file_format}', use one of: {', '.join(FILE_FORMATS)}")
@@ -0,0 +1,171 @@
+"""
+Read-through cache for the public merchandise catalog.
+List and detail responses are cached under keys built from the normalized query
+parameters and a catalog version. Any write to merchandise (saves, deletes, stock
+reservations and releases) bumps the version, so stale entries are never read again
+and simply age out. Stock-only writes also record which items they touched under the
+new version, so catalog indexes can patch those items instead of being rebuilt.
+Cached responses carry an ETag so clients can revalidate with If-None-Match and get
+a 304 without a response body.
+"""
+import hashlib
+import json
+import logging
+import time
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger('merchandise.catalog_cache')
+
+# Seconds cached catalog list pages and item details are kept
+MERCHANDISE_CATALOG_LIST_TTL = getattr(settings, 'MERCHANDISE_CATALOG_LIST_TTL', 60)
+MERCHANDISE_CATALOG_DETAIL_TTL = getattr(settings, 'MERCHANDISE_CATALOG_DETAIL_TTL', 300)
+CATALOG_VERSION_KEY = 'merchandise:catalog:version'
+# Seconds the ids of the items changed by a stock-only write are kept
+CATALOG_STOCK_CHANGE_TTL = 600
+
+
+def get_catalog_version():
+    """
+    Return the current catalog version
+
+    A missing version (first use, or evicted) restarts from the current time in
+    milliseconds rather than 1, so it cannot collide with a version a worker
+    built its catalog index against before the eviction.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cached catalog response
+
+    Inside a transaction the bump waits for the commit, so a concurrent request
+    cannot re-cache the data as it was before the write.
+    """
+    transaction.on_commit(next_catalog_version)
+
+
+def next_catalog_version():
+    """Move the catalog version on by one and return the new version"""
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # Version not cached yet (or evicted); any new value invalidates old keys
+        version = get_catalog_version() + 1
+        cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+        return version
+
+
+def stock_change_key(version):
+    return f"merchandise:catalog:stock:{version}"
+
+
+def bump_catalog_stock(merchandise_ids):
+    """
+    Invalidate every cached catalog response after a change to the stock of some items
+
+    Like bump_catalog_version, but the ids are recorded under the new version so a
+    catalog index can refresh just their stock (see get_stock_changes).
+    """
+    merchandise_ids = sorted(set(merchandise_ids))
+    if not merchandise_ids:
+        return
+
+    def bump():
+        cache.set(stock_change_key(next_catalog_version()), merchandise_ids, timeout=CATALOG_STOCK_CHANGE_TTL)
+
+    transaction.on_commit(bump)
+
+
+def get_stock_changes(first_version, last_version):
+    """
+    Ids of the items whose stock changed between two catalog versions
+
+    Returns:
+        set: Merchandise ids, or None if any version in the inclusive range was not a
+            stock-only change (or its record has expired)
+    """
+    keys = [stock_change_key(version) for version in range(first_version, last_version + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys):
+        return None
+    return set().union(*changes.values())
+
+
+def catalog_cache_key(request, view_name, pk=None):
+    """
+    Build the cache key for a catalog request
+
+    Empty query parameters are dropped and the rest sorted, so equivalent URLs
+    share an entry. The host is included because paginated responses contain
+    absolute next/previous links.
+    """
+    params = sorted(
+        (key, value)
+        for key, values in request.query_params.lists()
+        for value in values
+        if value != ''
+    )
+    raw = f"{request.get_host()}|{view_name}|{pk}|{urlencode(params)}"
+    digest = hashlib.sha1(raw.encode()).hexdigest()
+    return f"merchandise:catalog:{get_catalog_version()}:{digest}"
+
+
+def make_etag(data):
+    """Strong ETag for a response body"""
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return '"%s"' % hashlib.md5(body.encode()).hexdigest()
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def cached_catalog_response(request, view_name, render, pk=None, timeout=MERCHANDISE_CATALOG_LIST_TTL):
+    """
+    Serve a catalog response from the cache, rendering and storing it on a miss
+
+    Args:
+        request: The DRF request
+        view_name (str): Name of the view, part of the cache key
+        render: Callable returning the uncached Response
+        pk: Primary key of the item for detail views
+        timeout: Seconds to keep the response
+
+    Returns:
+        Response: The cached or freshly rendered response, or a 304 if the client's
+            If-None-Match matches its ETag. Non-200 responses are not cached.
+    """
+    key = catalog_cache_key(request, view_name, pk)
+    cached = cache.get(key)
+
+    if cached is None:
+        response = render()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        cached = {'data': response.data, 'etag': make_etag(response.data)}
+        cache.set(key, cached, timeout=timeout)
+        cache_status = 'MISS'
+    else:
+        cache_status = 'HIT'
+
+    if etag_matches(request, cached['etag']):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(cached['data'])
+    response['ETag'] = cached['etag']
+    response['X-Cache'] = cache_status
+    return response
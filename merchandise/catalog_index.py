@@ -0,0 +1,364 @@
+"""
+In-process index of the merchandise catalog for filtered listings and facet counts.
+
+Items are kept sorted by price, so a price range is a contiguous run of positions, and
+every filterable flag (category, in stock, featured) is a bitset over those positions
+held in a Python int. A filter is then a handful of big-int ANDs, and facet counts are
+popcounts, with no database round trip.
+
+Each worker keeps its own index. Saves and deletes made by this worker update it in
+place; any other write to the catalog (another worker, or a bulk import) bumps the
+shared catalog version from catalog_cache, and the index is rebuilt from the database on
+its next use. Stock-only writes (orders, released holds, bulk stock updates) record the
+items they changed, so the index just re-reads the stock of those items and flips their
+in-stock bits instead of being rebuilt.
+
+Versions only reach other workers through a shared cache backend. With a per-process
+cache (such as LocMemCache) a worker never sees another worker's writes, so every
+snapshot is also rebuilt once it is MERCHANDISE_CATALOG_INDEX_MAX_AGE seconds old.
+"""
+import bisect
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import transaction
+
+from .catalog_cache import get_catalog_version, get_stock_changes
+from .models import Merchandise
+
+logger = logging.getLogger('merchandise.catalog_index')
+
+ORDERING_FIELDS = ('name', 'price', 'created_at')
+DEFAULT_ORDERING = '-created_at'
+# Most catalog versions a snapshot catches up on by patching stock before it is rebuilt
+MAX_STOCK_CATCH_UP = 100
+# Seconds a snapshot is used before it is rebuilt from the database, whatever the version
+MERCHANDISE_CATALOG_INDEX_MAX_AGE = getattr(settings, 'MERCHANDISE_CATALOG_INDEX_MAX_AGE', 5)
+
+
+def parse_catalog_filters(query_params):
+    """
+    Read the catalog filters from request query parameters
+
+    Returns:
+        dict: Any of category (str), in_stock (bool), featured (bool),
+            min_price (int) and max_price (int)
+    """
+    filters = {}
+
+    category = query_params.get('category', None)
+    if category:
+        filters['category'] = category
+
+    in_stock = query_params.get('in_stock', None)
+    if in_stock is not None:
+        filters['in_stock'] = in_stock.lower() == 'true'
+
+    featured = query_params.get('featured', None)
+    if featured is not None:
+        filters['featured'] = featured.lower() == 'true'
+
+    min_price = query_params.get('min_price', None)
+    if min_price and min_price.isdigit():
+        filters['min_price'] = int(min_price)
+
+    max_price = query_params.get('max_price', None)
+    if max_price and max_price.isdigit():
+        filters['max_price'] = int(max_price)
+
+    return filters
+
+
+class CatalogSnapshot:
+    """
+    Immutable view of the catalog at one point in time
+
+    Args:
+        entries (dict): Merchandise id -> entry dict with 'row' (the serialized list
+            row), 'price', 'category', 'in_stock', 'featured', 'name' and 'created_at'
+        version: Catalog version the entries correspond to
+        built_at: time.monotonic() when the entries were read from the database;
+            defaults to now
+    """
+    __slots__ = ('entries', 'version', 'built_at', 'rows', 'positions_by_id', 'prices', 'sort_keys', 'all_bits',
+                 'category_bits', 'in_stock_bits', 'featured_bits')
+
+    def __init__(self, entries, version, built_at=None):
+        self.entries = entries
+        self.version = version
+        self.built_at = time.monotonic() if built_at is None else built_at
+
+        ordered = sorted(entries.values(), key=lambda entry: (entry['price'], entry['row']['id']))
+        self.rows = [entry['row'] for entry in ordered]
+        self.positions_by_id = {entry['row']['id']: position for position, entry in enumerate(ordered)}
+        self.prices = [entry['price'] for entry in ordered]
+        self.sort_keys = {
+            field: [entry[field] for entry in ordered] for field in ORDERING_FIELDS
+        }
+        self.all_bits = (1 << len(ordered)) - 1
+        self.category_bits = {}
+        self.in_stock_bits = 0
+        self.featured_bits = 0
+        for position, entry in enumerate(ordered):
+            bit = 1 << position
+            self.category_bits[entry['category']] = self.category_bits.get(entry['category'], 0) | bit
+            if entry['in_stock']:
+                self.in_stock_bits |= bit
+            if entry['featured']:
+                self.featured_bits |= bit
+
+    def with_stock(self, stock, version):
+        """
+        Copy of the snapshot with new stock levels for some items
+
+        Stock does not move an item's position, so only its row and in-stock bit are
+        replaced and everything else is shared with this snapshot.
+
+        Args:
+            stock (dict): Merchandise id -> current stock
+            version: Catalog version the new snapshot corresponds to
+
+        Returns:
+            CatalogSnapshot: The patched snapshot, or None if an item is not indexed
+        """
+        entries = dict(self.entries)
+        rows = list(self.rows)
+        in_stock_bits = self.in_stock_bits
+        for merchandise_id, level in stock.items():
+            if merchandise_id not in entries:
+                return None
+            position = self.positions_by_id[merchandise_id]
+            row = dict(entries[merchandise_id]['row'], stock=level, in_stock=level > 0)
+            entries[merchandise_id] = dict(entries[merchandise_id], row=row, in_stock=level > 0)
+            rows[position] = row
+            if level > 0:
+                in_stock_bits |= 1 << position
+            else:
+                in_stock_bits &= ~(1 << position)
+
+        snapshot = object.__new__(CatalogSnapshot)
+        for slot in CatalogSnapshot.__slots__:
+            setattr(snapshot, slot, getattr(self, slot))
+        snapshot.entries = entries
+        snapshot.version = version
+        snapshot.rows = rows
+        snapshot.in_stock_bits = in_stock_bits
+        return snapshot
+
+    def price_bits(self, min_price=None, max_price=None):
+        """Bitset of the items priced within [min_price, max_price]"""
+        low = 0 if min_price is None else bisect.bisect_left(self.prices, min_price)
+        high = len(self.prices) if max_price is None else bisect.bisect_right(self.prices, max_price)
+        if high <= low:
+            return 0
+        return ((1 << high) - 1) ^ ((1 << low) - 1)
+
+    def match(self, filters, ignore=()):
+        """
+        Bitset of the items matching ``filters``
+
+        Args:
+            filters (dict): As returned by parse_catalog_filters
+            ignore: Filter names to leave out, for facet counts
+        """
+        bits = self.all_bits
+        if 'category' in filters and 'category' not in ignore:
+            bits &= self.category_bits.get(filters['category'], 0)
+        if 'in_stock' in filters and 'in_stock' not in ignore:
+            bits &= self.in_stock_bits if filters['in_stock'] else ~self.in_stock_bits
+        if 'featured' in filters and 'featured' not in ignore:
+            bits &= self.featured_bits if filters['featured'] else ~self.featured_bits
+        if 'price' not in ignore and ('min_price' in filters or 'max_price' in filters):
+            bits &= self.price_bits(filters.get('min_price'), filters.get('max_price'))
+        return bits & self.all_bits
+
+    def positions(self, bits):
+        """Positions of the set bits, lowest first"""
+        positions = []
+        while bits:
+            low_bit = bits & -bits
+            positions.append(low_bit.bit_length() - 1)
+            bits ^= low_bit
+        return positions
+
+    def listing(self, filters, ordering=DEFAULT_ORDERING):
+        """
+        Serialized rows matching ``filters``, sorted like OrderingFilter would
+
+        Only the first ordering field is used; unknown fields fall back to the
+        default ordering.
+        """
+        positions = self.positions(self.match(filters))
+
+        ordering = ordering.split(',')[0].strip()
+        field = ordering.lstrip('-')
+        if field not in ORDERING_FIELDS:
+            ordering, field = DEFAULT_ORDERING, DEFAULT_ORDERING.lstrip('-')
+        keys = self.sort_keys[field]
+        positions.sort(key=keys.__getitem__, reverse=ordering.startswith('-'))
+
+        return [self.rows[position] for position in positions]
+
+    def facets(self, filters, buckets=5):
+        """
+        Facet counts for a filtered listing
+
+        Each facet is counted with every other filter applied but its own, so a
+        client can show how many items selecting another value would give.
+        """
+        categories = {}
+        category_match = self.match(filters, ignore=('category',))
+        for category, bits in sorted(self.category_bits.items()):
+            categories[category] = (bits & category_match).bit_count()
+
+        stock_match = self.match(filters, ignore=('in_stock',))
+        featured_match = self.match(filters, ignore=('featured',))
+        price_match = self.match(filters, ignore=('price',))
+
+        return {
+            'count': self.match(filters).bit_count(),
+            'categories': categories,
+            'in_stock': {
+                'true': (stock_match & self.in_stock_bits).bit_count(),
+                'false': (stock_match & ~self.in_stock_bits).bit_count(),
+            },
+            'featured': {
+                'true': (featured_match & self.featured_bits).bit_count(),
+                'false': (featured_match & ~self.featured_bits).bit_count(),
+            },
+            'price_histogram': self.price_histogram(price_match, buckets),
+        }
+
+    def price_histogram(self, bits, buckets):
+        """Counts of the items in ``bits`` over ``buckets`` equal price ranges of the whole catalog"""
+        if not self.prices:
+            return []
+
+        low, high = self.prices[0], self.prices[-1]
+        width = max(1, -(-(high - low + 1) // buckets))
+        histogram = []
+        for start in range(low, high + 1, width):
+            end = min(start + width - 1, high)
+            histogram.append({
+                'min_price': start,
+                'max_price': end,
+                'count': (bits & self.price_bits(start, end)).bit_count(),
+            })
+        return histogram
+
+
+def make_entry(merchandise, row):
+    return {
+        'row': row,
+        'price': merchandise.price,
+        'category': merchandise.category,
+        'in_stock': merchandise.stock > 0,
+        'featured': merchandise.featured,
+        'name': merchandise.name,
+        'created_at': merchandise.created_at,
+    }
+
+
+class CatalogIndex:
+    """Holds the current CatalogSnapshot for this worker and keeps it up to date"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def snapshot(self):
+        """
+        Return an up to date snapshot, patching or rebuilding it if the catalog version
+        moved, and rebuilding it once it is older than MERCHANDISE_CATALOG_INDEX_MAX_AGE
+        """
+        version = get_catalog_version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version and not self._expired(snapshot):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and self._expired(snapshot):
+                snapshot = None
+            if snapshot is None or snapshot.version != version:
+                self._snapshot = self._catch_up(snapshot, version) or self._build(version)
+            return self._snapshot
+
+    def upsert(self, merchandise):
+        """Add or replace one item after it was saved by this worker"""
+        from .serializers import MerchandiseListSerializer
+
+        row = MerchandiseListSerializer(merchandise).data
+        self._apply(lambda entries: entries.__setitem__(merchandise.id, make_entry(merchandise, row)))
+
+    def remove(self, merchandise_id):
+        """Drop one item after it was deleted by this worker"""
+        self._apply(lambda entries: entries.pop(merchandise_id, None))
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+    def _apply(self, change):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+
+            entries = dict(snapshot.entries)
+            change(entries)
+            # Our own write bumps the version by exactly one; a bigger jump means
+            # someone else wrote too, so leave the snapshot to be rebuilt
+            version = get_catalog_version()
+            if version == snapshot.version + 1:
+                self._snapshot = CatalogSnapshot(entries, version, built_at=snapshot.built_at)
+            else:
+                self._snapshot = None
+
+    def _expired(self, snapshot):
+        return time.monotonic() - snapshot.built_at >= MERCHANDISE_CATALOG_INDEX_MAX_AGE
+
+    def _catch_up(self, snapshot, version):
+        """
+        Bring a snapshot to ``version`` by re-reading the stock of the items changed since
+
+        Returns:
+            CatalogSnapshot: The patched snapshot, or None if any of the versions in
+                between was not a stock-only change
+        """
+        if snapshot is None or not snapshot.version < version <= snapshot.version + MAX_STOCK_CATCH_UP:
+            return None
+
+        changed = get_stock_changes(snapshot.version + 1, version)
+        if changed is None:
+            return None
+
+        stock = dict(Merchandise.objects.filter(id__in=changed).values_list('id', 'stock'))
+        if len(stock) != len(changed):
+            return None
+        return snapshot.with_stock(stock, version)
+
+    def _build(self, version):
+        from .serializers import MerchandiseListSerializer
+
+        queryset = Merchandise.objects.select_related('created_by')
+        entries = {
+            merchandise.id: make_entry(merchandise, row)
+            for merchandise, row in zip(queryset, MerchandiseListSerializer(queryset, many=True).data)
+        }
+        logger.info(f"Built merchandise catalog index with {len(entries)} items at version {version}")
+        return CatalogSnapshot(entries, version)
+
+
+catalog_index = CatalogIndex()
+
+
+def index_saved_merchandise(merchandise):
+    """Update this worker's index once the transaction saving ``merchandise`` commits"""
+    transaction.on_commit(lambda: catalog_index.upsert(merchandise))
+
+
+def index_deleted_merchandise(merchandise_id):
+    """Update this worker's index once the transaction deleting an item commits"""
+    transaction.on_commit(lambda: catalog_index.remove(merchandise_id))
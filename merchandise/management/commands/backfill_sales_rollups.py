@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from merchandise.analytics import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily sales and payment rollups used by the merchandise analytics endpoint'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--start-date', help='First day to rebuild (YYYY-MM-DD); all history by default')
+        parser.add_argument('--end-date', help='Last day to rebuild (YYYY-MM-DD); up to today by default')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Rollup rows inserted per query')
+    
+    def handle(self, *args, **options):
+        dates = {}
+        for option in ('start_date', 'end_date'):
+            value = options[option]
+            if value:
+                try:
+                    dates[option] = parse_date(value)
+                except ValueError:
+                    dates[option] = None
+                if dates[option] is None:
+                    raise CommandError(f"--{option.replace('_', '-')} must be a date in the format YYYY-MM-DD")
+        
+        item_rows, payment_rows = rebuild_rollups(
+            start_date=dates.get('start_date'),
+            end_date=dates.get('end_date'),
+            batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {item_rows} daily item sales rows and {payment_rows} daily payment total rows"
+        ))
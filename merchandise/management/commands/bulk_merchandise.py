@@ -0,0 +1,82 @@
+import json
+import sys
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from merchandise.bulk import (
+    FILE_FORMATS, BulkFormatError, apply_stock_updates, export_merchandise, import_merchandise, parse_rows
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Offline bulk merchandise loads: import items or stock levels from a CSV/JSONL file, '
+        'or export the catalog. Imports are validated in full and applied in one transaction.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['import', 'stock', 'export'],
+                            help='import items, set stock from id/stock rows, or export the catalog')
+        parser.add_argument('path', nargs='?', default='-',
+                            help='File to read or write, - for stdin/stdout')
+        parser.add_argument('--format', dest='file_format', choices=FILE_FORMATS,
+                            help='File format, taken from the file extension by default')
+        parser.add_argument('--created-by',
+                            help='Email of the user recorded as the creator of imported items')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Rows per INSERT/UPDATE (or per database fetch when exporting)')
+    
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['file_format'] or (path.rsplit('.', 1)[-1].lower() if path != '-' else 'csv')
+        if file_format not in FILE_FORMATS:
+            raise CommandError(f"Cannot tell the format of '{path}', pass --format")
+        
+        if options['action'] == 'export':
+            self.export(path, file_format, options['chunk_size'])
+            return
+        
+        created_by = None
+        if options['action'] == 'import':
+            if not options['created_by']:
+                raise CommandError('--created-by is required for imports')
+            try:
+                created_by = get_user_model().objects.get(email=options['created_by'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user with email '{options['created_by']}'")
+        
+        try:
+            if path == '-':
+                rows = parse_rows(sys.stdin.buffer, file_format)
+            else:
+                with open(path, 'rb') as stream:
+                    rows = parse_rows(stream, file_format)
+        except BulkFormatError as e:
+            raise CommandError(f"Could not read {path}: {e}")
+        
+        if options['action'] == 'import':
+            applied, results = import_merchandise(rows, created_by, chunk_size=options['chunk_size'])
+        else:
+            applied, results = apply_stock_updates(rows, chunk_size=options['chunk_size'])
+        
+        errors = [result for result in results if result['status'] == 'error']
+        for error in errors:
+            self.stderr.write(f"Row {error['row']}: {json.dumps(error['errors'])}")
+        
+        if not applied:
+            raise CommandError(f"{len(errors)} of {len(rows)} rows are invalid, nothing was applied")
+        
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        self.stdout.write(self.style.SUCCESS(f"Applied {len(rows)} rows: {counts}"))
+    
+    def export(self, path, file_format, chunk_size):
+        lines = export_merchandise(file_format, chunk_size=chunk_size)
+        if path == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        
+        with open(path, 'w', encoding='utf-8', newline='') as stream:
+            stream.writelines(lines)
+        self.stderr.write(self.style.SUCCESS(f"Exported merchandise to {path}"))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from merchandise.stock import release_expired_holds
+
+
+class Command(BaseCommand):
+    help = 'Return the stock held by unpaid orders whose holds have expired, and cancel those orders'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of holds released per database transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many holds would be released')
+    
+    def handle(self, *args, **options):
+        count = release_expired_holds(
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run']
+        )
+        
+        if options['dry_run']:
+            self.stdout.write(f"{count} expired stock holds would be released")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Released {count} expired stock holds"))
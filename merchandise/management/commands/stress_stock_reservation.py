@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+
+from merchandise.models import Merchandise, Order, OrderItem
+from merchandise.stock import InsufficientStockError, create_order
+
+STRESS_EMAIL = 'stock-stress-test@jkuelc.local'
+
+
+def legacy_create_order(user, merchandise_id, quantity):
+    """The old read-check-save order path, kept here as the baseline"""
+    with transaction.atomic():
+        merchandise = Merchandise.objects.get(id=merchandise_id)
+        if quantity > merchandise.stock:
+            raise InsufficientStockError(merchandise, quantity)
+        order = Order.objects.create(user=user, total_amount=merchandise.price * quantity)
+        OrderItem.objects.create(order=order, merchandise=merchandise, quantity=quantity,
+                                 unit_price=merchandise.price)
+        merchandise.stock -= quantity
+        merchandise.save()
+    return order
+
+
+class Command(BaseCommand):
+    help = (
+        'Stress order creation with many threads buying the last units of one hot item, '
+        'comparing the old read-check-save path with the stock reservation engine. '
+        'Reports accepted orders, oversold units and orders/sec for each.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', type=int, default=50,
+                            help='Units of the hot item available at the start of each run')
+        parser.add_argument('--buyers', type=int, default=200,
+                            help='Number of orders attempted per run')
+        parser.add_argument('--threads', type=int, default=16,
+                            help='Number of concurrent buyers')
+        parser.add_argument('--quantity', type=int, default=1,
+                            help='Units bought by each order')
+    
+    def handle(self, *args, **options):
+        user, _ = get_user_model().objects.get_or_create(
+            email=STRESS_EMAIL, defaults={'name': 'Stock Stress Test'}
+        )
+        self.stdout.write(
+            f"{options['buyers']} orders of {options['quantity']} against {options['stock']} units, "
+            f"{options['threads']} threads"
+        )
+        self.stdout.write(
+            f"{'mode':<8} {'accepted':>9} {'rejected':>9} {'errors':>7} {'oversold':>9} {'orders/s':>9}"
+        )
+        
+        try:
+            for mode in ('legacy', 'reserve'):
+                self.run_mode(mode, user, options)
+        finally:
+            # Cascades to the stress test items, orders and order items
+            user.delete()
+    
+    def run_mode(self, mode, user, options):
+        merchandise = Merchandise.objects.create(
+            name=f'Stress test item ({mode})', description='Stress test item', price=100,
+            image='https://example.com/stress.png', category='accessories',
+            stock=options['stock'], created_by=user
+        )
+        quantity = options['quantity']
+        start = threading.Barrier(options['threads'])
+        
+        def buy(_):
+            try:
+                start.wait(timeout=0.5)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                if mode == 'legacy':
+                    legacy_create_order(user, merchandise.id, quantity)
+                else:
+                    create_order([{'merchandise': merchandise, 'quantity': quantity}], user=user)
+                return 'accepted'
+            except InsufficientStockError:
+                return 'rejected'
+            except OperationalError:
+                # e.g. SQLite "database is locked" under write contention
+                return 'errors'
+            finally:
+                connection.close()
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            outcomes = list(executor.map(buy, range(options['buyers'])))
+        elapsed = time.perf_counter() - started
+        
+        accepted = outcomes.count('accepted')
+        sold = sum(
+            OrderItem.objects.filter(merchandise=merchandise).values_list('quantity', flat=True)
+        )
+        oversold = max(0, sold - options['stock'])
+        style = self.style.ERROR if oversold else self.style.SUCCESS
+        self.stdout.write(style(
+            f"{mode:<8} {accepted:>9} {outcomes.count('rejected'):>9} {outcomes.count('errors'):>7} "
+            f"{oversold:>9} {accepted / elapsed:>9.1f}"
+        ))
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.6 on 2026-10-16 22:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merchandise', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('HELD', 'Held'), ('SOLD', 'Sold'), ('RELEASED', 'Released')], default='HELD', max_length=20)),
+                ('expires_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('merchandise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='merchandise.merchandise')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_holds', to='merchandise.order')),
+            ],
+            options={
+                'verbose_name': 'Stock Hold',
+                'verbose_name_plural': 'Stock Holds',
+                'ordering': ['expires_at'],
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='merchandise_status_d045fb_idx')],
+            },
+        ),
+    ]
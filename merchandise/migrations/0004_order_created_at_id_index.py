@@ -0,0 +1,17 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merchandise', '0003_stockhold'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'id'], name='merchandise_created_be64d5_idx'),
+        ),
+    ]
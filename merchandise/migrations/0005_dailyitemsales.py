@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-17 00:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merchandise', '0004_order_created_at_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyItemSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('units', models.PositiveIntegerField(default=0)),
+                ('revenue', models.PositiveIntegerField(default=0)),
+                ('orders', models.PositiveIntegerField(default=0)),
+                ('merchandise', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='merchandise.merchandise')),
+            ],
+            options={
+                'verbose_name': 'Daily Item Sales',
+                'verbose_name_plural': 'Daily Item Sales',
+                'ordering': ['-date'],
+                'constraints': [models.UniqueConstraint(fields=('date', 'merchandise'), name='unique_daily_item_sales')],
+            },
+        ),
+    ]
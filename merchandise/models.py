@@ -57,6 +57,10 @@ class Order(models.Model):
         verbose_name = 'Order'
         verbose_name_plural = 'Orders'
         ordering = ['-created_at']
+        indexes = [
+            # Keyset pagination of order lists
+            models.Index(fields=['created_at', 'id']),
+        ]
     
     def __str__(self):
         return f"Order #{self.id} - {self.user.name}"
@@ -80,3 +84,58 @@ class OrderItem(models.Model):
     def subtotal(self):
         return self.quantity * self.unit_price
 
+
+
+class StockHold(models.Model):
+    """
+    Stock taken by an unpaid order. A hold is converted to a sale when the order is
+    paid, or released back to the item's stock once it expires.
+    """
+    STATUS_CHOICES = (
+        ('HELD', 'Held'),
+        ('SOLD', 'Sold'),
+        ('RELEASED', 'Released'),
+    )
+    
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='stock_holds')
+    merchandise = models.ForeignKey(Merchandise, on_delete=models.CASCADE, related_name='stock_holds')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='HELD')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = 'Stock Hold'
+        verbose_name_plural = 'Stock Holds'
+        ordering = ['expires_at']
+        indexes = [
+            # The release sweep: HELD holds past their expiry, oldest first
+            models.Index(fields=['status', 'expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.merchandise.name} held for order #{self.order_id}"
+
+
+class DailyItemSales(models.Model):
+    """
+    Units and revenue of one item sold on one day, counted when the order is paid.
+    Maintained by merchandise.analytics; rebuild with the backfill_sales_rollups command.
+    """
+    date = models.DateField()
+    merchandise = models.ForeignKey(Merchandise, on_delete=models.CASCADE, related_name='daily_sales')
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.PositiveIntegerField(default=0)  # KES
+    orders = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        verbose_name = 'Daily Item Sales'
+        verbose_name_plural = 'Daily Item Sales'
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'merchandise'], name='unique_daily_item_sales'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} - {self.merchandise.name}: {self.units} units"
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Merchandise, Order, OrderItem
+from .stock import InsufficientStockError, change_order_status, create_order
 
 User = get_user_model()
 
@@ -65,6 +66,13 @@ class MerchandiseUpdateSerializer(serializers.ModelSerializer):
                   'stock', 'featured', 'rating']
 
 
+class StockUpdateRowSerializer(serializers.Serializer):
+    """Serializer for one row of a bulk stock update"""
+    
+    id = serializers.IntegerField()
+    stock = serializers.IntegerField(min_value=0)
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     """Serializer for order items"""
     
@@ -114,6 +122,9 @@ class OrderListSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
     
     def get_items_count(self, obj):
+        # Annotated by OrderViewSet; fall back to a query for plain instances
+        if hasattr(obj, 'items_count'):
+            return obj.items_count
         return obj.items.count()
 
 
@@ -157,35 +168,14 @@ class OrderCreateSerializer(serializers.ModelSerializer):
     
     def create(self, validated_data):
         items_data = validated_data.pop('items')
-        total_amount = 0
-        
-        # Calculate the total amount
-        for item_data in items_data:
-            merchandise = item_data['merchandise']
-            quantity = item_data['quantity']
-            total_amount += merchandise.price * quantity
         
-        # Create the order
-        validated_data['total_amount'] = total_amount
-        order = Order.objects.create(**validated_data)
-        
-        # Create the order items
-        for item_data in items_data:
-            merchandise = item_data['merchandise']
-            quantity = item_data['quantity']
-            
-            OrderItem.objects.create(
-                order=order,
-                merchandise=merchandise,
-                quantity=quantity,
-                unit_price=merchandise.price
+        # Reserve stock with conditional updates so concurrent checkouts cannot oversell
+        try:
+            return create_order(items_data, **validated_data)
+        except InsufficientStockError as e:
+            raise serializers.ValidationError(
+                {"items": [f"Not enough stock for '{e.merchandise.name}'."]}
             )
-            
-            # Update the merchandise stock
-            merchandise.stock -= quantity
-            merchandise.save()
-        
-        return order
 
 
 class OrderStatusUpdateSerializer(serializers.ModelSerializer):
@@ -194,3 +184,12 @@ class OrderStatusUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = ['status']
+    
+    def update(self, instance, validated_data):
+        # Convert or release the order's stock holds along with its status
+        try:
+            return change_order_status(instance, validated_data.get('status', instance.status))
+        except InsufficientStockError as e:
+            raise serializers.ValidationError(
+                {"status": [f"Not enough stock for '{e.merchandise.name}' to reopen this order."]}
+            )
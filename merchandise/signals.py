@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog_cache import bump_catalog_version
+from .catalog_index import index_deleted_merchandise, index_saved_merchandise
+from .models import Merchandise
+
+
+@receiver(post_save, sender=Merchandise)
+def merchandise_saved(sender, instance, **kwargs):
+    # The version bump is registered first, so the index sees it when it updates
+    bump_catalog_version()
+    index_saved_merchandise(instance)
+
+
+@receiver(post_delete, sender=Merchandise)
+def merchandise_deleted(sender, instance, **kwargs):
+    bump_catalog_version()
+    index_deleted_merchandise(instance.id)
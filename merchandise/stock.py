@@ -0,0 +1,304 @@
+"""
+Stock reservation for order creation.
+Stock is decremented with conditional UPDATEs (``stock = stock - n WHERE stock >= n``) so
+concurrent checkouts cannot oversell, and rows are updated in primary key order so two
+orders touching the same items always lock them in the same order and cannot deadlock.
+
+The stock taken by an order is recorded as StockHold rows that expire after
+MERCHANDISE_STOCK_HOLD_TTL seconds. Paying for the order converts its holds to sales;
+release_expired_holds returns the stock of orders that were never paid. Every other
+status change goes through change_order_status, which keeps the holds in step.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .catalog_cache import bump_catalog_stock
+from .models import Merchandise, Order, OrderItem, StockHold
+
+logger = logging.getLogger('merchandise.stock')
+
+# Seconds an unpaid order keeps its stock
+MERCHANDISE_STOCK_HOLD_TTL = getattr(settings, 'MERCHANDISE_STOCK_HOLD_TTL', 15 * 60)
+
+# Order statuses whose stock has been sold
+SOLD_ORDER_STATUSES = ('PAID', 'SHIPPED', 'DELIVERED')
+
+
+class InsufficientStockError(Exception):
+    """
+    Raised when an item does not have enough stock left for an order
+
+    Attributes:
+        merchandise: The Merchandise item that ran out
+        requested: Quantity the order asked for
+    """
+
+    def __init__(self, merchandise, requested):
+        super().__init__(f"Not enough stock for '{merchandise.name}'.")
+        self.merchandise = merchandise
+        self.requested = requested
+
+
+def merge_quantities(items):
+    """
+    Total the quantity ordered per item
+
+    Args:
+        items (list): ``{'merchandise': Merchandise, 'quantity': int}`` dicts, as validated
+            by OrderCreateItemSerializer. An item may appear more than once.
+
+    Returns:
+        dict: Merchandise id -> (Merchandise, quantity), sorted by id
+    """
+    quantities = {}
+    for item in items:
+        merchandise = item['merchandise']
+        _, quantity = quantities.get(merchandise.id, (merchandise, 0))
+        quantities[merchandise.id] = (merchandise, quantity + item['quantity'])
+    return dict(sorted(quantities.items()))
+
+
+def reserve_stock(items):
+    """
+    Take stock for a set of order lines, all or nothing
+
+    Must run inside a transaction so a later shortfall rolls back the items
+    already decremented.
+
+    Args:
+        items (list): Order lines as accepted by merge_quantities
+
+    Raises:
+        InsufficientStockError: If any item has less stock than requested
+    """
+    quantities = merge_quantities(items)
+    for merchandise_id, (merchandise, quantity) in quantities.items():
+        updated = Merchandise.objects.filter(id=merchandise_id, stock__gte=quantity).update(
+            stock=F('stock') - quantity
+        )
+        if not updated:
+            raise InsufficientStockError(merchandise, quantity)
+
+    bump_catalog_stock(quantities)
+
+
+@transaction.atomic
+def create_order(items, **order_fields):
+    """
+    Create an order, reserve its stock and add its items
+
+    Each line is charged at the price of the item when it was validated.
+
+    Args:
+        items (list): Order lines as accepted by merge_quantities
+        **order_fields: Fields for the Order, such as user and shipping_address
+
+    Returns:
+        Order: The new order
+
+    Raises:
+        InsufficientStockError: If any item has less stock than requested. Nothing is saved.
+    """
+    quantities = merge_quantities(items)
+    reserve_stock(items)
+
+    order = Order.objects.create(
+        total_amount=sum(item['merchandise'].price * item['quantity'] for item in items),
+        **order_fields
+    )
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            merchandise=item['merchandise'],
+            quantity=item['quantity'],
+            unit_price=item['merchandise'].price
+        )
+        for item in items
+    ])
+    expires_at = timezone.now() + timedelta(seconds=MERCHANDISE_STOCK_HOLD_TTL)
+    StockHold.objects.bulk_create([
+        StockHold(order=order, merchandise_id=merchandise_id, quantity=quantity, expires_at=expires_at)
+        for merchandise_id, (_, quantity) in quantities.items()
+    ])
+    return order
+
+
+def extend_stock_holds(order):
+    """
+    Keep an order's stock held for another MERCHANDISE_STOCK_HOLD_TTL seconds
+
+    Called when a payment is started, so the stock is not released while the
+    customer is answering the STK prompt.
+
+    Returns:
+        int: Number of holds extended
+    """
+    return StockHold.objects.filter(order=order, status='HELD').update(
+        expires_at=timezone.now() + timedelta(seconds=MERCHANDISE_STOCK_HOLD_TTL),
+        updated_at=timezone.now()
+    )
+
+
+def convert_holds_to_sales(order):
+    """
+    Mark the stock held by a paid order as sold
+
+    Returns:
+        int: Number of holds converted
+    """
+    return StockHold.objects.filter(order=order, status='HELD').update(
+        status='SOLD',
+        updated_at=timezone.now()
+    )
+
+
+def release_holds(hold_ids, statuses=('HELD',)):
+    """
+    Release holds and return their stock
+
+    Must run inside a transaction. Only the holds this call flips to RELEASED give
+    their stock back, so a hold released concurrently (or sold in the meantime,
+    unless SOLD is one of ``statuses``) is never returned twice.
+
+    Args:
+        hold_ids (list): IDs of the holds to release
+        statuses: Hold statuses that may be released; SOLD too for a sold order
+            that is cancelled
+
+    Returns:
+        list: (order_id, merchandise_id, quantity) of the holds released
+    """
+    now = timezone.now()
+    StockHold.objects.filter(id__in=hold_ids, status__in=statuses).update(status='RELEASED', updated_at=now)
+    # The flipped rows are the ones carrying this call's timestamp
+    released = list(
+        StockHold.objects.filter(id__in=hold_ids, status='RELEASED', updated_at=now)
+        .values_list('order_id', 'merchandise_id', 'quantity')
+    )
+
+    quantities = {}
+    for _, merchandise_id, quantity in released:
+        quantities[merchandise_id] = quantities.get(merchandise_id, 0) + quantity
+    for merchandise_id, quantity in sorted(quantities.items()):
+        Merchandise.objects.filter(id=merchandise_id).update(stock=F('stock') + quantity)
+
+    bump_catalog_stock(quantities)
+    return released
+
+
+@transaction.atomic
+def reinstate_released_holds(order, status='SOLD'):
+    """
+    Take the stock of a cancelled order's released holds again
+
+    Args:
+        order: The Order
+        status: New status of the holds, SOLD for a paid order or HELD for one
+            that is pending payment again
+
+    Raises:
+        InsufficientStockError: If an item no longer has enough stock. Nothing is changed.
+    """
+    holds = list(
+        StockHold.objects.select_for_update(of=('self',)).select_related('merchandise')
+        .filter(order=order, status='RELEASED').order_by('merchandise_id', 'id')
+    )
+    if not holds:
+        return
+
+    reserve_stock([{'merchandise': hold.merchandise, 'quantity': hold.quantity} for hold in holds])
+    fields = {'status': status, 'updated_at': timezone.now()}
+    if status == 'HELD':
+        fields['expires_at'] = timezone.now() + timedelta(seconds=MERCHANDISE_STOCK_HOLD_TTL)
+    StockHold.objects.filter(id__in=[hold.id for hold in holds]).update(**fields)
+
+
+@transaction.atomic
+def change_order_status(order, status):
+    """
+    Move an order to a new status and keep its stock holds in step
+
+    Paid, shipped and delivered orders have their holds converted to sales, and
+    cancelled orders have their held or sold stock returned. An order leaving CANCELLED
+    takes its stock again first, so a late payment cannot sell stock that was
+    already given back.
+
+    Args:
+        order: The Order; its status is updated in place
+        status: The new status
+
+    Raises:
+        InsufficientStockError: If a cancelled order's stock is no longer available.
+            The order is left unchanged.
+    """
+    previous = Order.objects.select_for_update().values_list('status', flat=True).get(pk=order.pk)
+    if status == previous:
+        order.status = status
+        return order
+
+    if previous == 'CANCELLED':
+        reinstate_released_holds(order, status='HELD' if status == 'PENDING' else 'SOLD')
+
+    if status in SOLD_ORDER_STATUSES:
+        convert_holds_to_sales(order)
+    elif status == 'CANCELLED':
+        statuses = ('HELD', 'SOLD') if previous in SOLD_ORDER_STATUSES else ('HELD',)
+        release_holds(
+            list(StockHold.objects.filter(order=order, status__in=statuses).values_list('id', flat=True)),
+            statuses=statuses
+        )
+
+    order.status = status
+    order.save(update_fields=['status', 'updated_at'])
+    return order
+
+
+def release_expired_holds(batch_size=500, dry_run=False):
+    """
+    Return the stock of expired holds and cancel their unpaid orders.
+    This should be run as a scheduled task (see the release_stock_holds management command).
+
+    Only holds of orders still PENDING are released. Expired holds are processed in
+    chunks of ``batch_size``: each chunk is released with one UPDATE on holds, one
+    ``stock = stock + n`` UPDATE per item (in primary key order, like reserve_stock)
+    and one UPDATE cancelling the orders, inside its own database transaction.
+
+    Args:
+        batch_size: Number of holds released per chunk
+        dry_run: Only count the holds that would be released
+
+    Returns:
+        int: Number of holds released (or that would be released)
+    """
+    expired = StockHold.objects.filter(status='HELD', expires_at__lt=timezone.now(), order__status='PENDING')
+
+    if dry_run:
+        count = expired.count()
+        logger.info(f"Dry run: {count} expired stock holds would be released")
+        return count
+
+    count = 0
+    while True:
+        with transaction.atomic():
+            hold_ids = list(
+                expired.select_for_update()
+                .order_by('expires_at')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not hold_ids:
+                break
+
+            released = release_holds(hold_ids)
+            count += len(released)
+
+            Order.objects.filter(id__in={order_id for order_id, _, _ in released}, status='PENDING').update(
+                status='CANCELLED',
+                updated_at=timezone.now()
+            )
+
+    logger.info(f"Released {count} expired stock holds")
+    return count
@@ -1,3 +1,649 @@
-from django.test import TestCase
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from jkuelc_backend.pagination import CreatedAtCursorPagination
+from payment.models import MpesaTransaction, Payment
+from payment.utils import update_transaction_status
+from payment.models import DailyPaymentTotal
+from .analytics import rebuild_rollups
+from .bulk import import_merchandise
+from .catalog_index import catalog_index
+from .models import DailyItemSales, Merchandise, Order, OrderItem, StockHold
+from .serializers import MerchandiseUpdateSerializer
+from .stock import InsufficientStockError, create_order, release_expired_holds
+
+User = get_user_model()
+
+
+def create_merchandise(user, stock, name='Hoodie', price=1500):
+    return Merchandise.objects.create(
+        name=name, description=name, price=price, image='https://example.com/item.png',
+        category='clothing', stock=stock, created_by=user
+    )
+
+
+class PayWithMpesaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, total_amount=500)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('order-pay-with-mpesa', args=[self.order.id])
+        self.stk_client = mock.Mock()
+        self.stk_client.initiate_stk_push.return_value = {
+            'MerchantRequestID': 'mr-1', 'CheckoutRequestID': 'ws_CO_1', 'ResponseCode': '0'
+        }
+
+    def test_initiates_payment_in_process(self):
+        with mock.patch('payment.daraja.get_client', return_value=self.stk_client), \
+                mock.patch('requests.post') as self_http_post:
+            response = self.client.post(self.url, {'phone_number': '0700000000'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['checkout_request_id'], 'ws_CO_1')
+        self_http_post.assert_not_called()
+        self.assertEqual(self.stk_client.initiate_stk_push.call_args.kwargs['phone_number'], '254700000000')
+        transaction = MpesaTransaction.objects.select_related('payment').get(checkout_request_id='ws_CO_1')
+        self.assertEqual(transaction.payment.order_id, self.order.id)
+
+    def test_failed_stk_push_marks_payment_failed(self):
+        self.stk_client.initiate_stk_push.return_value = {'error': 'Daraja unavailable'}
+
+        with mock.patch('payment.daraja.get_client', return_value=self.stk_client):
+            response = self.client.post(self.url, {'phone_number': '254700000000'}, format='json')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data['details'], 'Daraja unavailable')
+        transaction = MpesaTransaction.objects.select_related('payment').get(payment__order=self.order)
+        self.assertEqual(transaction.status, 'FAILED')
+        self.assertEqual(transaction.payment.status, 'FAILED')
+
+    def test_rejects_invalid_phone_number(self):
+        response = self.client.post(self.url, {'phone_number': '12345'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(MpesaTransaction.objects.exists())
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.hoodie = create_merchandise(self.user, stock=5)
+        self.mug = create_merchandise(self.user, stock=1, name='Mug', price=500)
+
+    def test_create_order_reserves_stock(self):
+        order = create_order([
+            {'merchandise': self.hoodie, 'quantity': 2},
+            {'merchandise': self.mug, 'quantity': 1},
+            {'merchandise': self.hoodie, 'quantity': 1},
+        ], user=self.user)
+
+        self.assertEqual(order.total_amount, 3 * 1500 + 500)
+        self.assertEqual(order.items.count(), 3)
+        self.hoodie.refresh_from_db()
+        self.mug.refresh_from_db()
+        self.assertEqual((self.hoodie.stock, self.mug.stock), (2, 0))
+
+    def test_shortfall_rolls_back_whole_order(self):
+        with self.assertRaises(InsufficientStockError) as raised:
+            create_order([
+                {'merchandise': self.hoodie, 'quantity': 2},
+                {'merchandise': self.mug, 'quantity': 2},
+            ], user=self.user)
+
+        self.assertEqual(raised.exception.merchandise, self.mug)
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 5)
+        self.assertFalse(Order.objects.exists())
+
+    def test_create_order_endpoint_rejects_oversell(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post(reverse('order-list'), {
+            'user': self.user.id,
+            'items': [{'merchandise_id': self.mug.id, 'quantity': 1},
+                      {'merchandise_id': self.mug.id, 'quantity': 1}]
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('items', response.data)
+        self.assertFalse(Order.objects.exists())
+
+
+class ConcurrentStockReservationTests(TransactionTestCase):
+    def test_concurrent_buyers_never_oversell(self):
+        user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        hot_item = create_merchandise(user, stock=5)
+        start = threading.Barrier(8)
+
+        def buy(_):
+            try:
+                start.wait(timeout=1)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                create_order([{'merchandise': hot_item, 'quantity': 1}], user=user)
+                return True
+            except (InsufficientStockError, OperationalError):
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            accepted = sum(executor.map(buy, range(20)))
+
+        hot_item.refresh_from_db()
+        sold = OrderItem.objects.filter(merchandise=hot_item).count()
+        self.assertEqual(sold, accepted)
+        self.assertLessEqual(sold, 5)
+        self.assertEqual(hot_item.stock, 5 - sold)
+
+
+class StockHoldTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.hoodie = create_merchandise(self.user, stock=5)
+
+    def expire_holds(self, order):
+        StockHold.objects.filter(order=order).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_expired_holds_return_stock_and_cancel_order(self):
+        abandoned = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        live = create_order([{'merchandise': self.hoodie, 'quantity': 1}], user=self.user)
+        self.expire_holds(abandoned)
+
+        self.assertEqual(release_expired_holds(batch_size=1), 1)
+
+        self.hoodie.refresh_from_db()
+        abandoned.refresh_from_db()
+        live.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 4)
+        self.assertEqual(abandoned.status, 'CANCELLED')
+        self.assertEqual(live.status, 'PENDING')
+        self.assertEqual(release_expired_holds(), 0)
+
+    def test_paid_order_converts_holds_to_sales(self):
+        order = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        payment = Payment.objects.create(user=self.user, amount=order.total_amount, payment_type='ORDER',
+                                         payment_method='MPESA', order=order)
+        mpesa_transaction = MpesaTransaction.objects.create(
+            payment=payment, phone_number='254700000000', amount=order.total_amount,
+            reference=f"Order-{order.id}", description='Order payment', checkout_request_id='ws_CO_1'
+        )
+
+        update_transaction_status(mpesa_transaction, 'COMPLETED', receipt_number='RCP1')
+        self.expire_holds(order)
+
+        self.assertEqual(release_expired_holds(), 0)
+        self.assertEqual(order.stock_holds.get().status, 'SOLD')
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 3)
+
+    def pay(self, order, checkout_request_id='ws_CO_2'):
+        payment = Payment.objects.create(user=self.user, amount=order.total_amount, payment_type='ORDER',
+                                         payment_method='MPESA', order=order)
+        mpesa_transaction = MpesaTransaction.objects.create(
+            payment=payment, phone_number='254700000000', amount=order.total_amount,
+            reference=f"Order-{order.id}", description='Order payment', checkout_request_id=checkout_request_id
+        )
+        update_transaction_status(mpesa_transaction, 'COMPLETED', receipt_number='RCP2')
+
+    def test_expired_holds_of_orders_no_longer_pending_are_kept(self):
+        order = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        Order.objects.filter(pk=order.pk).update(status='SHIPPED')
+        self.expire_holds(order)
+
+        self.assertEqual(release_expired_holds(), 0)
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 3)
+
+    def test_admin_status_changes_release_and_retake_stock(self):
+        admin = User.objects.create_user(email='admin@example.com', name='Admin', password='pass', role='ADMIN')
+        client = APIClient()
+        client.force_authenticate(admin)
+        order = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        url = reverse('order-update-status', args=[order.id])
+
+        self.assertEqual(client.patch(url, {'status': 'CANCELLED'}, format='json').status_code, 200)
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 5)
+        self.assertEqual(order.stock_holds.get().status, 'RELEASED')
+
+        self.assertEqual(client.patch(url, {'status': 'SHIPPED'}, format='json').status_code, 200)
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 3)
+        self.assertEqual(order.stock_holds.get().status, 'SOLD')
+
+        self.assertEqual(client.patch(url, {'status': 'CANCELLED'}, format='json').status_code, 200)
+        self.hoodie.refresh_from_db()
+        self.assertEqual(self.hoodie.stock, 5)
+        Merchandise.objects.filter(pk=self.hoodie.pk).update(stock=1)
+        response = client.patch(url, {'status': 'PAID'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'CANCELLED')
+
+    def test_late_payment_retakes_stock_of_cancelled_order(self):
+        order = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        self.expire_holds(order)
+        release_expired_holds()
+
+        self.pay(order)
+
+        order.refresh_from_db()
+        self.hoodie.refresh_from_db()
+        self.assertEqual(order.status, 'PAID')
+        self.assertEqual(order.stock_holds.get().status, 'SOLD')
+        self.assertEqual(self.hoodie.stock, 3)
+
+    def test_late_payment_leaves_cancelled_order_when_stock_is_gone(self):
+        order = create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        self.expire_holds(order)
+        release_expired_holds()
+        create_order([{'merchandise': self.hoodie, 'quantity': 4}], user=self.user)
+
+        self.pay(order)
+
+        order.refresh_from_db()
+        self.hoodie.refresh_from_db()
+        self.assertEqual(order.status, 'CANCELLED')
+        self.assertEqual(order.stock_holds.get().status, 'RELEASED')
+        self.assertEqual(self.hoodie.stock, 1)
+        self.assertEqual(Payment.objects.get(order=order).status, 'COMPLETED')
+
+
+class OrderQueryCountTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.items = [create_merchandise(self.user, stock=100, name=f'Item {i}') for i in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_orders(self, count, lines=3):
+        orders = []
+        for _ in range(count):
+            orders.append(create_order(
+                [{'merchandise': item, 'quantity': 1} for item in self.items[:lines]], user=self.user
+            ))
+        return orders
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_list_query_count_is_constant(self):
+        self.create_orders(2)
+        few, _ = self.count_queries(reverse('order-list'))
+        self.create_orders(8)
+        many, response = self.count_queries(reverse('order-list'))
+
+        self.assertEqual(few, many)
+        self.assertEqual(response.data['results'][0]['items_count'], 3)
+        self.assertEqual(few, self.count_queries(reverse('order-my-orders'))[0])
+
+    def test_detail_query_count_is_constant(self):
+        small, large = self.create_orders(1, lines=1)[0], self.create_orders(1, lines=5)[0]
+
+        few, _ = self.count_queries(reverse('order-detail', args=[small.id]))
+        many, response = self.count_queries(reverse('order-detail', args=[large.id]))
+
+        self.assertEqual(few, many)
+        self.assertEqual(len(response.data['items']), 5)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='admin@example.com', name='Admin', password='pass')
+        self.hoodie = create_merchandise(self.user, stock=5)
+        self.client = APIClient()
+        self.list_url = reverse('merchandise-list')
+
+    def test_list_is_served_from_cache(self):
+        first = self.client.get(self.list_url, {'category': 'clothing', 'featured': ''})
+
+        with self.assertNumQueries(0):
+            second = self.client.get(self.list_url, {'category': 'clothing'})
+
+        self.assertEqual((first['X-Cache'], second['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(first.data, second.data)
+
+    def test_writes_invalidate_cached_responses(self):
+        detail_url = reverse('merchandise-detail', args=[self.hoodie.id])
+        self.client.get(self.list_url)
+        self.client.get(detail_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_order([{'merchandise': self.hoodie, 'quantity': 2}], user=self.user)
+        response = self.client.get(detail_url)
+        self.assertEqual((response['X-Cache'], response.data['stock']), ('MISS', 3))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.hoodie.refresh_from_db()
+            self.hoodie.name = 'Zip Hoodie'
+            self.hoodie.save()
+        response = self.client.get(self.list_url)
+        self.assertEqual((response['X-Cache'], response.data['results'][0]['name']), ('MISS', 'Zip Hoodie'))
+
+    def test_if_none_match_returns_not_modified(self):
+        etag = self.client.get(self.list_url)['ETag']
+
+        response = self.client.get(self.list_url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+
+class CatalogIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        catalog_index.clear()
+        self.user = User.objects.create_user(email='admin@example.com', name='Admin', password='pass')
+        self.items = [
+            create_merchandise(self.user, stock=5, name='Hoodie', price=1500),
+            create_merchandise(self.user, stock=0, name='Cap', price=800),
+            create_merchandise(self.user, stock=2, name='Tee', price=1000),
+        ]
+        Merchandise.objects.create(
+            name='Notebook', description='Notebook', price=200, image='https://example.com/item.png',
+            category='stationery', stock=10, featured=True, created_by=self.user
+        )
+        self.client = APIClient()
+
+    def test_listing_matches_database_filters(self):
+        cases = [
+            ({}, '-created_at', {}),
+            ({'category': 'clothing', 'in_stock': True}, '-created_at', {'category': 'clothing', 'stock__gt': 0}),
+            ({'featured': True}, 'name', {'featured': True}),
+            ({'min_price': 500, 'max_price': 1500}, 'price', {'price__gte': 500, 'price__lte': 1500}),
+            ({'in_stock': False}, '-name', {'stock': 0}),
+        ]
+        snapshot = catalog_index.snapshot()
+        for filters, ordering, lookup in cases:
+            with self.subTest(filters=filters, ordering=ordering):
+                expected = list(Merchandise.objects.filter(**lookup).order_by(ordering).values_list('id', flat=True))
+                self.assertEqual([row['id'] for row in snapshot.listing(filters, ordering)], expected)
+
+    def test_list_endpoint_uses_index(self):
+        catalog_index.snapshot()
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('merchandise-list'), {'category': 'clothing', 'ordering': 'price'})
+
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([row['name'] for row in response.data['results']], ['Cap', 'Tee', 'Hoodie'])
+
+    def test_facets(self):
+        response = self.client.get(reverse('merchandise-facets'), {'category': 'clothing', 'buckets': '2'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['categories'], {'clothing': 3, 'stationery': 1})
+        self.assertEqual(response.data['in_stock'], {'true': 2, 'false': 1})
+        self.assertEqual(response.data['featured'], {'true': 0, 'false': 3})
+        self.assertEqual(
+            [bucket['count'] for bucket in response.data['price_histogram']], [1, 2]
+        )
+
+    def test_saves_update_index_in_place(self):
+        catalog_index.snapshot()
+        cap = self.items[1]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            cap.stock = 3
+            cap.save()
+
+        with self.assertNumQueries(0):
+            snapshot = catalog_index.snapshot()
+        self.assertEqual(snapshot.facets({})['in_stock'], {'true': 4, 'false': 0})
+
+    def test_index_is_rebuilt_once_it_is_too_old(self):
+        catalog_index.snapshot()
+        # A write this worker's cache never hears about, as from another worker with LocMemCache
+        Merchandise.objects.filter(pk=self.items[0].pk).update(stock=0)
+
+        self.assertEqual(catalog_index.snapshot().facets({})['in_stock'], {'true': 3, 'false': 1})
+        with mock.patch('merchandise.catalog_index.MERCHANDISE_CATALOG_INDEX_MAX_AGE', 0):
+            snapshot = catalog_index.snapshot()
+        self.assertEqual(snapshot.facets({})['in_stock'], {'true': 2, 'false': 2})
+
+    def test_orders_patch_stock_without_rebuilding(self):
+        catalog_index.snapshot()
+        tee = self.items[2]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_order([{'merchandise': tee, 'quantity': 2}], user=self.user)
+
+        with mock.patch.object(catalog_index, '_build', side_effect=AssertionError('index rebuilt')), \
+                self.assertNumQueries(1):
+            snapshot = catalog_index.snapshot()
+        self.assertEqual(snapshot.facets({})['in_stock'], {'true': 2, 'false': 2})
+        row = snapshot.rows[snapshot.positions_by_id[tee.id]]
+        self.assertEqual((row['stock'], row['in_stock']), (0, False))
+
+
+class BulkMerchandiseTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user(email='admin@example.com', name='Admin', password='pass', role='ADMIN')
+        self.items = [create_merchandise(self.admin, stock=0, name=f'Item {i}') for i in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_bulk_update_stock(self):
+        response = self.client.post(reverse('merchandise-bulk-update-stock'), {
+            'items': [{'id': item.id, 'stock': 10 + i} for i, item in enumerate(self.items)]
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data['results']], ['updated'] * 3)
+        self.assertEqual(
+            list(Merchandise.objects.order_by('id').values_list('stock', flat=True)), [10, 11, 12]
+        )
+
+    def test_invalid_row_rejects_whole_batch(self):
+        response = self.client.post(reverse('merchandise-bulk-update-stock'), [
+            {'id': self.items[0].id, 'stock': 5},
+            {'id': self.items[1].id, 'stock': -1},
+            {'id': 999999, 'stock': 1},
+        ], format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual([r['status'] for r in response.data['results']], ['updated', 'error', 'error'])
+        self.assertFalse(Merchandise.objects.filter(stock__gt=0).exists())
+
+    def test_import_and_export_round_trip(self):
+        upload = SimpleUploadedFile('items.csv', (
+            'id,name,description,price,image,category,stock,featured\n'
+            f'{self.items[0].id},,,2000,,,7,\n'
+            ',Scarf,Warm scarf,900,https://example.com/scarf.png,accessories,4,true\n'
+        ).encode())
+
+        response = self.client.post(reverse('merchandise-bulk-import'), {'file': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data['results']], ['updated', 'created'])
+        self.items[0].refresh_from_db()
+        self.assertEqual((self.items[0].price, self.items[0].stock, self.items[0].name), (2000, 7, 'Item 0'))
+
+        response = self.client.get(reverse('merchandise-bulk-export'), {'file_format': 'jsonl'})
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(any(line['name'] == 'Scarf' and line['featured'] for line in lines))
+
+    def test_import_without_stock_keeps_concurrent_stock_changes(self):
+        item = self.items[0]
+        is_valid = MerchandiseUpdateSerializer.is_valid
+
+        def is_valid_then_restock(serializer, *args, **kwargs):
+            # Stock moves after the row was read for validation
+            Merchandise.objects.filter(pk=item.pk).update(stock=F('stock') + 3)
+            return is_valid(serializer, *args, **kwargs)
+
+        with mock.patch.object(MerchandiseUpdateSerializer, 'is_valid', is_valid_then_restock):
+            applied, _ = import_merchandise([{'id': item.id, 'price': 2000}], created_by=self.admin)
+
+        self.assertTrue(applied)
+        item.refresh_from_db()
+        self.assertEqual((item.price, item.stock), (2000, 3))
+
+    def test_requires_admin(self):
+        member = User.objects.create_user(email='member@example.com', name='Member', password='pass')
+        self.client.force_authenticate(member)
+
+        response = self.client.post(reverse('merchandise-bulk-update-stock'), [], format='json')
+
+        self.assertEqual(response.status_code, 403)
+
+
+class OrderCursorPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='admin@example.com', name='Admin', password='pass', role='ADMIN')
+        now = timezone.now()
+        # Orders sharing a timestamp must still be paged without gaps or repeats
+        self.orders = Order.objects.bulk_create([
+            Order(user=self.user, total_amount=100, created_at=now - timedelta(minutes=i // 2))
+            for i in range(25)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_walks_all_pages_at_constant_cost(self):
+        url = reverse('order-list') + '?page_size=10'
+        seen = []
+        query_counts = []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            seen.extend(order['id'] for order in response.data['results'])
+            query_counts.append(len(queries))
+            url = response.data['next']
+
+        expected = list(Order.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(set(query_counts)), 1)
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(CreatedAtCursorPagination, 'max_page_size', 5):
+            response = self.client.get(reverse('order-list'), {'page_size': 1000})
+
+        self.assertEqual(len(response.data['results']), 5)
+
+
+class SalesAnalyticsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='admin@example.com', name='Admin', password='pass', role='ADMIN')
+        self.hoodie = create_merchandise(self.user, stock=10)
+        self.cap = create_merchandise(self.user, stock=10, name='Cap', price=500)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def pay(self, items, checkout_request_id):
+        order = create_order(items, user=self.user)
+        payment = Payment.objects.create(user=self.user, amount=order.total_amount, payment_type='ORDER',
+                                         payment_method='MPESA', order=order)
+        mpesa_transaction = MpesaTransaction.objects.create(
+            payment=payment, phone_number='254700000000', amount=order.total_amount,
+            reference=f"Order-{order.id}", description='Order payment', checkout_request_id=checkout_request_id
+        )
+        update_transaction_status(mpesa_transaction, 'COMPLETED', receipt_number=checkout_request_id)
+        return mpesa_transaction
+
+    def rollups(self):
+        items = sorted(DailyItemSales.objects.values_list('date', 'merchandise_id', 'units', 'revenue', 'orders'))
+        payments = sorted(DailyPaymentTotal.objects.values_list('date', 'payment_type', 'payment_method',
+                                                                'count', 'amount'))
+        return items, payments
+
+    def test_paid_transition_updates_rollups_once(self):
+        mpesa_transaction = self.pay([{'merchandise': self.hoodie, 'quantity': 2},
+                                      {'merchandise': self.cap, 'quantity': 1}], 'ws_CO_1')
+        self.pay([{'merchandise': self.hoodie, 'quantity': 1}], 'ws_CO_2')
+        # A replayed result must not count the sale again
+        update_transaction_status(mpesa_transaction, 'COMPLETED', receipt_number='ws_CO_1')
+
+        today = timezone.localdate()
+        hoodie = DailyItemSales.objects.get(date=today, merchandise=self.hoodie)
+        self.assertEqual((hoodie.units, hoodie.revenue, hoodie.orders), (3, 4500, 2))
+        totals = DailyPaymentTotal.objects.get(date=today, payment_type='ORDER', payment_method='MPESA')
+        self.assertEqual((totals.count, totals.amount), (2, 5000))
+
+    def test_admin_status_changes_move_rollups_both_ways(self):
+        mpesa_transaction = self.pay([{'merchandise': self.hoodie, 'quantity': 2}], 'ws_CO_1')
+        counted = self.rollups()
+        url = reverse('payment-update-status', args=[mpesa_transaction.payment_id])
+
+        self.assertEqual(self.client.patch(url, {'status': 'FAILED'}, format='json').status_code, 200)
+        today = timezone.localdate()
+        hoodie = DailyItemSales.objects.get(date=today, merchandise=self.hoodie)
+        self.assertEqual((hoodie.units, hoodie.revenue, hoodie.orders), (0, 0, 0))
+
+        response = self.client.patch(url, {'status': 'COMPLETED', 'transaction_id': 'ws_CO_1'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rollups(), counted)
+
+    def test_backfill_matches_incremental_rollups(self):
+        self.pay([{'merchandise': self.hoodie, 'quantity': 2}], 'ws_CO_1')
+        self.pay([{'merchandise': self.cap, 'quantity': 3}], 'ws_CO_2')
+        incremental = self.rollups()
+
+        DailyItemSales.objects.all().delete()
+        DailyPaymentTotal.objects.update(count=0, amount=0)
+        rebuild_rollups()
+
+        self.assertEqual(self.rollups(), incremental)
+
+    def test_backfill_counts_an_order_with_several_payments_once(self):
+        order = create_order([{'merchandise': self.cap, 'quantity': 2}], user=self.user)
+        for payment_status in ('FAILED', 'FAILED', 'COMPLETED'):
+            Payment.objects.create(user=self.user, amount=order.total_amount, payment_type='ORDER',
+                                   payment_method='MPESA', order=order, status=payment_status)
+        today = timezone.localdate()
+
+        rebuild_rollups(start_date=today, end_date=today)
+
+        sales = DailyItemSales.objects.get(date=today, merchandise=self.cap)
+        self.assertEqual((sales.units, sales.revenue, sales.orders), (2, 1000, 1))
+
+    def test_analytics_endpoint_reads_rollups(self):
+        self.pay([{'merchandise': self.hoodie, 'quantity': 2},
+                  {'merchandise': self.cap, 'quantity': 1}], 'ws_CO_1')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('merchandise-analytics'), {'top': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['totals'], {'revenue': 3500, 'units': 3, 'paid_orders': 1})
+        self.assertEqual([item['name'] for item in response.data['items']], ['Hoodie'])
+        self.assertEqual(response.data['payments'][0]['amount'], 3500)
+        tables = ' '.join(query['sql'] for query in queries)
+        self.assertNotIn('merchandise_orderitem', tables)
+        self.assertNotIn('"payment_payment"', tables)
+
+    def test_analytics_endpoint_requires_admin(self):
+        member = User.objects.create_user(email='member@example.com', name='Member', password='pass')
+        self.client.force_authenticate(member)
+
+        response = self.client.get(reverse('merchandise-analytics'))
+
+        self.assertEqual(response.status_code, 403)
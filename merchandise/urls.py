@@ -1,11 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import MerchandiseViewSet, OrderViewSet
+from .views import MerchandiseViewSet, OrderViewSet, SalesAnalyticsView
 
 router = DefaultRouter()
 router.register(r'items', MerchandiseViewSet)
 router.register(r'orders', OrderViewSet)
 
 urlpatterns = [
+    path('analytics/', SalesAnalyticsView.as_view(), name='merchandise-analytics'),
     path('', include(router.urls)),
 ]
@@ -1,9 +1,20 @@
-from rest_framework import viewsets, permissions, status, filters
+from rest_framework import generics, viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.db import transaction
+from django.db.models import Count
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import timedelta
 
+from .analytics import sales_summary
+from .bulk import (
+    FILE_FORMATS, BulkFormatError, apply_stock_updates, export_merchandise, import_merchandise, parse_rows
+)
+from .catalog_cache import MERCHANDISE_CATALOG_DETAIL_TTL, cached_catalog_response
+from .catalog_index import DEFAULT_ORDERING, catalog_index, parse_catalog_filters
 from .models import Merchandise, Order, OrderItem
 from .serializers import (
     MerchandiseListSerializer, MerchandiseDetailSerializer,
@@ -11,6 +22,11 @@ from .serializers import (
     OrderListSerializer, OrderDetailSerializer, OrderCreateSerializer,
     OrderStatusUpdateSerializer, OrderItemSerializer
 )
+from payment.services import (
+    PaymentInitiationError, get_callback_url, initiate_order_payment, initiation_response,
+    normalize_phone_number
+)
+from jkuelc_backend.pagination import CreatedAtCursorPagination
 from users.permissions import IsAdminOrManager, IsAdminOrManagerOrOwner
 
 
@@ -33,7 +49,7 @@ class MerchandiseViewSet(viewsets.ModelViewSet):
         return MerchandiseListSerializer
     
     def get_permissions(self):
-        if self.action == 'list' or self.action == 'retrieve':
+        if self.action in ['list', 'retrieve', 'facets']:
             return [permissions.AllowAny()]
         elif self.action in ['update', 'partial_update', 'destroy']:
             return [permissions.IsAuthenticated(), IsAdminOrManagerOrOwner()]
@@ -41,38 +57,69 @@ class MerchandiseViewSet(viewsets.ModelViewSet):
     
     def get_queryset(self):
         queryset = self.queryset
+        filters = parse_catalog_filters(self.request.query_params)
         
         # Filter by category if provided
-        category = self.request.query_params.get('category', None)
-        if category:
-            queryset = queryset.filter(category=category)
+        if 'category' in filters:
+            queryset = queryset.filter(category=filters['category'])
         
         # Filter by in_stock if provided
-        in_stock = self.request.query_params.get('in_stock', None)
-        if in_stock is not None:
-            in_stock_bool = in_stock.lower() == 'true'
-            if in_stock_bool:
+        if 'in_stock' in filters:
+            if filters['in_stock']:
                 queryset = queryset.filter(stock__gt=0)
             else:
                 queryset = queryset.filter(stock=0)
         
         # Filter by featured if provided
-        featured = self.request.query_params.get('featured', None)
-        if featured is not None:
-            featured_bool = featured.lower() == 'true'
-            queryset = queryset.filter(featured=featured_bool)
+        if 'featured' in filters:
+            queryset = queryset.filter(featured=filters['featured'])
         
         # Filter by min/max price if provided
-        min_price = self.request.query_params.get('min_price', None)
-        if min_price and min_price.isdigit():
-            queryset = queryset.filter(price__gte=int(min_price))
+        if 'min_price' in filters:
+            queryset = queryset.filter(price__gte=filters['min_price'])
         
-        max_price = self.request.query_params.get('max_price', None)
-        if max_price and max_price.isdigit():
-            queryset = queryset.filter(price__lte=int(max_price))
+        if 'max_price' in filters:
+            queryset = queryset.filter(price__lte=filters['max_price'])
         
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        return cached_catalog_response(request, 'list', lambda: self.list_from_index(request, *args, **kwargs))
+    
+    def list_from_index(self, request, *args, **kwargs):
+        """
+        Answer catalog listings from the in-memory catalog index; text searches still go to the database
+        """
+        if request.query_params.get('search'):
+            return super().list(request, *args, **kwargs)
+        
+        rows = catalog_index.snapshot().listing(
+            parse_catalog_filters(request.query_params),
+            ordering=request.query_params.get('ordering') or DEFAULT_ORDERING
+        )
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(rows)
+    
+    def retrieve(self, request, *args, **kwargs):
+        return cached_catalog_response(
+            request, 'retrieve', lambda: super(MerchandiseViewSet, self).retrieve(request, *args, **kwargs),
+            pk=kwargs.get('pk'), timeout=MERCHANDISE_CATALOG_DETAIL_TTL
+        )
+    
+    @action(detail=False, methods=['get'])
+    def facets(self, request):
+        """
+        Facet counts (items per category, in stock, featured and a price histogram)
+        for the catalog filtered by the same query parameters as the listing
+        """
+        buckets = request.query_params.get('buckets', '5')
+        buckets = min(int(buckets), 50) if buckets.isdigit() and int(buckets) > 0 else 5
+        
+        snapshot = catalog_index.snapshot()
+        return Response(snapshot.facets(parse_catalog_filters(request.query_params), buckets=buckets))
+    
     @action(detail=False, methods=['get'])
     def my_merchandise(self, request):
         """
@@ -125,6 +172,72 @@ class MerchandiseViewSet(viewsets.ModelViewSet):
         merchandise.save()
         serializer = MerchandiseDetailSerializer(merchandise)
         return Response(serializer.data)
+    
+    @action(detail=False, methods=['post'])
+    def bulk_update_stock(self, request):
+        """
+        Set the stock of many items in one request (admin only)
+        
+        Accepts a list of {"id", "stock"} objects, or {"items": [...]}. Nothing is
+        applied unless every row is valid.
+        """
+        rows = request.data.get('items') if isinstance(request.data, dict) else request.data
+        if not isinstance(rows, list) or not rows:
+            return Response(
+                {"detail": "A non-empty list of items is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        applied, results = apply_stock_updates(rows)
+        return Response(
+            {'applied': applied, 'results': results},
+            status=status.HTTP_200_OK if applied else status.HTTP_400_BAD_REQUEST
+        )
+    
+    @action(detail=False, methods=['post'])
+    def bulk_import(self, request):
+        """
+        Create or update items from an uploaded CSV or JSONL file (admin only)
+        
+        The format is taken from the file_format parameter or the file extension.
+        Rows with an id update that item, other rows create new items. Nothing is
+        applied unless every row is valid.
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response(
+                {"detail": "A CSV or JSONL file is required."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        file_format = request.data.get('file_format') or upload.name.rsplit('.', 1)[-1].lower()
+        try:
+            rows = parse_rows(upload, file_format)
+        except BulkFormatError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        applied, results = import_merchandise(rows, created_by=request.user)
+        return Response(
+            {'applied': applied, 'results': results},
+            status=status.HTTP_200_OK if applied else status.HTTP_400_BAD_REQUEST
+        )
+    
+    @action(detail=False, methods=['get'])
+    def bulk_export(self, request):
+        """
+        Stream the whole catalog as CSV or JSONL (admin only)
+        """
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in FILE_FORMATS:
+            return Response(
+                {"detail": f"file_format must be one of: {', '.join(FILE_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        content_type = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+        response = StreamingHttpResponse(export_merchandise(file_format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="merchandise.{file_format}"'
+        return response
 
 
 class OrderViewSet(viewsets.ModelViewSet):
@@ -132,9 +245,11 @@ class OrderViewSet(viewsets.ModelViewSet):
     API endpoint for order management
     """
     queryset = Order.objects.all().order_by('-created_at')
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = CreatedAtCursorPagination
+    # Keyset pages need a fixed, unique ordering, so client ordering is not offered
+    ordering = ('-created_at', '-id')
+    filter_backends = [filters.SearchFilter]
     search_fields = ['user__name', 'user__email']
-    ordering_fields = ['created_at', 'total_amount']
     
     def get_serializer_class(self):
         if self.action == 'create':
@@ -153,7 +268,12 @@ class OrderViewSet(viewsets.ModelViewSet):
         return [permissions.IsAuthenticated()]
     
     def get_queryset(self):
-        queryset = self.queryset
+        queryset = self.queryset.select_related('user')
+        
+        if self.action == 'retrieve':
+            queryset = queryset.prefetch_related('items__merchandise')
+        elif self.action == 'list':
+            queryset = queryset.annotate(items_count=Count('items'))
         
         # Filter by status if provided
         status_param = self.request.query_params.get('status', None)
@@ -181,7 +301,9 @@ class OrderViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        queryset = Order.objects.filter(user=request.user).order_by('-created_at')
+        queryset = Order.objects.filter(user=request.user).select_related('user').annotate(
+            items_count=Count('items')
+        ).order_by('-created_at')
         page = self.paginate_queryset(queryset)
         
         if page is not None:
@@ -228,50 +350,73 @@ class OrderViewSet(viewsets.ModelViewSet):
             )
         
         # Format phone number if needed (ensure it's in 254XXXXXXXXX format)
-        if phone_number.startswith('0'):
-            phone_number = '254' + phone_number[1:]
-        elif phone_number.startswith('+254'):
-            phone_number = phone_number[1:]
-        
-        # Check phone number format
-        if not phone_number.startswith('254') or not phone_number.isdigit() or len(phone_number) != 12:
+        phone_number = normalize_phone_number(phone_number)
+        if phone_number is None:
             return Response(
                 {"error": "Phone number must be in the format 254XXXXXXXXX, +254XXXXXXXXX, or 07XXXXXXXX"},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Redirect to payment app's M-Pesa initiation endpoint
-        from rest_framework.reverse import reverse
-        payment_url = reverse('mpesa-transaction-initiate-order-payment', request=request)
-        
-        # Prepare the data for the payment request
-        payment_data = {
-            'order_id': order.id,
-            'phone_number': phone_number
-        }
-        
-        # Use requests to make an internal API call
-        import requests
-        from django.conf import settings
-        
-        # Get the host from the request
-        host = request.get_host()
-        protocol = 'https' if request.is_secure() else 'http'
-        
-        # Construct the full URL
-        full_url = f"{protocol}://{host}{payment_url}"
-        
-        # Get the auth token from the request
-        auth_header = request.headers.get('Authorization')
-        headers = {}
-        if auth_header:
-            headers['Authorization'] = auth_header
-        
+        # Initiate the payment in-process rather than calling back into our own API
         try:
-            response = requests.post(full_url, json=payment_data, headers=headers)
-            return Response(response.json(), status=response.status_code)
+            mpesa_transaction = initiate_order_payment(
+                order, request.user, phone_number, callback_url=get_callback_url(request)
+            )
+        except PaymentInitiationError as e:
+            return Response(e.as_dict(), status=e.status_code)
         except Exception as e:
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        
+        return Response(initiation_response(mpesa_transaction))
+
+
+class SalesAnalyticsView(generics.GenericAPIView):
+    """
+    API endpoint for merchandise sales analytics (admin only)
+    
+    Reads only the daily rollups maintained by merchandise.analytics, so the cost
+    does not grow with the number of orders.
+    """
+    permission_classes = [permissions.IsAuthenticated, IsAdminOrManager]
+    
+    # Days covered when no start_date is given
+    DEFAULT_DAYS = 30
+    
+    def get(self, request):
+        """
+        Query parameters: start_date and end_date (inclusive, YYYY-MM-DD; the last
+        30 days by default) and top (number of best selling items, default 10).
+        """
+        dates = {}
+        for param in ('start_date', 'end_date'):
+            value = request.query_params.get(param)
+            if value:
+                try:
+                    dates[param] = parse_date(value)
+                except ValueError:
+                    dates[param] = None
+                if dates[param] is None:
+                    return Response(
+                        {"detail": f"{param} must be a date in the format YYYY-MM-DD."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+        
+        end_date = dates.get('end_date') or timezone.localdate()
+        start_date = dates.get('start_date') or end_date - timedelta(days=self.DEFAULT_DAYS - 1)
+        if start_date > end_date:
+            return Response(
+                {"detail": "start_date must not be after end_date."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        top = request.query_params.get('top', '10')
+        if not top.isdigit() or not 1 <= int(top) <= 100:
+            return Response(
+                {"detail": "top must be a number between 1 and 100."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        return Response(sales_summary(start_date, end_date, top=int(top)))
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment, MembershipPayment, Notification, Feedback, MpesaTransaction
+from .models import Payment, MembershipPayment, Notification, Feedback, MpesaTransaction, MpesaCallback
 
 
 class PaymentAdmin(admin.ModelAdmin):
@@ -61,9 +61,20 @@ class MpesaTransactionAdmin(admin.ModelAdmin):
     )
 
 
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'received_at', 'processed_at', 'attempts')
+    list_filter = ('processed_at', 'received_at')
+    readonly_fields = ('payload', 'received_at', 'processed_at', 'attempts', 'last_error')
+    fieldsets = (
+        (None, {'fields': ('payload',)}),
+        ('Processing', {'fields': ('received_at', 'processed_at', 'attempts', 'last_error')}),
+    )
+
+
 admin.site.register(Payment, PaymentAdmin)
 admin.site.register(MembershipPayment, MembershipPaymentAdmin)
 admin.site.register(Notification, NotificationAdmin)
 admin.site.register(Feedback, FeedbackAdmin)
 admin.site.register(MpesaTransaction, MpesaTransactionAdmin)
+admin.site.register(MpesaCallback, MpesaCallbackAdmin)
 
@@ -0,0 +1,241 @@
+"""
+Asynchronous Daraja API client.
+This module mirrors the synchronous client in daraja.py on top of httpx.AsyncClient so that
+async views served under ASGI can keep many STK pushes in flight from a single worker.
+"""
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+from django.core.cache import cache
+
+from .daraja import (
+    BASE_URL, MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET, MPESA_SHORTCODE, MPESA_PASSKEY,
+    MPESA_HTTP_POOL_SIZE, MPESA_CONNECT_TIMEOUT, MPESA_READ_TIMEOUT, MPESA_MAX_RETRIES,
+    MPESA_RETRY_BACKOFF, MPESA_TOKEN_CACHE_KEY, MPESA_TOKEN_REFRESH_MARGIN, RETRY_STATUS_CODES,
+    get_timestamp, generate_password
+)
+
+logger = logging.getLogger('payment.daraja')
+
+
+class AsyncDarajaClient:
+    """
+    Async counterpart of DarajaClient with the same public surface.
+    
+    The access token is shared with the synchronous client through the same cache
+    key, and concurrent refreshes on an event loop wait on a single asyncio lock.
+    The underlying httpx.AsyncClient is bound to the event loop it was created on,
+    so if the client is used from a different loop the old one is closed and a new
+    one is opened.
+    """
+    
+    def __init__(self, base_url=BASE_URL, consumer_key=MPESA_CONSUMER_KEY,
+                 consumer_secret=MPESA_CONSUMER_SECRET, shortcode=MPESA_SHORTCODE,
+                 passkey=MPESA_PASSKEY, pool_size=MPESA_HTTP_POOL_SIZE,
+                 connect_timeout=MPESA_CONNECT_TIMEOUT, read_timeout=MPESA_READ_TIMEOUT,
+                 max_retries=MPESA_MAX_RETRIES, retry_backoff=MPESA_RETRY_BACKOFF,
+                 cache_key=MPESA_TOKEN_CACHE_KEY, refresh_margin=MPESA_TOKEN_REFRESH_MARGIN):
+        self.token_url = f"{base_url}/oauth/v1/generate?grant_type=client_credentials"
+        self.stk_push_url = f"{base_url}/mpesa/stkpush/v1/processrequest"
+        self.query_url = f"{base_url}/mpesa/stkpushquery/v1/query"
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.cache_key = cache_key
+        self.refresh_margin = refresh_margin
+        
+        self._http = None
+        self._loop = None
+        self._token_lock = None
+        self._token = None
+        self._expires_at = 0
+    
+    async def aclose(self):
+        """Close all pooled connections"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+    
+    async def fetch_access_token(self):
+        """
+        Request a new OAuth access token from the M-Pesa API
+        
+        Returns:
+            tuple: (access_token, expires_in) or (None, None) if the request failed
+        """
+        try:
+            response = await self._request(
+                'GET', self.token_url, idempotent=True,
+                auth=(self.consumer_key, self.consumer_secret)
+            )
+            response.raise_for_status()
+            result = response.json()
+            return result.get("access_token"), int(result.get("expires_in", 3599))
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Error getting access token: {e}")
+            return None, None
+    
+    async def get_access_token(self):
+        """Get an OAuth access token, reusing the cached token when possible"""
+        if self._is_fresh():
+            return self._token
+        
+        await self._bind_loop()
+        async with self._token_lock:
+            # Another coroutine or worker may have refreshed while we were waiting
+            await self._load_shared_token()
+            if self._is_fresh():
+                return self._token
+            
+            token, expires_in = await self.fetch_access_token()
+            if not token:
+                return self._token if self._token and time.time() < self._expires_at else None
+            
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            await cache.aset(
+                self.cache_key,
+                {'access_token': token, 'expires_at': self._expires_at},
+                timeout=expires_in
+            )
+            logger.info("Refreshed M-Pesa access token (async client)")
+            return token
+    
+    async def initiate_stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        """
+        Initiate an STK Push request to the customer's phone
+        
+        Args:
+            phone_number (str): Phone number in format 254XXXXXXXXX
+            amount (int): Amount to pay
+            account_reference (str): Payment reference e.g. "Order 123"
+            transaction_desc (str): Description of the transaction
+            callback_url (str): URL to receive payment notification
+        
+        Returns:
+            dict: Response from the M-Pesa API
+        """
+        timestamp = get_timestamp()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": generate_password(self.shortcode, self.passkey, timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": transaction_desc
+        }
+        
+        try:
+            return await self._post_json(self.stk_push_url, payload, idempotent=False)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Error initiating STK push: {e}")
+            return {"error": str(e)}
+    
+    async def query_stk_status(self, checkout_request_id):
+        """
+        Query the status of an STK Push request
+        
+        Args:
+            checkout_request_id (str): The CheckoutRequestID from the STK Push response
+        
+        Returns:
+            dict: Response from the M-Pesa API
+        """
+        timestamp = get_timestamp()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": generate_password(self.shortcode, self.passkey, timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+        
+        try:
+            return await self._post_json(self.query_url, payload, idempotent=True)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Error querying STK status: {e}")
+            return {"error": str(e)}
+    
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+    
+    async def _load_shared_token(self):
+        shared = await cache.aget(self.cache_key)
+        if shared and shared.get('expires_at', 0) > self._expires_at:
+            self._token = shared['access_token']
+            self._expires_at = shared['expires_at']
+    
+    async def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            previous = self._http
+            self._loop = loop
+            self._token_lock = asyncio.Lock()
+            self._http = None
+            if previous is not None:
+                # Release the old loop's connection pool rather than leaking it
+                try:
+                    await previous.aclose()
+                except Exception as e:
+                    logger.warning(f"Error closing Daraja HTTP client of a previous event loop: {e}")
+        if self._http is None:
+            self._http = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+    
+    async def _post_json(self, url, payload, idempotent):
+        access_token = await self.get_access_token()
+        if not access_token:
+            return {"error": "Could not get access token"}
+        
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        response = await self._request('POST', url, idempotent=idempotent, json=payload, headers=headers)
+        if response.status_code == 401:
+            # The token was revoked or expired early, fetch a new one next time
+            self._token = None
+            self._expires_at = 0
+            await cache.adelete(self.cache_key)
+        return response.json()
+    
+    async def _request(self, method, url, idempotent=False, **kwargs):
+        await self._bind_loop()
+        attempts = self.max_retries + 1 if idempotent else 1
+        
+        for attempt in range(attempts):
+            is_last_attempt = attempt == attempts - 1
+            try:
+                response = await self._http.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if is_last_attempt:
+                    raise
+                logger.warning(f"Daraja request to {url} failed ({e}), retrying")
+            else:
+                if is_last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                logger.warning(f"Daraja request to {url} returned {response.status_code}, retrying")
+            
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+
+
+_default_client = None
+
+
+def get_async_client():
+    """Return the process-wide async Daraja client, creating it on first use"""
+    global _default_client
+    if _default_client is None:
+        _default_client = AsyncDarajaClient()
+    return _default_client
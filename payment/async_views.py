@@ -0,0 +1,90 @@
+"""
+Async views for M-Pesa payments.
+These views are served natively by the ASGI application, so a single worker can keep many
+STK push requests in flight while it waits on Safaricom.
+"""
+import json
+import logging
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework.authtoken.models import Token
+
+from merchandise.models import Order
+from .async_daraja import get_async_client
+from .services import (
+    PaymentInitiationError, ainitiate_order_payment, get_callback_url, initiation_response
+)
+
+logger = logging.getLogger('payment.async_views')
+
+
+async def get_token_user(request):
+    """
+    Resolve the user from a DRF ``Authorization: Token <key>`` header
+    """
+    auth_header = request.headers.get('Authorization', '')
+    keyword, _, key = auth_header.partition(' ')
+    if keyword != 'Token' or not key:
+        return None
+    
+    try:
+        token = await Token.objects.select_related('user').aget(key=key.strip())
+    except Token.DoesNotExist:
+        return None
+    
+    return token.user if token.user.is_active else None
+
+
+@csrf_exempt
+@require_POST
+async def initiate_order_payment_async(request):
+    """
+    Initiate an M-Pesa payment for an order without blocking a worker thread
+    """
+    user = await get_token_user(request)
+    if user is None:
+        return JsonResponse(
+            {"detail": "Authentication credentials were not provided."},
+            status=401
+        )
+    
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body"}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "JSON body must be an object"}, status=400)
+    
+    # Validate order_id and phone_number
+    order_id = data.get('order_id')
+    phone_number = str(data.get('phone_number') or '')
+    
+    if not order_id:
+        return JsonResponse({"error": "Order ID is required"}, status=400)
+    
+    if not phone_number:
+        return JsonResponse({"error": "Phone number is required"}, status=400)
+    
+    # Check phone number format (should be 254XXXXXXXXX)
+    if not phone_number.startswith('254') or not phone_number.isdigit() or len(phone_number) != 12:
+        return JsonResponse({"error": "Phone number must be in the format 254XXXXXXXXX"}, status=400)
+    
+    try:
+        order = await Order.objects.aget(id=order_id, user=user)
+    except (Order.DoesNotExist, ValueError):
+        return JsonResponse(
+            {"error": "Order not found or you don't have permission to pay for it"},
+            status=404
+        )
+    
+    try:
+        mpesa_transaction = await ainitiate_order_payment(
+            order, user, phone_number,
+            callback_url=get_callback_url(request),
+            stk_push=get_async_client().initiate_stk_push
+        )
+    except PaymentInitiationError as e:
+        return JsonResponse(e.as_dict(), status=e.status_code)
+    
+    return JsonResponse(initiation_response(mpesa_transaction))
@@ -0,0 +1,111 @@
+"""
+Parser for M-Pesa STK push callbacks.
+The stkCallback object is located once, its shape is validated, and the CallbackMetadata
+items are mapped onto a slotted StkCallback through a name -> slot setter table.
+"""
+
+class CallbackParseError(ValueError):
+    """Raised when a callback payload does not have the expected stkCallback shape"""
+
+
+class StkCallback:
+    """Parsed STK push callback"""
+    
+    __slots__ = (
+        'merchant_request_id', 'checkout_request_id', 'result_code', 'result_desc',
+        'amount', 'mpesa_receipt_number', 'transaction_date', 'phone_number',
+    )
+    
+    def __init__(self, merchant_request_id, checkout_request_id, result_code, result_desc):
+        self.merchant_request_id = merchant_request_id
+        self.checkout_request_id = checkout_request_id
+        self.result_code = result_code
+        self.result_desc = result_desc
+        self.amount = None
+        self.mpesa_receipt_number = None
+        self.transaction_date = None
+        self.phone_number = None
+    
+    def __repr__(self):
+        return f"StkCallback(checkout_request_id={self.checkout_request_id!r}, result_code={self.result_code!r})"
+    
+    @property
+    def is_successful(self):
+        return self.result_code == 0
+    
+    def as_dict(self):
+        """Return the callback in the dict format produced by daraja.process_callback"""
+        payment_info = {
+            "result_code": self.result_code,
+            "result_desc": self.result_desc,
+            "checkout_request_id": self.checkout_request_id,
+            "merchant_request_id": self.merchant_request_id,
+        }
+        if self.result_code == 0:
+            payment_info["amount"] = self.amount
+            payment_info["mpesa_receipt_number"] = self.mpesa_receipt_number
+            payment_info["transaction_date"] = self.transaction_date
+            payment_info["phone_number"] = self.phone_number
+        return payment_info
+
+
+# CallbackMetadata item name -> setter of the matching StkCallback slot
+METADATA_FIELDS = {
+    'Amount': StkCallback.amount.__set__,
+    'MpesaReceiptNumber': StkCallback.mpesa_receipt_number.__set__,
+    'TransactionDate': StkCallback.transaction_date.__set__,
+    'PhoneNumber': StkCallback.phone_number.__set__,
+}
+
+
+def parse_stk_callback(callback_data):
+    """
+    Parse and validate an STK push callback payload
+    
+    Args:
+        callback_data (dict): The callback data from M-Pesa
+    
+    Returns:
+        StkCallback: The parsed callback
+    
+    Raises:
+        CallbackParseError: If the payload is missing required fields or has the wrong types
+    """
+    try:
+        stk_callback = callback_data["Body"]["stkCallback"]
+        checkout_request_id = stk_callback["CheckoutRequestID"]
+        result_code = stk_callback["ResultCode"]
+    except (KeyError, TypeError) as e:
+        raise CallbackParseError(f"Missing callback field: {e}") from None
+    
+    if not isinstance(checkout_request_id, str) or not checkout_request_id:
+        raise CallbackParseError("CheckoutRequestID must be a non-empty string")
+    
+    if type(result_code) is not int:
+        # Some gateways forward the code as a string
+        if not isinstance(result_code, str) or not result_code.isdigit():
+            raise CallbackParseError(f"Invalid ResultCode: {result_code!r}")
+        result_code = int(result_code)
+    
+    callback = StkCallback(
+        stk_callback.get("MerchantRequestID"),
+        checkout_request_id,
+        result_code,
+        stk_callback.get("ResultDesc"),
+    )
+    
+    if result_code == 0:
+        metadata = stk_callback.get("CallbackMetadata")
+        items = metadata.get("Item") if isinstance(metadata, dict) else None
+        if not isinstance(items, list):
+            raise CallbackParseError("Successful callback is missing CallbackMetadata.Item")
+        
+        fields = METADATA_FIELDS
+        for item in items:
+            if type(item) is not dict:
+                raise CallbackParseError(f"Invalid CallbackMetadata item: {item!r}")
+            setter = fields.get(item.get("Name"))
+            if setter is not None:
+                setter(callback, item.get("Value"))
+    
+    return callback
@@ -0,0 +1,89 @@
+"""
+Durable queue for M-Pesa callbacks.
+In queue mode the callback view only stores the raw payload and acknowledges Safaricom
+immediately; the payloads are then applied in batches by the process_mpesa_callbacks command.
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import MpesaCallback
+from .utils import ingest_callback
+
+logger = logging.getLogger('payment.callback_queue')
+
+MPESA_CALLBACK_MAX_ATTEMPTS = getattr(settings, 'MPESA_CALLBACK_MAX_ATTEMPTS', 5)
+
+
+def enqueue_callback(payload):
+    """Store a raw callback payload for later processing"""
+    return MpesaCallback.objects.create(payload=payload)
+
+
+def drain_callback_queue(batch_size=100, max_attempts=MPESA_CALLBACK_MAX_ATTEMPTS):
+    """
+    Apply queued callbacks in batches through ingest_callback
+    
+    Each batch is claimed with SELECT ... FOR UPDATE SKIP LOCKED (where the
+    database supports it) so several consumers can drain the queue at once.
+    Callbacks that raise are kept in the queue and retried on the next run
+    until they reach ``max_attempts``.
+    
+    Args:
+        batch_size: Number of callbacks claimed per batch
+        max_attempts: Attempts after which a failing callback is left for inspection
+        
+    Returns:
+        dict: Counts of processed and failed callbacks
+    """
+    stats = {'processed': 0, 'failed': 0}
+    last_id = 0
+    
+    while True:
+        with transaction.atomic():
+            batch = list(
+                MpesaCallback.objects.select_for_update(skip_locked=True)
+                .filter(processed_at__isnull=True, attempts__lt=max_attempts, id__gt=last_id)
+                .order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+            
+            processed_ids = []
+            failed = []
+            for callback in batch:
+                try:
+                    with transaction.atomic():
+                        ingest_callback(callback.payload)
+                    processed_ids.append(callback.id)
+                except Exception as e:
+                    logger.error(f"Error processing queued M-Pesa callback {callback.id}: {e}")
+                    callback.attempts += 1
+                    callback.last_error = str(e)
+                    failed.append(callback)
+            
+            MpesaCallback.objects.filter(id__in=processed_ids).update(
+                processed_at=timezone.now(),
+                attempts=F('attempts') + 1,
+                last_error=None
+            )
+            MpesaCallback.objects.bulk_update(failed, ['attempts', 'last_error'])
+        
+        stats['processed'] += len(processed_ids)
+        stats['failed'] += len(failed)
+    
+    if stats['processed'] or stats['failed']:
+        logger.info(f"Drained M-Pesa callback queue: {stats}")
+    return stats
+
+
+def purge_processed_callbacks(older_than=timedelta(days=7)):
+    """Delete processed callbacks older than ``older_than``"""
+    deleted, _ = MpesaCallback.objects.filter(
+        processed_at__lt=timezone.now() - older_than
+    ).delete()
+    return deleted
@@ -5,10 +5,16 @@ This module handles all interactions with the Safaricom Daraja API for the JKUEL
 import base64
 import json
 import logging
+import random
+import threading
+import time
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from django.conf import settings
+from django.core.cache import cache
+from .callback_parser import CallbackParseError, parse_stk_callback
 
 logger = logging.getLogger(__name__)
 
@@ -18,10 +24,20 @@ MPESA_CONSUMER_SECRET = getattr(settings, 'MPESA_CONSUMER_SECRET', '')
 MPESA_PASSKEY = getattr(settings, 'MPESA_PASSKEY', '')
 MPESA_SHORTCODE = getattr(settings, 'MPESA_SHORTCODE', '')
 MPESA_ENV = getattr(settings, 'MPESA_ENVIRONMENT', 'sandbox')
+MPESA_TOKEN_REFRESH_MARGIN = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)  # Seconds before expiry
+MPESA_TOKEN_CACHE_KEY = getattr(settings, 'MPESA_TOKEN_CACHE_KEY', 'mpesa:access_token')
+MPESA_HTTP_POOL_SIZE = getattr(settings, 'MPESA_HTTP_POOL_SIZE', 10)
+MPESA_CONNECT_TIMEOUT = getattr(settings, 'MPESA_CONNECT_TIMEOUT', 5)  # Seconds
+MPESA_READ_TIMEOUT = getattr(settings, 'MPESA_READ_TIMEOUT', 30)  # Seconds
+MPESA_MAX_RETRIES = getattr(settings, 'MPESA_MAX_RETRIES', 2)  # Retries for idempotent calls only
+MPESA_RETRY_BACKOFF = getattr(settings, 'MPESA_RETRY_BACKOFF', 0.5)  # Base delay in seconds
 
 # API URLs
 if MPESA_ENV == "sandbox":
     BASE_URL = "https://sandbox.safaricom.co.ke"
+elif MPESA_ENV == "simulator":
+    # Local stand-in served by the run_daraja_simulator command
+    BASE_URL = getattr(settings, 'MPESA_SIMULATOR_URL', 'http://127.0.0.1:8089')
 else:
     BASE_URL = "https://api.safaricom.co.ke"
 
@@ -29,6 +45,10 @@ TOKEN_URL = f"{BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
 STK_PUSH_URL = f"{BASE_URL}/mpesa/stkpush/v1/processrequest"
 QUERY_URL = f"{BASE_URL}/mpesa/stkpushquery/v1/query"
 
+# Status codes worth retrying for idempotent requests. Plain 500s are not
+# retried because Daraja uses them for "transaction is being processed".
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
 
 def get_timestamp():
     """Generate timestamp in the format YYYYMMDDHHmmss"""
@@ -41,104 +61,369 @@ def generate_password(shortcode, passkey, timestamp):
     return base64.b64encode(data_to_encode.encode()).decode()
 
 
-def get_access_token():
-    """Get an OAuth access token from the M-Pesa API"""
-    try:
-        response = requests.get(
-            TOKEN_URL,
-            auth=HTTPBasicAuth(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)
-        )
-        response.raise_for_status()
-        result = response.json()
-        return result.get("access_token")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error getting access token: {e}")
-        return None
-
-
-def initiate_stk_push(phone_number, amount, account_reference, transaction_desc, callback_url):
+class DarajaTokenManager:
     """
-    Initiate an STK Push request to the customer's phone
+    Caches the Daraja OAuth bearer token until shortly before it expires.
     
-    Args:
-        phone_number (str): Phone number in format 254XXXXXXXXX
-        amount (int): Amount to pay
-        account_reference (str): Payment reference e.g. "Order 123"
-        transaction_desc (str): Description of the transaction
-        callback_url (str): URL to receive payment notification
-        
-    Returns:
-        dict: Response from the M-Pesa API
+    The token is kept in process memory and mirrored into Django's cache so that
+    every worker sharing the cache backend reuses the same token. Once a token
+    enters the refresh margin it is still served while a single background
+    thread fetches its replacement. Within a process one thread refreshes while
+    the others wait on a condition for its token, and workers coordinate through
+    a short-lived cache lock, so the token endpoint sees one request per expiry
+    window. The lock is not held while fetching, or while waiting for another
+    worker's token, so callers with a valid token are never held up.
     """
-    access_token = get_access_token()
-    if not access_token:
-        return {"error": "Could not get access token"}
-    
-    timestamp = get_timestamp()
-    password = generate_password(MPESA_SHORTCODE, MPESA_PASSKEY, timestamp)
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": amount,
-        "PartyA": phone_number,
-        "PartyB": MPESA_SHORTCODE,
-        "PhoneNumber": phone_number,
-        "CallBackURL": callback_url,
-        "AccountReference": account_reference,
-        "TransactionDesc": transaction_desc
-    }
     
-    try:
-        response = requests.post(STK_PUSH_URL, json=payload, headers=headers)
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error initiating STK push: {e}")
-        return {"error": str(e)}
+    def __init__(self, fetch_token, cache_key=MPESA_TOKEN_CACHE_KEY,
+                 refresh_margin=MPESA_TOKEN_REFRESH_MARGIN, lock_timeout=30):
+        self.fetch_token = fetch_token
+        self.cache_key = cache_key
+        self.lock_key = f"{cache_key}:lock"
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Condition(threading.Lock())
+        self._refreshing = False
+        self._background_refresh = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+    
+    def get_token(self):
+        """Return a valid access token, fetching a new one only when necessary"""
+        now = time.time()
+        
+        if not self._is_valid(now):
+            self._load_shared_token()
+        
+        token, expires_at = self._token, self._expires_at
+        if token is not None and now < expires_at:
+            with self._lock:
+                self.hits += 1
+            if now >= expires_at - self.refresh_margin:
+                self._refresh_in_background()
+            return token
+        
+        with self._lock:
+            self.misses += 1
+        return self._refresh()
+    
+    def invalidate(self):
+        """Drop the cached token, e.g. after the API rejected it"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+            cache.delete(self.cache_key)
+    
+    def stats(self):
+        """Return cache counters for monitoring"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'expires_in': max(0, int(self._expires_at - time.time())),
+        }
+    
+    def _is_valid(self, now):
+        return self._token is not None and now < self._expires_at
+    
+    def _is_fresh(self, now):
+        return self._token is not None and now < self._expires_at - self.refresh_margin
+    
+    def _load_shared_token(self):
+        shared = cache.get(self.cache_key)
+        if shared and shared.get('expires_at', 0) > self._expires_at:
+            self._token = shared['access_token']
+            self._expires_at = shared['expires_at']
+    
+    def _refresh_in_background(self):
+        # Checked and started under the lock so two callers cannot start two threads
+        with self._lock:
+            thread = self._background_refresh
+            if self._refreshing or (thread is not None and thread.is_alive()):
+                return
+            self._background_refresh = threading.Thread(
+                target=self._refresh, name='daraja-token-refresh', daemon=True
+            )
+            self._background_refresh.start()
+    
+    def _refresh(self):
+        with self._lock:
+            # One thread per process refreshes; the others wait here for its token
+            while self._refreshing:
+                self._lock.wait()
+            
+            # Another thread or worker may have refreshed while we were waiting
+            self._load_shared_token()
+            if self._is_fresh(time.time()):
+                return self._token
+            self._refreshing = True
+        
+        try:
+            fetched = self._fetch_unless_shared()
+            with self._lock:
+                return self._store(fetched)
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._lock.notify_all()
+    
+    def _fetch_unless_shared(self):
+        """
+        Fetch a token, unless another worker holds the refresh lock and publishes one
+        
+        Returns:
+            tuple: (token, expires_in) from fetch_token, or None if another worker's
+                token was loaded instead
+        """
+        acquired = cache.add(self.lock_key, True, timeout=self.lock_timeout)
+        if not acquired and self._wait_for_shared_token():
+            return None
+        
+        try:
+            return self.fetch_token()
+        finally:
+            if acquired:
+                cache.delete(self.lock_key)
+    
+    def _store(self, fetched):
+        """Keep a fetched token, called with self._lock held"""
+        if fetched is None:
+            # Another worker held the refresh lock and published its token
+            return self._token
+        
+        token, expires_in = fetched
+        if not token:
+            self.failures += 1
+            # Keep serving the old token for as long as it remains valid
+            return self._token if self._is_valid(time.time()) else None
+        
+        self._token = token
+        self._expires_at = time.time() + expires_in
+        self.refreshes += 1
+        cache.set(
+            self.cache_key,
+            {'access_token': token, 'expires_at': self._expires_at},
+            timeout=expires_in
+        )
+        logger.info(f"Refreshed M-Pesa access token ({self.stats()})")
+        return token
+    
+    def _wait_for_shared_token(self, timeout=2.0, interval=0.1):
+        """
+        Wait for another worker to publish a fresh token, without holding self._lock
+        
+        Tokens from other workers only arrive through the cache, which is checked
+        every ``interval`` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._load_shared_token()
+                if self._is_fresh(time.time()):
+                    return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
 
 
-def query_stk_status(checkout_request_id):
+class DarajaClient:
     """
-    Query the status of an STK Push request
+    Client for the Safaricom Daraja API.
     
-    Args:
-        checkout_request_id (str): The CheckoutRequestID from the STK Push response
-        
-    Returns:
-        dict: Response from the M-Pesa API
+    All calls share one keep-alive ``requests.Session`` with a bounded connection
+    pool, so TLS handshakes are paid once per connection rather than once per
+    call. Every request has connect/read timeouts. Idempotent calls (token
+    fetches and STK status queries) are retried on connection errors and
+    transient status codes with jittered exponential backoff; STK pushes are
+    never retried since a retry could prompt the customer twice.
     """
-    access_token = get_access_token()
-    if not access_token:
-        return {"error": "Could not get access token"}
     
-    timestamp = get_timestamp()
-    password = generate_password(MPESA_SHORTCODE, MPESA_PASSKEY, timestamp)
+    def __init__(self, base_url=BASE_URL, consumer_key=MPESA_CONSUMER_KEY,
+                 consumer_secret=MPESA_CONSUMER_SECRET, shortcode=MPESA_SHORTCODE,
+                 passkey=MPESA_PASSKEY, pool_size=MPESA_HTTP_POOL_SIZE,
+                 connect_timeout=MPESA_CONNECT_TIMEOUT, read_timeout=MPESA_READ_TIMEOUT,
+                 max_retries=MPESA_MAX_RETRIES, retry_backoff=MPESA_RETRY_BACKOFF):
+        self.token_url = f"{base_url}/oauth/v1/generate?grant_type=client_credentials"
+        self.stk_push_url = f"{base_url}/mpesa/stkpush/v1/processrequest"
+        self.query_url = f"{base_url}/mpesa/stkpushquery/v1/query"
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        self.tokens = DarajaTokenManager(fetch_token=self.fetch_access_token)
     
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
     
-    payload = {
-        "BusinessShortCode": MPESA_SHORTCODE,
-        "Password": password,
-        "Timestamp": timestamp,
-        "CheckoutRequestID": checkout_request_id
-    }
+    def fetch_access_token(self):
+        """
+        Request a new OAuth access token from the M-Pesa API
+        
+        Returns:
+            tuple: (access_token, expires_in) or (None, None) if the request failed
+        """
+        try:
+            response = self._request(
+                'GET', self.token_url, idempotent=True,
+                auth=HTTPBasicAuth(self.consumer_key, self.consumer_secret)
+            )
+            response.raise_for_status()
+            result = response.json()
+            return result.get("access_token"), int(result.get("expires_in", 3599))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Error getting access token: {e}")
+            return None, None
     
-    try:
-        response = requests.post(QUERY_URL, json=payload, headers=headers)
+    def get_access_token(self):
+        """Get an OAuth access token, reusing the cached token when possible"""
+        return self.tokens.get_token()
+    
+    def initiate_stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        """
+        Initiate an STK Push request to the customer's phone
+        
+        Args:
+            phone_number (str): Phone number in format 254XXXXXXXXX
+            amount (int): Amount to pay
+            account_reference (str): Payment reference e.g. "Order 123"
+            transaction_desc (str): Description of the transaction
+            callback_url (str): URL to receive payment notification
+            
+        Returns:
+            dict: Response from the M-Pesa API
+        """
+        timestamp = get_timestamp()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": generate_password(self.shortcode, self.passkey, timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount,
+            "PartyA": phone_number,
+            "PartyB": self.shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": transaction_desc
+        }
+        
+        try:
+            return self._post_json(self.stk_push_url, payload, idempotent=False)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error initiating STK push: {e}")
+            return {"error": str(e)}
+    
+    def query_stk_status(self, checkout_request_id):
+        """
+        Query the status of an STK Push request
+        
+        Args:
+            checkout_request_id (str): The CheckoutRequestID from the STK Push response
+            
+        Returns:
+            dict: Response from the M-Pesa API
+        """
+        timestamp = get_timestamp()
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": generate_password(self.shortcode, self.passkey, timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+        
+        try:
+            return self._post_json(self.query_url, payload, idempotent=True)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error querying STK status: {e}")
+            return {"error": str(e)}
+    
+    def _post_json(self, url, payload, idempotent):
+        access_token = self.get_access_token()
+        if not access_token:
+            return {"error": "Could not get access token"}
+        
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        response = self._request('POST', url, idempotent=idempotent, json=payload, headers=headers)
+        if response.status_code == 401:
+            # The token was revoked or expired early, fetch a new one next time
+            self.tokens.invalidate()
         return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error querying STK status: {e}")
-        return {"error": str(e)}
+    
+    def _request(self, method, url, idempotent=False, **kwargs):
+        attempts = self.max_retries + 1 if idempotent else 1
+        
+        for attempt in range(attempts):
+            is_last_attempt = attempt == attempts - 1
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if is_last_attempt:
+                    raise
+                logger.warning(f"Daraja request to {url} failed ({e}), retrying")
+            else:
+                if is_last_attempt or response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                logger.warning(f"Daraja request to {url} returned {response.status_code}, retrying")
+            
+            time.sleep(self._backoff_delay(attempt))
+    
+    def _backoff_delay(self, attempt):
+        # Exponential backoff with full jitter so retries from many workers spread out
+        return random.uniform(0, self.retry_backoff * (2 ** attempt))
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide Daraja client, creating it on first use"""
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = DarajaClient()
+    return _default_client
+
+
+def get_access_token():
+    """Get an OAuth access token for the M-Pesa API, reusing the cached token when possible"""
+    return get_client().get_access_token()
+
+
+def initiate_stk_push(phone_number, amount, account_reference, transaction_desc, callback_url):
+    """Initiate an STK Push request using the shared Daraja client"""
+    return get_client().initiate_stk_push(
+        phone_number=phone_number,
+        amount=amount,
+        account_reference=account_reference,
+        transaction_desc=transaction_desc,
+        callback_url=callback_url
+    )
+
+
+def query_stk_status(checkout_request_id):
+    """Query the status of an STK Push request using the shared Daraja client"""
+    return get_client().query_stk_status(checkout_request_id)
 
 
 def process_callback(callback_data):
@@ -152,46 +437,7 @@ def process_callback(callback_data):
         dict: Processed payment information
     """
     try:
-        result_code = callback_data.get("Body", {}).get("stkCallback", {}).get("ResultCode")
-        
-        # Get callback metadata
-        if result_code == 0:  # Successful payment
-            callback_metadata = callback_data.get("Body", {}).get("stkCallback", {}).get("CallbackMetadata", {}).get("Item", [])
-            
-            payment_info = {
-                "result_code": result_code,
-                "result_desc": callback_data.get("Body", {}).get("stkCallback", {}).get("ResultDesc"),
-                "checkout_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("CheckoutRequestID"),
-                "merchant_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("MerchantRequestID"),
-                "amount": None,
-                "mpesa_receipt_number": None,
-                "transaction_date": None,
-                "phone_number": None
-            }
-            
-            # Extract metadata values
-            for item in callback_metadata:
-                name = item.get("Name")
-                value = item.get("Value")
-                
-                if name == "Amount":
-                    payment_info["amount"] = value
-                elif name == "MpesaReceiptNumber":
-                    payment_info["mpesa_receipt_number"] = value
-                elif name == "TransactionDate":
-                    payment_info["transaction_date"] = value
-                elif name == "PhoneNumber":
-                    payment_info["phone_number"] = value
-            
-            return payment_info
-        else:
-            # Failed payment
-            return {
-                "result_code": result_code,
-                "result_desc": callback_data.get("Body", {}).get("stkCallback", {}).get("ResultDesc"),
-                "checkout_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("CheckoutRequestID"),
-                "merchant_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("MerchantRequestID")
-            }
-    except Exception as e:
+        return parse_stk_callback(callback_data).as_dict()
+    except CallbackParseError as e:
         logger.error(f"Error processing callback: {e}")
         return {"error": str(e)}
@@ -0,0 +1,85 @@
+import json
+import timeit
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from payment.callback_parser import parse_stk_callback
+from payment.daraja import process_callback
+
+SAMPLES_PATH = Path(__file__).resolve().parents[2] / 'samples' / 'stk_callbacks.json'
+
+
+def legacy_process_callback(callback_data):
+    """process_callback as it was before the compiled parser, kept for comparison"""
+    try:
+        result_code = callback_data.get("Body", {}).get("stkCallback", {}).get("ResultCode")
+        
+        if result_code == 0:
+            callback_metadata = callback_data.get("Body", {}).get("stkCallback", {}).get("CallbackMetadata", {}).get("Item", [])
+            
+            payment_info = {
+                "result_code": result_code,
+                "result_desc": callback_data.get("Body", {}).get("stkCallback", {}).get("ResultDesc"),
+                "checkout_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("CheckoutRequestID"),
+                "merchant_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("MerchantRequestID"),
+                "amount": None,
+                "mpesa_receipt_number": None,
+                "transaction_date": None,
+                "phone_number": None
+            }
+            
+            for item in callback_metadata:
+                name = item.get("Name")
+                value = item.get("Value")
+                
+                if name == "Amount":
+                    payment_info["amount"] = value
+                elif name == "MpesaReceiptNumber":
+                    payment_info["mpesa_receipt_number"] = value
+                elif name == "TransactionDate":
+                    payment_info["transaction_date"] = value
+                elif name == "PhoneNumber":
+                    payment_info["phone_number"] = value
+            
+            return payment_info
+        else:
+            return {
+                "result_code": result_code,
+                "result_desc": callback_data.get("Body", {}).get("stkCallback", {}).get("ResultDesc"),
+                "checkout_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("CheckoutRequestID"),
+                "merchant_request_id": callback_data.get("Body", {}).get("stkCallback", {}).get("MerchantRequestID")
+            }
+    except Exception as e:
+        return {"error": str(e)}
+
+
+class Command(BaseCommand):
+    help = 'Compare the STK callback parser against the previous process_callback implementation'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', default=str(SAMPLES_PATH),
+                            help='JSON file containing a list of recorded callback payloads')
+        parser.add_argument('--number', type=int, default=20000,
+                            help='Passes over the corpus per measurement')
+    
+    def handle(self, *args, **options):
+        with open(options['samples']) as f:
+            corpus = json.load(f)
+        
+        for payload in corpus:
+            if process_callback(payload) != legacy_process_callback(payload):
+                self.stderr.write(f"Output differs for {payload['Body']['stkCallback']['CheckoutRequestID']}")
+        
+        candidates = [
+            ('legacy process_callback', legacy_process_callback),
+            ('parse_stk_callback', parse_stk_callback),
+            ('process_callback', process_callback),
+        ]
+        self.stdout.write(f"{len(corpus)} payloads x {options['number']} passes")
+        for name, func in candidates:
+            seconds = min(timeit.repeat(
+                lambda: [func(payload) for payload in corpus],
+                number=options['number'],
+                repeat=5
+            ))
+            per_call = seconds / (options['number'] * len(corpus)) * 1e9
+            self.stdout.write(f"{name:<25} {per_call:8.0f} ns/callback")
@@ -0,0 +1,80 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from payment.models import MpesaTransaction
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark callback lookups by CheckoutRequestID and the pending-expiry scan as the '
+        'M-Pesa transaction table grows. Rows are inserted inside a transaction that is rolled back.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                            help='Table sizes to measure at')
+        parser.add_argument('--lookups', type=int, default=1000,
+                            help='Number of lookups timed at each size')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Rows inserted per bulk_create')
+    
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'rows':>10} {'lookup (us)':>12} {'expiry scan (us)':>17}")
+        
+        try:
+            with transaction.atomic():
+                checkout_ids = []
+                for size in sorted(options['sizes']):
+                    self.grow_table(checkout_ids, size, options['chunk_size'])
+                    lookup = self.time_lookups(checkout_ids, options['lookups'])
+                    scan = self.time_expiry_scan(options['lookups'] // 10 or 1)
+                    self.stdout.write(f"{size:>10} {lookup:>12.1f} {scan:>17.1f}")
+                
+                self.stdout.write('')
+                self.stdout.write(MpesaTransaction.objects.filter(checkout_request_id=checkout_ids[0]).explain())
+                raise Rollback
+        except Rollback:
+            pass
+    
+    def grow_table(self, checkout_ids, size, chunk_size):
+        now = timezone.now()
+        while len(checkout_ids) < size:
+            rows = []
+            for _ in range(min(chunk_size, size - len(checkout_ids))):
+                checkout_id = f"ws_CO_{uuid.uuid4().hex}"
+                checkout_ids.append(checkout_id)
+                rows.append(MpesaTransaction(
+                    phone_number='254700000000',
+                    amount=100,
+                    reference='Benchmark',
+                    description='Benchmark',
+                    checkout_request_id=checkout_id,
+                    # Mostly settled transactions with a small tail of pending ones, like production
+                    status='PENDING' if random.random() < 0.01 else 'COMPLETED',
+                    created_at=now - timedelta(minutes=random.randint(0, 60 * 24 * 90))
+                ))
+            MpesaTransaction.objects.bulk_create(rows, batch_size=chunk_size)
+    
+    def time_lookups(self, checkout_ids, count):
+        sample = random.sample(checkout_ids, min(count, len(checkout_ids)))
+        start = time.perf_counter()
+        for checkout_id in sample:
+            MpesaTransaction.objects.get(checkout_request_id=checkout_id)
+        return (time.perf_counter() - start) / len(sample) * 1e6
+    
+    def time_expiry_scan(self, count):
+        expiry_time = timezone.now() - timedelta(hours=1)
+        start = time.perf_counter()
+        for _ in range(count):
+            list(MpesaTransaction.objects.filter(
+                status='PENDING', created_at__lt=expiry_time
+            ).order_by('created_at').values_list('id', flat=True)[:500])
+        return (time.perf_counter() - start) / count * 1e6
@@ -0,0 +1,216 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+
+from merchandise.models import Order
+from payment import daraja
+from payment.simulator import DarajaSimulator
+
+BENCH_EMAIL = 'pay-with-mpesa-bench@jkuelc.local'
+LEGACY_PREFIX = '/bench/legacy-pay/'
+
+
+class PooledWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI server that handles requests on a fixed pool of worker threads, like gunicorn --threads"""
+    
+    def __init__(self, *args, workers=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+    
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+    
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class OccupancyMeter:
+    """
+    WSGI middleware recording how long successful (2xx) requests hold a worker
+    thread, and the peak number of busy workers
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.peak = 0
+        self.worker_seconds = 0.0
+    
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        statuses = []
+        
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+        
+        with self.lock:
+            self.busy += 1
+            self.peak = max(self.peak, self.busy)
+        try:
+            return self.app(environ, recording_start_response)
+        finally:
+            with self.lock:
+                self.busy -= 1
+                if statuses and statuses[-1].startswith('2'):
+                    self.worker_seconds += time.perf_counter() - started
+    
+    def reset(self):
+        with self.lock:
+            self.peak = self.busy
+            self.worker_seconds = 0.0
+
+
+class LegacyPayWithMpesa:
+    """
+    Reproduces the old pay_with_mpesa behaviour: the worker handling the request
+    posts to our own initiate_order_payment endpoint and waits for another worker
+    to answer it
+    """
+    
+    def __init__(self, app, hop_timeout):
+        self.app = app
+        self.hop_timeout = hop_timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=100))
+    
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(LEGACY_PREFIX):
+            return self.app(environ, start_response)
+        
+        order_id = path[len(LEGACY_PREFIX):].strip('/')
+        url = f"http://{environ['HTTP_HOST']}{reverse('mpesatransaction-initiate-order-payment')}"
+        try:
+            response = self.session.post(url, json={
+                'order_id': order_id,
+                'phone_number': environ.get('HTTP_X_PHONE_NUMBER', '')
+            }, headers={'Authorization': environ.get('HTTP_AUTHORIZATION', '')}, timeout=self.hop_timeout)
+            status, body = f"{response.status_code} {response.reason}", response.content
+        except requests.RequestException:
+            status, body = '504 Gateway Timeout', b'{"error": "Internal payment request timed out"}'
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark OrderViewSet.pay_with_mpesa against the old self-HTTP hop. Serves the API '
+        'in-process on a fixed pool of worker threads with a local Daraja simulator, and reports '
+        'latency, failures and worker occupancy for both paths.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=100,
+                            help='Number of order payments to initiate per mode')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of server worker threads')
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help='Number of concurrent clients')
+        parser.add_argument('--daraja-latency', type=float, default=0.2,
+                            help='Seconds the simulator takes to answer each Daraja call')
+        parser.add_argument('--hop-timeout', type=float, default=10,
+                            help='Timeout of the legacy internal request, in seconds')
+        parser.add_argument('--phone-number', default='254708374149',
+                            help='Phone number sent with each payment')
+    
+    def handle(self, *args, **options):
+        simulator = DarajaSimulator(port=0, api_latency=options['daraja_latency'],
+                                    callback_latency=3600, send_callback=lambda url, payload: None).start()
+        client = daraja.DarajaClient(base_url=simulator.url, shortcode='174379', passkey='passkey')
+        client.tokens.invalidate()
+        previous_client, daraja._default_client = daraja._default_client, client
+        
+        meter = OccupancyMeter(LegacyPayWithMpesa(WSGIHandler(), options['hop_timeout']))
+        server = make_server('127.0.0.1', 0, meter,
+                             server_class=lambda *a, **kw: PooledWSGIServer(*a, workers=options['workers'], **kw),
+                             handler_class=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        
+        user, _ = get_user_model().objects.get_or_create(
+            email=BENCH_EMAIL, defaults={'name': 'pay_with_mpesa Benchmark'}
+        )
+        token, _ = Token.objects.get_or_create(user=user)
+        
+        self.stdout.write(
+            f"{options['payments']} payments, {options['concurrency']} clients, {options['workers']} workers, "
+            f"{options['daraja_latency'] * 1000:.0f} ms Daraja latency"
+        )
+        self.stdout.write(
+            f"{'mode':<10} {'ok':>5} {'errors':>7} {'p50 (ms)':>9} {'p95 (ms)':>9} {'ok/s':>7} "
+            f"{'worker-s/ok':>12} {'peak busy':>10}"
+        )
+        try:
+            for mode in ('self-http', 'in-process'):
+                self.run_mode(mode, base_url, user, token, meter, options)
+        finally:
+            server.shutdown()
+            server.server_close()
+            daraja._default_client = previous_client
+            client.close()
+            simulator.stop()
+            # Cascades to the benchmark orders, payments and transactions
+            user.delete()
+    
+    def run_mode(self, mode, base_url, user, token, meter, options):
+        orders = Order.objects.bulk_create(
+            [Order(user=user, total_amount=100) for _ in range(options['payments'])]
+        )
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_maxsize=options['concurrency']))
+        session.headers['Authorization'] = f"Token {token.key}"
+        
+        def pay(order):
+            started = time.perf_counter()
+            try:
+                if mode == 'self-http':
+                    response = session.post(f"{base_url}{LEGACY_PREFIX}{order.id}/",
+                                            headers={'X-Phone-Number': options['phone_number']}, timeout=60)
+                else:
+                    response = session.post(f"{base_url}/api/merchandise/orders/{order.id}/pay_with_mpesa/",
+                                            json={'phone_number': options['phone_number']}, timeout=60)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            return ok, time.perf_counter() - started
+        
+        meter.reset()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(pay, orders))
+        elapsed = time.perf_counter() - started
+        session.close()
+        
+        # Latency and occupancy are measured over successful payments only
+        latencies = sorted(latency for ok, latency in results if ok)
+        accepted = len(latencies)
+        errors = len(results) - accepted
+        style = self.style.ERROR if errors else self.style.SUCCESS
+        if not accepted:
+            self.stdout.write(style(f"{mode:<10} {accepted:>5} {errors:>7}   (every request failed)"))
+            return
+        
+        p95 = latencies[min(accepted - 1, int(accepted * 0.95))]
+        self.stdout.write(style(
+            f"{mode:<10} {accepted:>5} {errors:>7} {statistics.median(latencies) * 1000:>9.0f} {p95 * 1000:>9.0f} "
+            f"{accepted / elapsed:>7.1f} {meter.worker_seconds / accepted:>12.3f} {meter.peak:>10}"
+        ))
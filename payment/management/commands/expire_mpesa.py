@@ -0,0 +1,27 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from payment.utils import expire_pending_transactions
+
+
+class Command(BaseCommand):
+    help = 'Mark pending M-Pesa transactions older than the expiry window as failed'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of transactions expired per database transaction')
+        parser.add_argument('--max-age', type=int, default=60,
+                            help='Minutes after which a pending transaction is considered expired')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many transactions would be expired')
+    
+    def handle(self, *args, **options):
+        count = expire_pending_transactions(
+            batch_size=options['batch_size'],
+            max_age=timedelta(minutes=options['max_age']),
+            dry_run=options['dry_run']
+        )
+        
+        if options['dry_run']:
+            self.stdout.write(f"{count} pending M-Pesa transactions would be expired")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Expired {count} pending M-Pesa transactions"))
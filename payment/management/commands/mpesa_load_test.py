@@ -0,0 +1,106 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from rest_framework.authtoken.models import Token
+
+from merchandise.models import Order
+from payment.models import MpesaTransaction
+
+LOAD_TEST_EMAIL = 'mpesa-load-test@jkuelc.local'
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive M-Pesa order payments end to end against a running server and report payments/sec. '
+        "Start the server with MPESA_ENVIRONMENT = 'simulator' and MPESA_CALLBACK_URL pointing at its "
+        'mpesa/callback/ endpoint, and run_daraja_simulator alongside it.'
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000',
+                            help='Base URL of the running API server')
+        parser.add_argument('--payments', type=int, default=200,
+                            help='Number of order payments to initiate')
+        parser.add_argument('--concurrency', type=int, default=20,
+                            help='Number of concurrent clients')
+        parser.add_argument('--phone-number', default='254708374149',
+                            help='Phone number sent with each payment')
+        parser.add_argument('--use-async', action='store_true',
+                            help='Use the async initiation endpoint instead of the DRF action')
+        parser.add_argument('--timeout', type=int, default=120,
+                            help='Seconds to wait for callbacks to settle all transactions')
+        parser.add_argument('--keep-data', action='store_true',
+                            help='Keep the load test user, orders and payments afterwards')
+    
+    def handle(self, *args, **options):
+        user, _ = get_user_model().objects.get_or_create(
+            email=LOAD_TEST_EMAIL, defaults={'name': 'M-Pesa Load Test'}
+        )
+        token, _ = Token.objects.get_or_create(user=user)
+        orders = Order.objects.bulk_create(
+            [Order(user=user, total_amount=100) for _ in range(options['payments'])]
+        )
+        order_ids = [order.id for order in orders]
+        
+        if options['use_async']:
+            path = '/api/payment/mpesa/initiate-order-payment-async/'
+        else:
+            path = '/api/payment/mpesa/initiate_order_payment/'
+        url = options['base_url'].rstrip('/') + path
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=options['concurrency'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Authorization'] = f"Token {token.key}"
+        
+        def initiate(order_id):
+            started = time.perf_counter()
+            try:
+                response = session.post(url, json={
+                    'order_id': order_id,
+                    'phone_number': options['phone_number']
+                }, timeout=60)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            return ok, time.perf_counter() - started
+        
+        self.stdout.write(f"Initiating {len(order_ids)} payments against {url}")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            results = list(executor.map(initiate, order_ids))
+        initiated_in = time.perf_counter() - started
+        
+        latencies = sorted(latency for _, latency in results)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        accepted = sum(1 for ok, _ in results if ok)
+        self.stdout.write(
+            f"Initiated {accepted}/{len(results)} in {initiated_in:.2f}s "
+            f"({len(results) / initiated_in:.1f} req/s, p50 {statistics.median(latencies) * 1000:.0f} ms, "
+            f"p95 {p95 * 1000:.0f} ms)"
+        )
+        
+        # Wait for the simulator callbacks to settle every accepted transaction
+        transactions = MpesaTransaction.objects.filter(payment__order_id__in=order_ids)
+        deadline = time.monotonic() + options['timeout']
+        while time.monotonic() < deadline:
+            if not transactions.filter(status='PENDING').exists():
+                break
+            time.sleep(0.5)
+        elapsed = time.perf_counter() - started
+        
+        counts = dict(transactions.values_list('status').annotate(n=Count('id')).order_by())
+        settled = sum(n for status, n in counts.items() if status != 'PENDING')
+        self.stdout.write(self.style.SUCCESS(
+            f"Settled {settled} payments in {elapsed:.2f}s ({settled / elapsed:.1f} payments/s end to end): {counts}"
+        ))
+        
+        if not options['keep_data']:
+            # Cascades to the load test orders, payments, transactions and notifications
+            user.delete()
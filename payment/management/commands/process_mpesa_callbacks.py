@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from payment.callback_queue import drain_callback_queue, purge_processed_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Apply M-Pesa callbacks queued by the callback endpoint in queue mode'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of callbacks processed per database transaction')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, draining the queue every --interval seconds')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between runs when --loop is given')
+        parser.add_argument('--purge-days', type=int, default=7,
+                            help='Delete processed callbacks older than this many days')
+    
+    def handle(self, *args, **options):
+        purged = purge_processed_callbacks(older_than=timedelta(days=options['purge_days']))
+        if purged:
+            self.stdout.write(f"Purged {purged} processed callbacks")
+        
+        while True:
+            stats = drain_callback_queue(batch_size=options['batch_size'])
+            if stats['processed'] or stats['failed'] or not options['loop']:
+                self.stdout.write(self.style.SUCCESS(
+                    f"Processed {stats['processed']} callbacks, {stats['failed']} failed"
+                ))
+            
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from payment.reconcile import (
+    reconcile_pending_transactions, MPESA_RECONCILE_BATCH_SIZE,
+    MPESA_RECONCILE_CONCURRENCY, MPESA_RECONCILE_MIN_AGE
+)
+
+
+class Command(BaseCommand):
+    help = 'Query M-Pesa for pending STK push transactions and apply the results'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=MPESA_RECONCILE_BATCH_SIZE,
+                            help='Number of transactions queried per batch')
+        parser.add_argument('--concurrency', type=int, default=MPESA_RECONCILE_CONCURRENCY,
+                            help='Maximum number of concurrent Daraja queries')
+        parser.add_argument('--min-age', type=int, default=MPESA_RECONCILE_MIN_AGE,
+                            help='Only reconcile transactions pending for at least this many seconds')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running, reconciling every --interval seconds')
+        parser.add_argument('--interval', type=int, default=30,
+                            help='Seconds to wait between runs when --loop is given')
+    
+    def handle(self, *args, **options):
+        while True:
+            stats = reconcile_pending_transactions(
+                batch_size=options['batch_size'],
+                concurrency=options['concurrency'],
+                min_age=options['min_age']
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f"Checked {stats['checked']} transactions: {stats['COMPLETED']} completed, "
+                f"{stats['FAILED']} failed, {stats['CANCELLED']} cancelled, {stats['pending']} still pending"
+            ))
+            
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
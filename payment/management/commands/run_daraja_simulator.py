@@ -0,0 +1,56 @@
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from payment.simulator import DarajaSimulator
+
+
+class Command(BaseCommand):
+    help = "Run a local Daraja API simulator for offline load testing (use with MPESA_ENVIRONMENT = 'simulator')"
+    
+    def add_arguments(self, parser):
+        default = urlsplit(getattr(settings, 'MPESA_SIMULATOR_URL', 'http://127.0.0.1:8089'))
+        parser.add_argument('--host', default=default.hostname or '127.0.0.1',
+                            help='Interface to bind')
+        parser.add_argument('--port', type=int, default=default.port or 8089,
+                            help='Port to bind')
+        parser.add_argument('--callback-latency', type=float, default=1.0,
+                            help='Seconds between accepting an STK push and sending its callback')
+        parser.add_argument('--callback-jitter', type=float, default=0.0,
+                            help='Extra random callback delay in seconds')
+        parser.add_argument('--api-latency', type=float, default=0.0,
+                            help='Seconds to wait before answering each API request')
+        parser.add_argument('--failure-rate', type=float, default=0.0,
+                            help='Fraction of STK pushes resolved as failed')
+        parser.add_argument('--cancel-rate', type=float, default=0.0,
+                            help='Fraction of STK pushes resolved as cancelled by the user')
+        parser.add_argument('--callback-workers', type=int, default=10,
+                            help='Number of threads delivering callbacks')
+        parser.add_argument('--token-ttl', type=int, default=3599,
+                            help='Lifetime of issued access tokens in seconds')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for the outcome generator, for repeatable runs')
+    
+    def handle(self, *args, **options):
+        if options['failure_rate'] + options['cancel_rate'] > 1:
+            self.stderr.write(self.style.ERROR('--failure-rate and --cancel-rate must add up to at most 1'))
+            return
+        
+        simulator = DarajaSimulator(
+            host=options['host'],
+            port=options['port'],
+            token_ttl=options['token_ttl'],
+            api_latency=options['api_latency'],
+            callback_latency=options['callback_latency'],
+            callback_jitter=options['callback_jitter'],
+            failure_rate=options['failure_rate'],
+            cancel_rate=options['cancel_rate'],
+            callback_workers=options['callback_workers'],
+            seed=options['seed']
+        )
+        self.stdout.write(self.style.SUCCESS(f"Daraja simulator listening on {simulator.url}"))
+        
+        try:
+            simulator.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Simulator stats: {simulator.stats()}")
@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-16 21:01
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, Value, When
+
+
+def clear_duplicate_checkout_request_ids(apps, schema_editor):
+    """
+    Make checkout_request_id unique before the constraint is added
+
+    Empty strings become NULL. Where several transactions share an ID, a finished
+    one (else the earliest) keeps it and the others are set to NULL.
+    """
+    MpesaTransaction = apps.get_model('payment', 'MpesaTransaction')
+    MpesaTransaction.objects.filter(checkout_request_id='').update(checkout_request_id=None)
+
+    duplicated = (
+        MpesaTransaction.objects.exclude(checkout_request_id=None)
+        .values('checkout_request_id')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .values_list('checkout_request_id', flat=True)
+    )
+    for checkout_request_id in list(duplicated):
+        ids = list(
+            MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id)
+            .order_by(
+                Case(When(status='PENDING', then=Value(1)), default=Value(0), output_field=IntegerField()),
+                'id'
+            )
+            .values_list('id', flat=True)
+        )
+        MpesaTransaction.objects.filter(id__in=ids[1:]).update(checkout_request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('merchandise', '0002_initial'),
+        ('payment', '0004_mpesacallback'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_checkout_request_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['status', 'created_at'], name='payment_mpe_status_a97604_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['order', 'created_at'], name='payment_pay_order_i_67ce66_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'created_at'], name='payment_pay_user_id_b9fc38_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.6 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0005_mpesa_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['created_at', 'id'], name='payment_mpe_created_bd551c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['created_at', 'id'], name='payment_pay_created_a0fd38_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.0.6 on 2026-10-17 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payment', '0006_created_at_id_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyPaymentTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('payment_type', models.CharField(choices=[('MEMBERSHIP', 'Membership'), ('ORDER', 'Order'), ('DONATION', 'Donation')], max_length=20)),
+                ('payment_method', models.CharField(blank=True, default='', max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Daily Payment Total',
+                'verbose_name_plural': 'Daily Payment Totals',
+                'ordering': ['-date'],
+                'constraints': [models.UniqueConstraint(fields=('date', 'payment_type', 'payment_method'), name='unique_daily_payment_total')],
+            },
+        ),
+    ]
@@ -39,11 +39,41 @@ class Payment(models.Model):
         verbose_name = 'Payment'
         verbose_name_plural = 'Payments'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['order', 'created_at']),
+            models.Index(fields=['user', 'created_at']),
+            # Keyset pagination of payment lists
+            models.Index(fields=['created_at', 'id']),
+        ]
     
     def __str__(self):
         return f"{self.payment_type} - {self.amount} KES - {self.status}"
 
 
+class DailyPaymentTotal(models.Model):
+    """
+    Number and sum of payments completed on one day, per payment type and method.
+    Maintained by merchandise.analytics; rebuild with the backfill_sales_rollups command.
+    """
+    date = models.DateField()
+    payment_type = models.CharField(max_length=20, choices=Payment.PAYMENT_TYPE_CHOICES)
+    payment_method = models.CharField(max_length=20, blank=True, default='')  # '' when not recorded
+    count = models.PositiveIntegerField(default=0)
+    amount = models.PositiveIntegerField(default=0)  # KES
+    
+    class Meta:
+        verbose_name = 'Daily Payment Total'
+        verbose_name_plural = 'Daily Payment Totals'
+        ordering = ['-date']
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'payment_type', 'payment_method'],
+                                    name='unique_daily_payment_total'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} - {self.payment_type}/{self.payment_method or 'unknown'}: {self.amount} KES"
+
+
 class MembershipPayment(models.Model):
     payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name='membership_payment')
     membership_period = models.PositiveIntegerField(default=12)  # In months
@@ -118,7 +148,7 @@ class MpesaTransaction(models.Model):
     reference = models.CharField(max_length=100)  # Account reference
     description = models.CharField(max_length=255)
     merchant_request_id = models.CharField(max_length=100, null=True, blank=True)
-    checkout_request_id = models.CharField(max_length=100, null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
     mpesa_receipt_number = models.CharField(max_length=50, null=True, blank=True)
     transaction_date = models.CharField(max_length=20, null=True, blank=True)  # Format from M-Pesa: YYYYMMDDHHmmss
     result_code = models.CharField(max_length=10, null=True, blank=True)
@@ -133,7 +163,34 @@ class MpesaTransaction(models.Model):
         verbose_name = 'M-Pesa Transaction'
         verbose_name_plural = 'M-Pesa Transactions'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            # Keyset pagination of transaction lists
+            models.Index(fields=['created_at', 'id']),
+        ]
     
     def __str__(self):
         return f"M-Pesa Transaction - {self.amount} KES - {self.status}"
 
+
+
+class MpesaCallback(models.Model):
+    """Raw M-Pesa callback payload queued for out-of-band processing"""
+    
+    payload = models.JSONField()
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    
+    class Meta:
+        verbose_name = 'M-Pesa Callback'
+        verbose_name_plural = 'M-Pesa Callbacks'
+        ordering = ['received_at']
+        indexes = [
+            models.Index(fields=['processed_at', 'id']),
+        ]
+    
+    def __str__(self):
+        state = 'processed' if self.processed_at else 'queued'
+        return f"M-Pesa Callback #{self.id} - {state}"
@@ -6,10 +6,7 @@ from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.db import transaction
-from django.urls import reverse
 from django.conf import settings
-from django.utils import timezone
 
 from .models import Payment, MpesaTransaction
 from merchandise.models import Order
@@ -18,10 +15,17 @@ from .serializers import (
     MpesaTransactionSerializer, MpesaTransactionCreateSerializer,
     MpesaTransactionDetailSerializer
 )
-from .daraja import initiate_stk_push, query_stk_status, process_callback
-from .utils import update_transaction_status
+from .daraja import query_stk_status
+from .utils import apply_stk_query_result, ingest_callback
+from .callback_queue import enqueue_callback
+from .services import (
+    PaymentInitiationError, get_callback_url, initiate_order_payment, initiation_response
+)
+from jkuelc_backend.pagination import CreatedAtCursorPagination
 from users.permissions import IsAdminOrManager, IsAdminOrManagerOrOwner
 
+logger = logging.getLogger('payment.mpesa_views')
+
 
 class MpesaTransactionViewSet(viewsets.ModelViewSet):
     """
@@ -29,6 +33,7 @@ class MpesaTransactionViewSet(viewsets.ModelViewSet):
     """
     queryset = MpesaTransaction.objects.all().order_by('-created_at')
     serializer_class = MpesaTransactionSerializer
+    pagination_class = CreatedAtCursorPagination
     
     def get_permissions(self):
         if self.action in ['update', 'partial_update', 'destroy']:
@@ -75,94 +80,26 @@ class MpesaTransactionViewSet(viewsets.ModelViewSet):
             )
         
         try:
-            # Get the order
             order = Order.objects.get(id=order_id, user=request.user)
-            
-            # Check if order is already paid
-            if order.status != 'PENDING':
-                return Response(
-                    {"error": f"Order is already in '{order.status}' status"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            # Create a payment record
-            payment_data = {
-                'user': request.user,
-                'amount': order.total_amount,
-                'payment_type': 'ORDER',
-                'payment_method': 'MPESA',
-                'order': order
-            }
-            payment = Payment.objects.create(**payment_data)
-            
-            # Create M-Pesa transaction record
-            mpesa_data = {
-                'payment': payment,
-                'phone_number': phone_number,
-                'amount': order.total_amount,
-                'reference': f"Order-{order.id}",
-                'description': f"Payment for JKUELC Order #{order.id}"
-            }
-            mpesa_transaction = MpesaTransaction.objects.create(**mpesa_data)
-            
-            # Construct callback URL - use configured one if available, otherwise build from request
-            callback_url = settings.MPESA_CALLBACK_URL
-            if not callback_url:
-                # Build callback URL from request (only works if server is publicly accessible)
-                host = request.get_host()
-                protocol = 'https' if request.is_secure() else 'http'
-                callback_url = f"{protocol}://{host}{reverse('mpesa-callback')}"
-                
-            # Log the callback URL being used
-            logger.info(f"Using M-Pesa callback URL: {callback_url}")
-            
-            # Initiate STK Push
-            stk_response = initiate_stk_push(
-                phone_number=phone_number,
-                amount=order.total_amount,
-                account_reference=f"Order-{order.id}",
-                transaction_desc=f"Payment for JKUELC Order #{order.id}",
-                callback_url=callback_url
-            )
-            
-            # Update transaction with response data
-            if 'error' not in stk_response:
-                mpesa_transaction.merchant_request_id = stk_response.get('MerchantRequestID')
-                mpesa_transaction.checkout_request_id = stk_response.get('CheckoutRequestID')
-                mpesa_transaction.raw_response = stk_response
-                mpesa_transaction.save()
-                
-                return Response({
-                    'message': 'Payment initiated. Please check your phone to complete the transaction.',
-                    'transaction_id': mpesa_transaction.id,
-                    'checkout_request_id': mpesa_transaction.checkout_request_id
-                })
-            else:
-                # Payment initiation failed
-                mpesa_transaction.status = 'FAILED'
-                mpesa_transaction.result_description = stk_response.get('error')
-                mpesa_transaction.raw_response = stk_response
-                mpesa_transaction.save()
-                
-                # Update payment status
-                payment.status = 'FAILED'
-                payment.save()
-                
-                return Response(
-                    {"error": "Failed to initiate payment", "details": stk_response.get('error')},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-                
         except Order.DoesNotExist:
             return Response(
                 {"error": "Order not found or you don't have permission to pay for it"},
                 status=status.HTTP_404_NOT_FOUND
             )
+        
+        try:
+            mpesa_transaction = initiate_order_payment(
+                order, request.user, phone_number, callback_url=get_callback_url(request)
+            )
+        except PaymentInitiationError as e:
+            return Response(e.as_dict(), status=e.status_code)
         except Exception as e:
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        
+        return Response(initiation_response(mpesa_transaction))
     
     @action(detail=True, methods=['get'])
     def check_status(self, request, pk=None):
@@ -185,36 +122,12 @@ class MpesaTransactionViewSet(viewsets.ModelViewSet):
             mpesa_transaction.raw_response = status_response
             
             if 'error' not in status_response:
-                result_code = status_response.get('ResultCode')
-                result_desc = status_response.get('ResultDesc')
-                
-                # Use utility function to update transaction status
-                if result_code == 0:
-                    update_transaction_status(
-                        mpesa_transaction=mpesa_transaction,
-                        status='COMPLETED',
-                        result_code=result_code,
-                        result_description=result_desc
-                    )
-                elif result_code == 1032:  # Request cancelled by user
-                    update_transaction_status(
-                        mpesa_transaction=mpesa_transaction,
-                        status='CANCELLED',
-                        result_code=result_code,
-                        result_description=result_desc
-                    )
-                else:
-                    update_transaction_status(
-                        mpesa_transaction=mpesa_transaction,
-                        status='FAILED',
-                        result_code=result_code,
-                        result_description=result_desc
-                    )
+                apply_stk_query_result(mpesa_transaction, status_response)
                 
                 return Response({
                     'status': mpesa_transaction.status,
-                    'result_code': result_code,
-                    'result_description': result_desc
+                    'result_code': status_response.get('ResultCode'),
+                    'result_description': status_response.get('ResultDesc')
                 })
             else:
                 return Response(
@@ -250,9 +163,9 @@ class MpesaTransactionViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_403_FORBIDDEN
                 )
             
-            # Get payment status
-            payments = Payment.objects.filter(order=order)
-            if not payments.exists():
+            # Get latest payment (served by the (order, created_at) index)
+            latest_payment = Payment.objects.filter(order=order).order_by('-created_at').first()
+            if latest_payment is None:
                 return Response({
                     'order_id': order_id,
                     'payment_status': 'NO_PAYMENT',
@@ -260,48 +173,11 @@ class MpesaTransactionViewSet(viewsets.ModelViewSet):
                     'message': 'No payment has been initiated for this order'
                 })
             
-            # Get latest payment
-            latest_payment = payments.order_by('-created_at').first()
-            
-            # Check if there's an M-Pesa transaction
+            # Check if there's an M-Pesa transaction. Pending transactions are resolved
+            # by the callback or the reconcile_mpesa worker, so only local state is read here
             try:
                 mpesa_transaction = MpesaTransaction.objects.get(payment=latest_payment)
                 
-                # If transaction is still pending and older than 2 minutes, check status
-                if mpesa_transaction.status == 'PENDING' and \
-                   (timezone.now() - mpesa_transaction.created_at).seconds > 120:
-                    try:
-                        # Check transaction status with M-Pesa
-                        status_response = query_stk_status(mpesa_transaction.checkout_request_id)
-                        
-                        if 'error' not in status_response:
-                            result_code = status_response.get('ResultCode')
-                            result_desc = status_response.get('ResultDesc')
-                            
-                            if result_code == 0:
-                                update_transaction_status(
-                                    mpesa_transaction=mpesa_transaction,
-                                    status='COMPLETED',
-                                    result_code=result_code,
-                                    result_description=result_desc
-                                )
-                            elif result_code == 1032:
-                                update_transaction_status(
-                                    mpesa_transaction=mpesa_transaction,
-                                    status='CANCELLED',
-                                    result_code=result_code,
-                                    result_description=result_desc
-                                )
-                            else:
-                                update_transaction_status(
-                                    mpesa_transaction=mpesa_transaction,
-                                    status='FAILED',
-                                    result_code=result_code,
-                                    result_description=result_desc
-                                )
-                    except Exception as e:
-                        logger.error(f"Error checking transaction status for order {order_id}: {e}")
-                
                 return Response({
                     'order_id': order_id,
                     'payment_id': latest_payment.id,
@@ -350,55 +226,24 @@ def mpesa_callback(request):
         callback_data = request.data
         logger.info(f"Received M-Pesa callback: {callback_data}")
         
-        # Process the callback data
-        payment_info = process_callback(callback_data)
-        
-        if 'error' not in payment_info:
-            checkout_request_id = payment_info.get('checkout_request_id')
-            
-            # Find the associated transaction
+        if getattr(settings, 'MPESA_CALLBACK_MODE', 'inline') == 'queue':
+            # Store the payload and acknowledge immediately; process_mpesa_callbacks applies it
             try:
-                mpesa_transaction = MpesaTransaction.objects.get(checkout_request_id=checkout_request_id)
-                
-                # Update transaction with callback data
-                if payment_info.get('result_code') == 0:
-                    # Transaction successful
-                    update_transaction_status(
-                        mpesa_transaction=mpesa_transaction,
-                        status='COMPLETED',
-                        receipt_number=payment_info.get('mpesa_receipt_number'),
-                        transaction_date=payment_info.get('transaction_date'),
-                        result_code=payment_info.get('result_code'),
-                        result_description=payment_info.get('result_desc')
-                    )
-                    logger.info(f"Successfully processed M-Pesa payment for transaction {checkout_request_id}")
-                else:
-                    # Transaction failed
-                    update_transaction_status(
-                        mpesa_transaction=mpesa_transaction,
-                        status='FAILED',
-                        result_code=payment_info.get('result_code'),
-                        result_description=payment_info.get('result_desc')
-                    )
-                    logger.warning(f"Failed M-Pesa payment for transaction {checkout_request_id}")
-                
-                # Store the full callback data
-                mpesa_transaction.raw_response = callback_data
-                mpesa_transaction.save(update_fields=['raw_response'])
-                
-                return Response({"ResultCode": 0, "ResultDesc": "Success"})
-            
-            except MpesaTransaction.DoesNotExist:
-                # If no transaction is found, still acknowledge receipt to M-Pesa
-                logger.warning(f"Received callback for unknown transaction: {checkout_request_id}")
-                return Response({"ResultCode": 0, "ResultDesc": "Success"})
+                enqueue_callback(callback_data)
+            except Exception as e:
+                # Nothing was stored, so ask M-Pesa to send the callback again
+                logger.error(f"Could not queue M-Pesa callback: {str(e)}")
+                return Response(
+                    {"ResultCode": 1, "ResultDesc": "Callback could not be stored"},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE
+                )
         else:
-            # Error processing callback data
-            logger.error(f"Error processing M-Pesa callback: {payment_info.get('error')}")
-            return Response({"ResultCode": 0, "ResultDesc": "Success"})
+            # Safaricom retries callbacks, so replays are acknowledged without being reapplied
+            ingest_callback(callback_data)
     
     except Exception as e:
         # Log the error but still acknowledge receipt to M-Pesa
         logger.error(f"Exception in M-Pesa callback: {str(e)}")
-        # Always return success to M-Pesa even if we have internal errors
-        return Response({"ResultCode": 0, "ResultDesc": "Success"})
+    
+    # Acknowledge processing errors too; a stored or replayed callback is not sent again
+    return Response({"ResultCode": 0, "ResultDesc": "Success"})
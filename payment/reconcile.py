@@ -0,0 +1,75 @@
+"""
+Background reconciliation of pending M-Pesa transactions.
+Pending STK pushes whose callback never arrived are queried against Daraja here, so that
+customer-facing endpoints only ever read local state.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+
+from .daraja import query_stk_status
+from .models import MpesaTransaction
+from .utils import apply_stk_query_result
+
+logger = logging.getLogger('payment.reconcile')
+
+MPESA_RECONCILE_MIN_AGE = getattr(settings, 'MPESA_RECONCILE_MIN_AGE', 120)  # Seconds
+MPESA_RECONCILE_BATCH_SIZE = getattr(settings, 'MPESA_RECONCILE_BATCH_SIZE', 100)
+MPESA_RECONCILE_CONCURRENCY = getattr(settings, 'MPESA_RECONCILE_CONCURRENCY', 5)
+
+
+def reconcile_pending_transactions(batch_size=MPESA_RECONCILE_BATCH_SIZE,
+                                   concurrency=MPESA_RECONCILE_CONCURRENCY,
+                                   min_age=MPESA_RECONCILE_MIN_AGE, query=query_stk_status):
+    """
+    Query Daraja for pending transactions and apply the results
+    
+    Transactions are scanned in batches ordered by primary key. Each batch is
+    queried with at most ``concurrency`` requests in flight, and the results are
+    applied on the calling thread through apply_stk_query_result, which moves each
+    transaction out of PENDING with transition_pending_transaction.
+    
+    Args:
+        batch_size: Number of transactions loaded and queried per batch
+        concurrency: Maximum number of concurrent Daraja queries
+        min_age: Only reconcile transactions pending for at least this many seconds
+        query: Function used to query a CheckoutRequestID (defaults to query_stk_status)
+    
+    Returns:
+        dict: Counts of checked transactions and of each resulting status
+    """
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    pending = MpesaTransaction.objects.filter(
+        status='PENDING',
+        checkout_request_id__isnull=False,
+        created_at__lte=cutoff
+    ).select_related('payment__order', 'payment__user').order_by('id')
+    
+    stats = {'checked': 0, 'COMPLETED': 0, 'FAILED': 0, 'CANCELLED': 0, 'pending': 0}
+    last_id = 0
+    
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='mpesa-reconcile') as executor:
+        while True:
+            batch = list(pending.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            
+            responses = executor.map(_safe_query, [query] * len(batch), [t.checkout_request_id for t in batch])
+            for mpesa_transaction, status_response in zip(batch, responses):
+                stats['checked'] += 1
+                new_status = apply_stk_query_result(mpesa_transaction, status_response)
+                stats[new_status or 'pending'] += 1
+    
+    logger.info(f"Reconciled pending M-Pesa transactions: {stats}")
+    return stats
+
+
+def _safe_query(query, checkout_request_id):
+    try:
+        return query(checkout_request_id)
+    except Exception as e:
+        logger.error(f"Error querying STK status for {checkout_request_id}: {e}")
+        return {"error": str(e)}
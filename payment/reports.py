@@ -0,0 +1,151 @@
+"""
+Finance reports of orders, payments and M-Pesa receipts.
+Each report is a single joined query read with ``iterator(chunk_size=...)`` and written
+out one row at a time, so a report over any date range streams in constant memory.
+"""
+import csv
+import tempfile
+from datetime import datetime, time, timedelta
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from merchandise.bulk import Echo
+from merchandise.models import OrderItem
+from .models import Payment
+
+REPORT_FORMATS = ('csv', 'xlsx')
+
+# Column title, values_list lookup
+SALES_COLUMNS = [
+    ('Order ID', 'order_id'),
+    ('Order Date', 'order__created_at'),
+    ('Customer', 'order__user__name'),
+    ('Customer Email', 'order__user__email'),
+    ('Order Status', 'order__status'),
+    ('Item', 'merchandise__name'),
+    ('Category', 'merchandise__category'),
+    ('Quantity', 'quantity'),
+    ('Unit Price', 'unit_price'),
+    ('Order Total', 'order__total_amount'),
+    ('M-Pesa Receipt', 'mpesa_receipt'),
+]
+
+PAYMENTS_COLUMNS = [
+    ('Payment ID', 'id'),
+    ('Date', 'created_at'),
+    ('User', 'user__name'),
+    ('User Email', 'user__email'),
+    ('Type', 'payment_type'),
+    ('Method', 'payment_method'),
+    ('Status', 'status'),
+    ('Amount', 'amount'),
+    ('Order ID', 'order_id'),
+    ('Transaction ID', 'transaction_id'),
+    ('M-Pesa Receipt', 'mpesa_transaction__mpesa_receipt_number'),
+    ('M-Pesa Phone', 'mpesa_transaction__phone_number'),
+    ('M-Pesa Status', 'mpesa_transaction__status'),
+    ('M-Pesa Result', 'mpesa_transaction__result_description'),
+]
+
+
+def date_range(start_date=None, end_date=None):
+    """
+    Convert an inclusive range of dates to aware datetime bounds
+
+    Returns:
+        tuple: (start, end) where end is exclusive; either may be None
+    """
+    start = end = None
+    if start_date:
+        start = timezone.make_aware(datetime.combine(start_date, time.min))
+    if end_date:
+        end = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+    return start, end
+
+
+def sales_rows(start=None, end=None):
+    """
+    Queryset of one row per order item, with the receipt of the order's latest completed payment
+    """
+    latest_receipt = Payment.objects.filter(
+        order=OuterRef('order_id'), status='COMPLETED'
+    ).order_by('-created_at').values('mpesa_transaction__mpesa_receipt_number')[:1]
+
+    queryset = OrderItem.objects.annotate(mpesa_receipt=Subquery(latest_receipt))
+    if start:
+        queryset = queryset.filter(order__created_at__gte=start)
+    if end:
+        queryset = queryset.filter(order__created_at__lt=end)
+    return queryset.order_by('order__created_at', 'order_id', 'id').values_list(
+        *[lookup for _, lookup in SALES_COLUMNS]
+    )
+
+
+def payments_rows(start=None, end=None):
+    """
+    Queryset of one row per payment, joined to its user and M-Pesa transaction
+    """
+    queryset = Payment.objects.all()
+    if start:
+        queryset = queryset.filter(created_at__gte=start)
+    if end:
+        queryset = queryset.filter(created_at__lt=end)
+    return queryset.order_by('created_at', 'id').values_list(
+        *[lookup for _, lookup in PAYMENTS_COLUMNS]
+    )
+
+
+REPORTS = {
+    'sales': (SALES_COLUMNS, sales_rows),
+    'payments': (PAYMENTS_COLUMNS, payments_rows),
+}
+
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def iter_csv(report, start=None, end=None, chunk_size=2000):
+    """
+    Yield a report as CSV lines
+
+    Args:
+        report (str): A key of REPORTS
+        start, end: Datetime bounds from date_range
+        chunk_size: Rows fetched from the database at a time
+    """
+    columns, rows = REPORTS[report]
+    writer = csv.writer(Echo())
+    yield writer.writerow([title for title, _ in columns])
+    for row in rows(start, end).iterator(chunk_size=chunk_size):
+        yield writer.writerow([format_value(value) for value in row])
+
+
+def write_xlsx(report, start=None, end=None, chunk_size=2000):
+    """
+    Write a report to a temporary XLSX file
+
+    The workbook is built in openpyxl's write-only mode, which flushes rows to
+    disk as they are appended.
+
+    Returns:
+        file: The temporary file, positioned at the start. It is deleted when closed.
+
+    Raises:
+        ImportError: If openpyxl is not installed
+    """
+    from openpyxl import Workbook
+
+    columns, rows = REPORTS[report]
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=report.capitalize())
+    sheet.append([title for title, _ in columns])
+    for row in rows(start, end).iterator(chunk_size=chunk_size):
+        sheet.append([format_value(value) for value in row])
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
@@ -0,0 +1,200 @@
+"""
+Order payment initiation shared by the M-Pesa, merchandise and async endpoints.
+Every endpoint that starts an M-Pesa payment for an order calls into this module in-process,
+so a payment costs one request worker and one Daraja round trip.
+"""
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.urls import reverse
+
+from merchandise.stock import extend_stock_holds
+from .daraja import initiate_stk_push
+from .models import Payment, MpesaTransaction
+
+logger = logging.getLogger('payment.services')
+
+
+class PaymentInitiationError(Exception):
+    """
+    Raised when an order payment cannot be started
+
+    Attributes:
+        message: Error message returned to the client
+        status_code: HTTP status code for the response
+        details: Optional error details from M-Pesa
+    """
+
+    def __init__(self, message, status_code=400, details=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.details = details
+
+    def as_dict(self):
+        data = {"error": self.message}
+        if self.details is not None:
+            data["details"] = self.details
+        return data
+
+
+def normalize_phone_number(phone_number):
+    """
+    Convert a Kenyan phone number to the 254XXXXXXXXX format used by M-Pesa
+
+    Args:
+        phone_number (str): Number as 07XXXXXXXX, +254XXXXXXXXX or 254XXXXXXXXX
+
+    Returns:
+        str: The normalized number, or None if it is not a valid number
+    """
+    phone_number = str(phone_number or '').strip()
+    if phone_number.startswith('0'):
+        phone_number = '254' + phone_number[1:]
+    elif phone_number.startswith('+254'):
+        phone_number = phone_number[1:]
+
+    if not phone_number.startswith('254') or not phone_number.isdigit() or len(phone_number) != 12:
+        return None
+    return phone_number
+
+
+def get_callback_url(request):
+    """Return the configured M-Pesa callback URL, or build one from the request"""
+    callback_url = settings.MPESA_CALLBACK_URL
+    if not callback_url:
+        # Build callback URL from request (only works if server is publicly accessible)
+        callback_url = request.build_absolute_uri(reverse('mpesa-callback'))
+    return callback_url
+
+
+def create_order_payment(order, user, phone_number):
+    """
+    Create the pending payment and M-Pesa transaction records for an order
+
+    Args:
+        order: The Order being paid for
+        user: The user making the payment
+        phone_number (str): Phone number in format 254XXXXXXXXX
+
+    Returns:
+        MpesaTransaction: The new transaction, with its payment attached
+
+    Raises:
+        PaymentInitiationError: If the order is no longer awaiting payment
+    """
+    if order.status != 'PENDING':
+        raise PaymentInitiationError(f"Order is already in '{order.status}' status")
+
+    # Keep the order's stock while the customer answers the STK prompt
+    extend_stock_holds(order)
+
+    payment = Payment.objects.create(
+        user=user,
+        amount=order.total_amount,
+        payment_type='ORDER',
+        payment_method='MPESA',
+        order=order
+    )
+    return MpesaTransaction.objects.create(
+        payment=payment,
+        phone_number=phone_number,
+        amount=order.total_amount,
+        reference=f"Order-{order.id}",
+        description=f"Payment for JKUELC Order #{order.id}"
+    )
+
+
+def record_stk_push_response(mpesa_transaction, stk_response):
+    """
+    Store the STK push response on a transaction
+
+    Args:
+        mpesa_transaction: The transaction created by create_order_payment
+        stk_response (dict): Response from initiate_stk_push
+
+    Raises:
+        PaymentInitiationError: If M-Pesa rejected the push. The transaction and
+            payment are marked as failed first.
+    """
+    mpesa_transaction.raw_response = stk_response
+
+    if 'error' not in stk_response:
+        mpesa_transaction.merchant_request_id = stk_response.get('MerchantRequestID')
+        mpesa_transaction.checkout_request_id = stk_response.get('CheckoutRequestID')
+        mpesa_transaction.save()
+        return
+
+    # Payment initiation failed
+    mpesa_transaction.status = 'FAILED'
+    mpesa_transaction.result_description = stk_response.get('error')
+    mpesa_transaction.save()
+
+    payment = mpesa_transaction.payment
+    payment.status = 'FAILED'
+    payment.save()
+
+    logger.error(f"Failed to initiate STK push for {mpesa_transaction.reference}: {stk_response.get('error')}")
+    raise PaymentInitiationError("Failed to initiate payment", status_code=500, details=stk_response.get('error'))
+
+
+def initiate_order_payment(order, user, phone_number, callback_url, stk_push=initiate_stk_push):
+    """
+    Start an M-Pesa STK push payment for an order
+
+    Args:
+        order: The Order being paid for
+        user: The user making the payment
+        phone_number (str): Phone number in format 254XXXXXXXXX
+        callback_url (str): URL to receive payment notification
+        stk_push: Function used to send the STK push (defaults to initiate_stk_push)
+
+    Returns:
+        MpesaTransaction: The initiated transaction
+
+    Raises:
+        PaymentInitiationError: If the order cannot be paid or M-Pesa rejected the push
+    """
+    mpesa_transaction = create_order_payment(order, user, phone_number)
+
+    logger.info(f"Using M-Pesa callback URL: {callback_url}")
+    stk_response = stk_push(
+        phone_number=phone_number,
+        amount=order.total_amount,
+        account_reference=mpesa_transaction.reference,
+        transaction_desc=mpesa_transaction.description,
+        callback_url=callback_url
+    )
+
+    record_stk_push_response(mpesa_transaction, stk_response)
+    return mpesa_transaction
+
+
+async def ainitiate_order_payment(order, user, phone_number, callback_url, stk_push):
+    """
+    Async version of initiate_order_payment
+
+    ``stk_push`` must be a coroutine function such as AsyncDarajaClient.initiate_stk_push,
+    so the event loop is free while M-Pesa handles the push.
+    """
+    mpesa_transaction = await sync_to_async(create_order_payment)(order, user, phone_number)
+
+    stk_response = await stk_push(
+        phone_number=phone_number,
+        amount=order.total_amount,
+        account_reference=mpesa_transaction.reference,
+        transaction_desc=mpesa_transaction.description,
+        callback_url=callback_url
+    )
+
+    await sync_to_async(record_stk_push_response)(mpesa_transaction, stk_response)
+    return mpesa_transaction
+
+
+def initiation_response(mpesa_transaction):
+    """Response body returned once a payment has been initiated"""
+    return {
+        'message': 'Payment initiated. Please check your phone to complete the transaction.',
+        'transaction_id': mpesa_transaction.id,
+        'checkout_request_id': mpesa_transaction.checkout_request_id
+    }
@@ -0,0 +1,305 @@
+"""
+Local stand-in for the Safaricom Daraja API.
+The simulator issues OAuth tokens, accepts STK pushes, answers STK queries and posts the
+result callback to the CallBackURL of each push after a configurable delay, so the whole
+initiate -> callback -> update flow can be load tested offline. Point the app at it with
+MPESA_ENVIRONMENT = 'simulator' and MPESA_SIMULATOR_URL.
+"""
+import heapq
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+
+logger = logging.getLogger('payment.simulator')
+
+TOKEN_PATH = '/oauth/v1/generate'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+# (ResultCode, ResultDesc) for each simulated outcome
+RESULT_SUCCESS = (0, "The service request is processed successfully.")
+RESULT_CANCELLED = (1032, "Request cancelled by user")
+RESULT_FAILED = (1, "The balance is insufficient for the transaction")
+
+
+class DarajaSimulator:
+    """
+    In-process Daraja API server.
+    
+    Each accepted STK push is resolved as successful, failed or cancelled according to
+    the configured rates, and the callback is delivered after ``callback_latency``
+    seconds (plus up to ``callback_jitter``). Until then, STK queries answer with the
+    "transaction is being processed" error, as Daraja does.
+    
+    Args:
+        host: Interface to bind
+        port: Port to bind, 0 picks a free one
+        token_ttl: Lifetime of issued access tokens in seconds
+        api_latency: Seconds to wait before answering each API request
+        callback_latency: Seconds between accepting a push and sending its callback
+        callback_jitter: Extra random delay added to each callback, in seconds
+        failure_rate: Fraction of pushes resolved as failed
+        cancel_rate: Fraction of pushes resolved as cancelled by the user
+        callback_workers: Number of threads delivering callbacks
+        send_callback: Function called with (url, payload) to deliver a callback
+        seed: Seed for the outcome generator, for repeatable runs
+    """
+    
+    def __init__(self, host='127.0.0.1', port=8089, token_ttl=3599, api_latency=0.0,
+                 callback_latency=1.0, callback_jitter=0.0, failure_rate=0.0, cancel_rate=0.0,
+                 callback_workers=10, send_callback=None, seed=None):
+        self.token_ttl = token_ttl
+        self.api_latency = api_latency
+        self.callback_latency = callback_latency
+        self.callback_jitter = callback_jitter
+        self.failure_rate = failure_rate
+        self.cancel_rate = cancel_rate
+        self.send_callback = send_callback or self._post_callback
+        
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._transactions = {}
+        self._counter = 0
+        self._stats = {'tokens': 0, 'pushes': 0, 'queries': 0, 'callbacks_sent': 0, 'callbacks_failed': 0}
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers,
+                                             thread_name_prefix='daraja-sim-callback')
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._http = requests.Session()
+        self._due = []
+        self._due_changed = threading.Condition(self._lock)
+        self._stopping = False
+        self._scheduler = threading.Thread(target=self._run_scheduler, name='daraja-sim-scheduler', daemon=True)
+        self._scheduler.start()
+    
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+    
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name='daraja-sim', daemon=True)
+        self._thread.start()
+        return self
+    
+    def serve_forever(self):
+        """Serve requests on the calling thread until interrupted"""
+        try:
+            self._server.serve_forever()
+        finally:
+            self.stop()
+    
+    def stop(self):
+        """Stop serving and wait for pending callbacks to be delivered"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        with self._lock:
+            self._stopping = True
+            self._due_changed.notify()
+        self._scheduler.join()
+        self._callbacks.shutdown(wait=True)
+        self._http.close()
+    
+    def stats(self):
+        """Return counters of served requests and delivered callbacks"""
+        with self._lock:
+            return dict(self._stats, pending=sum(
+                1 for t in self._transactions.values() if t['result'] is None
+            ))
+    
+    def issue_token(self):
+        token = secrets.token_urlsafe(24)
+        with self._lock:
+            self._tokens[token] = time.time() + self.token_ttl
+            self._stats['tokens'] += 1
+        return {"access_token": token, "expires_in": str(self.token_ttl)}
+    
+    def is_authorized(self, authorization):
+        keyword, _, token = (authorization or '').partition(' ')
+        with self._lock:
+            expires_at = self._tokens.get(token)
+        return keyword == 'Bearer' and expires_at is not None and time.time() < expires_at
+    
+    def accept_stk_push(self, payload):
+        """Register an STK push and schedule its callback"""
+        missing = [f for f in ('PhoneNumber', 'Amount', 'CallBackURL', 'BusinessShortCode') if not payload.get(f)]
+        if missing:
+            return 400, {
+                "requestId": secrets.token_hex(8),
+                "errorCode": "400.002.02",
+                "errorMessage": f"Bad Request - Invalid {missing[0]}"
+            }
+        
+        with self._lock:
+            self._counter += 1
+            merchant_request_id = f"sim-{self._counter}"
+            checkout_request_id = f"ws_CO_SIM_{datetime.now():%d%m%Y%H%M%S}{self._counter:08d}"
+            roll = self._random.random()
+            if roll < self.failure_rate:
+                outcome = RESULT_FAILED
+            elif roll < self.failure_rate + self.cancel_rate:
+                outcome = RESULT_CANCELLED
+            else:
+                outcome = RESULT_SUCCESS
+            
+            due_at = time.monotonic() + self.callback_latency + self._random.uniform(0, self.callback_jitter)
+            self._transactions[checkout_request_id] = {
+                'merchant_request_id': merchant_request_id,
+                'payload': payload,
+                'result': None,
+            }
+            heapq.heappush(self._due, (due_at, checkout_request_id, outcome))
+            self._due_changed.notify()
+            self._stats['pushes'] += 1
+        
+        return 200, {
+            "MerchantRequestID": merchant_request_id,
+            "CheckoutRequestID": checkout_request_id,
+            "ResponseCode": "0",
+            "ResponseDescription": "Success. Request accepted for processing",
+            "CustomerMessage": "Success. Request accepted for processing"
+        }
+    
+    def query_stk_push(self, payload):
+        """Answer an STK query for a previously accepted push"""
+        checkout_request_id = payload.get('CheckoutRequestID')
+        with self._lock:
+            self._stats['queries'] += 1
+            transaction = self._transactions.get(checkout_request_id)
+        
+        if transaction is None:
+            return 400, {
+                "requestId": secrets.token_hex(8),
+                "errorCode": "400.002.02",
+                "errorMessage": "Bad Request - Invalid CheckoutRequestID"
+            }
+        if transaction['result'] is None:
+            return 500, {
+                "requestId": secrets.token_hex(8),
+                "errorCode": "500.001.1001",
+                "errorMessage": "The transaction is being processed"
+            }
+        
+        result_code, result_desc = transaction['result']
+        return 200, {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": transaction['merchant_request_id'],
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": str(result_code),
+            "ResultDesc": result_desc
+        }
+    
+    def _run_scheduler(self):
+        # Hands each push to the callback pool once its latency has elapsed, so a long
+        # callback_latency does not tie up a delivery thread per transaction
+        with self._lock:
+            while True:
+                if self._stopping and not self._due:
+                    return
+                if not self._due:
+                    self._due_changed.wait()
+                    continue
+                
+                wait = self._due[0][0] - time.monotonic()
+                if wait > 0 and not self._stopping:
+                    self._due_changed.wait(wait)
+                    continue
+                
+                _, checkout_request_id, outcome = heapq.heappop(self._due)
+                self._callbacks.submit(self._resolve, checkout_request_id, outcome)
+    
+    def _resolve(self, checkout_request_id, outcome):
+        with self._lock:
+            transaction = self._transactions[checkout_request_id]
+            transaction['result'] = outcome
+        
+        push = transaction['payload']
+        result_code, result_desc = outcome
+        stk_callback = {
+            "MerchantRequestID": transaction['merchant_request_id'],
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": result_code,
+            "ResultDesc": result_desc
+        }
+        if result_code == 0:
+            stk_callback["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": push['Amount']},
+                {"Name": "MpesaReceiptNumber", "Value": f"SIM{secrets.token_hex(4).upper()}"},
+                {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": int(push['PhoneNumber'])}
+            ]}
+        
+        try:
+            self.send_callback(push['CallBackURL'], {"Body": {"stkCallback": stk_callback}})
+            sent = True
+        except Exception as e:
+            logger.error(f"Failed to deliver simulated callback for {checkout_request_id}: {e}")
+            sent = False
+        with self._lock:
+            self._stats['callbacks_sent' if sent else 'callbacks_failed'] += 1
+    
+    def _post_callback(self, url, payload):
+        response = self._http.post(url, json=payload, timeout=30)
+        response.raise_for_status()
+    
+    def _make_handler(self):
+        simulator = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_GET(self):
+                if urlsplit(self.path).path != TOKEN_PATH:
+                    return self._reply(404, {"errorMessage": "Not found"})
+                if not self.headers.get('Authorization', '').startswith('Basic '):
+                    return self._reply(400, {"errorMessage": "Invalid Authentication passed"})
+                self._reply(200, simulator.issue_token())
+            
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self._reply(400, {"errorMessage": "Bad Request - Invalid JSON"})
+                
+                if not simulator.is_authorized(self.headers.get('Authorization')):
+                    return self._reply(401, {"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"})
+                
+                path = urlsplit(self.path).path
+                if path == STK_PUSH_PATH:
+                    self._reply(*simulator.accept_stk_push(payload))
+                elif path == QUERY_PATH:
+                    self._reply(*simulator.query_stk_push(payload))
+                else:
+                    self._reply(404, {"errorMessage": "Not found"})
+            
+            def _reply(self, status_code, body):
+                if simulator.api_latency:
+                    time.sleep(simulator.api_latency)
+                data = json.dumps(body).encode()
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+        
+        return Handler
@@ -1,3 +1,533 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from merchandise.models import Merchandise, Order, OrderItem
+from .callback_parser import CallbackParseError, parse_stk_callback
+from .async_daraja import AsyncDarajaClient
+from .daraja import DarajaClient, DarajaTokenManager, process_callback
+from .callback_queue import drain_callback_queue
+from .models import Payment, MpesaTransaction, MpesaCallback, Notification
+from .reconcile import reconcile_pending_transactions
+from .simulator import DarajaSimulator
+from .utils import expire_pending_transactions
+
+User = get_user_model()
+
+
+class DarajaTokenManagerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    def fetch_token(self):
+        self.calls += 1
+        return f"token-{self.calls}", 3599
+
+    def test_token_is_reused_until_refresh_margin(self):
+        manager = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+
+        tokens = {manager.get_token() for _ in range(50)}
+
+        self.assertEqual(tokens, {'token-1'})
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(manager.stats()['misses'], 1)
+        self.assertEqual(manager.stats()['hits'], 49)
+
+    def test_token_is_shared_through_cache(self):
+        first = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+        second = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+
+        self.assertEqual(first.get_token(), 'token-1')
+        self.assertEqual(second.get_token(), 'token-1')
+        self.assertEqual(self.calls, 1)
+
+    def test_concurrent_misses_fetch_once(self):
+        def slow_fetch():
+            time.sleep(0.05)
+            return self.fetch_token()
+
+        manager = DarajaTokenManager(fetch_token=slow_fetch, cache_key='test:token')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get_token())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(set(results), {'token-1'})
+        self.assertEqual(self.calls, 1)
+
+    def test_token_in_refresh_margin_is_served_while_refreshing(self):
+        manager = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token', refresh_margin=3600)
+
+        self.assertEqual(manager.get_token(), 'token-1')
+        self.assertEqual(manager.get_token(), 'token-1')
+        manager._background_refresh.join()
+
+        self.assertEqual(manager.get_token(), 'token-2')
+        self.assertGreaterEqual(manager.stats()['refreshes'], 2)
+
+    def test_waits_for_token_published_by_another_worker(self):
+        manager = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+        cache.add(manager.lock_key, True)
+
+        def publish():
+            time.sleep(0.05)
+            cache.set('test:token', {'access_token': 'shared', 'expires_at': time.time() + 3599})
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get_token())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads + [publisher]:
+            thread.join()
+
+        self.assertEqual(results, ['shared'] * 5)
+        self.assertEqual(self.calls, 0)
+
+    def test_counters_are_exact_under_concurrent_calls(self):
+        manager = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+
+        def get_tokens():
+            for _ in range(500):
+                manager.get_token()
+
+        threads = [threading.Thread(target=get_tokens) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = manager.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4000)
+        self.assertEqual(self.calls, 1)
+
+    def test_invalidate_forces_new_token(self):
+        manager = DarajaTokenManager(fetch_token=self.fetch_token, cache_key='test:token')
+        manager.get_token()
+        manager.invalidate()
+
+        self.assertEqual(manager.get_token(), 'token-2')
+
+
+class DarajaClientTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = DarajaClient(base_url='https://daraja.test', retry_backoff=0)
+        self.client.tokens = DarajaTokenManager(fetch_token=lambda: ('token', 3599), cache_key='test:client-token')
+
+    def response(self, status_code, data):
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = data
+        return response
+
+    def test_stk_query_retries_transient_errors(self):
+        with mock.patch.object(self.client.session, 'request', side_effect=[
+            requests.exceptions.ConnectionError('reset'),
+            self.response(503, {}),
+            self.response(200, {'ResultCode': '0'}),
+        ]) as request:
+            result = self.client.query_stk_status('ws_CO_1')
+
+        self.assertEqual(result, {'ResultCode': '0'})
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(request.call_args.kwargs['timeout'], self.client.timeout)
+
+    def test_stk_push_is_not_retried(self):
+        with mock.patch.object(self.client.session, 'request', side_effect=requests.exceptions.ConnectionError('reset')) as request:
+            result = self.client.initiate_stk_push('254700000000', 10, 'Order-1', 'Test', 'https://example.com/cb')
+
+        self.assertIn('error', result)
+        self.assertEqual(request.call_count, 1)
+
+    def test_unauthorized_response_invalidates_token(self):
+        with mock.patch.object(self.client.session, 'request', return_value=self.response(401, {'errorCode': '404.001.03'})):
+            self.client.query_stk_status('ws_CO_1')
+
+        self.assertIsNone(self.client.tokens._token)
+
+
+class DarajaSimulatorTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.callbacks = []
+        self.delivered = threading.Event()
+
+        def send_callback(url, payload):
+            self.callbacks.append((url, payload))
+            self.delivered.set()
+
+        self.simulator = DarajaSimulator(port=0, callback_latency=0, send_callback=send_callback, seed=1).start()
+        self.addCleanup(self.simulator.stop)
+        self.client = DarajaClient(base_url=self.simulator.url, shortcode='174379', passkey='passkey')
+        self.addCleanup(self.client.close)
+
+    def test_stk_push_round_trip(self):
+        response = self.client.initiate_stk_push('254708374149', 10, 'Order-1', 'Test', 'http://app.test/cb')
+        checkout_request_id = response['CheckoutRequestID']
+        self.assertTrue(self.delivered.wait(5))
+
+        url, payload = self.callbacks[0]
+        callback = parse_stk_callback(payload)
+        self.assertEqual(url, 'http://app.test/cb')
+        self.assertEqual(callback.checkout_request_id, checkout_request_id)
+        self.assertTrue(callback.is_successful)
+        self.assertEqual(callback.amount, 10)
+
+        status_response = self.client.query_stk_status(checkout_request_id)
+        self.assertEqual(status_response['ResultCode'], '0')
+        self.assertEqual(self.simulator.stats()['tokens'], 1)
+
+    def test_cancel_rate(self):
+        self.simulator.cancel_rate = 1.0
+        self.client.initiate_stk_push('254708374149', 10, 'Order-1', 'Test', 'http://app.test/cb')
+        self.assertTrue(self.delivered.wait(5))
+
+        self.assertEqual(parse_stk_callback(self.callbacks[0][1]).result_code, 1032)
+
+    def test_rejects_unknown_token(self):
+        response = requests.post(f"{self.simulator.url}/mpesa/stkpushquery/v1/query",
+                                 json={'CheckoutRequestID': 'ws_CO_1'}, headers={'Authorization': 'Bearer nope'})
+        self.assertEqual(response.status_code, 401)
+
+
+class CallbackParserTests(SimpleTestCase):
+    samples_path = Path(__file__).resolve().parent / 'samples' / 'stk_callbacks.json'
+
+    def setUp(self):
+        with open(self.samples_path) as f:
+            self.corpus = json.load(f)
+
+    def test_parses_successful_callback(self):
+        callback = parse_stk_callback(self.corpus[0])
+
+        self.assertTrue(callback.is_successful)
+        self.assertEqual(callback.checkout_request_id, 'ws_CO_191220191020363925')
+        self.assertEqual(callback.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(callback.amount, 1500)
+        self.assertEqual(callback.phone_number, 254708374149)
+
+    def test_parses_failed_callback_without_metadata(self):
+        callback = parse_stk_callback(self.corpus[2])
+
+        self.assertFalse(callback.is_successful)
+        self.assertEqual(callback.result_code, 1032)
+        self.assertIsNone(callback.mpesa_receipt_number)
+        self.assertNotIn('amount', callback.as_dict())
+
+    def test_string_result_code_is_normalised(self):
+        payload = {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_1', 'ResultCode': '1032'}}}
+        self.assertEqual(parse_stk_callback(payload).result_code, 1032)
+
+    def test_rejects_malformed_payloads(self):
+        malformed = [
+            {},
+            {'Body': []},
+            {'Body': {'stkCallback': {'ResultCode': 0}}},
+            {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_1', 'ResultCode': 'x'}}},
+            {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_1', 'ResultCode': 0}}},
+            {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_1', 'ResultCode': 0,
+                                      'CallbackMetadata': {'Item': ['Amount']}}}},
+        ]
+        for payload in malformed:
+            with self.subTest(payload=payload):
+                with self.assertRaises(CallbackParseError):
+                    parse_stk_callback(payload)
+
+    def test_process_callback_output_shape(self):
+        for payload in self.corpus:
+            stk_callback = payload['Body']['stkCallback']
+            result = process_callback(payload)
+            self.assertEqual(result['checkout_request_id'], stk_callback['CheckoutRequestID'])
+            self.assertEqual(result['result_code'], stk_callback['ResultCode'])
+            self.assertEqual('mpesa_receipt_number' in result, stk_callback['ResultCode'] == 0)
+
+        self.assertIn('error', process_callback({'Body': {}}))
+
+
+class AsyncInitiateOrderPaymentTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.token = Token.objects.create(user=self.user)
+        self.order = Order.objects.create(user=self.user, total_amount=500)
+        self.url = reverse('mpesa-initiate-order-payment-async')
+
+    async def test_initiates_stk_push(self):
+        stk_client = mock.Mock()
+        stk_client.initiate_stk_push = mock.AsyncMock(return_value={
+            'MerchantRequestID': 'mr-1', 'CheckoutRequestID': 'ws_CO_1', 'ResponseCode': '0'
+        })
+
+        with mock.patch('payment.async_views.get_async_client', return_value=stk_client):
+            response = await self.async_client.post(
+                self.url,
+                {'order_id': self.order.id, 'phone_number': '254700000000'},
+                content_type='application/json',
+                headers={'Authorization': f'Token {self.token.key}'}
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['checkout_request_id'], 'ws_CO_1')
+        transaction = await MpesaTransaction.objects.select_related('payment').aget(checkout_request_id='ws_CO_1')
+        self.assertEqual(transaction.payment.order_id, self.order.id)
+
+    async def test_requires_token(self):
+        response = await self.async_client.post(self.url, {}, content_type='application/json')
+
+        self.assertEqual(response.status_code, 401)
+
+    async def test_rejects_body_that_is_not_an_object(self):
+        response = await self.async_client.post(
+            self.url, [self.order.id], content_type='application/json',
+            headers={'Authorization': f'Token {self.token.key}'}
+        )
+
+        self.assertEqual(response.status_code, 400)
+
+
+class AsyncDarajaClientTests(SimpleTestCase):
+    def test_http_client_of_a_previous_loop_is_closed(self):
+        client = AsyncDarajaClient(base_url='https://daraja.test')
+        asyncio.run(client._bind_loop())
+        first = client._http
+
+        with mock.patch.object(first, 'aclose', new_callable=mock.AsyncMock) as aclose:
+            asyncio.run(client._bind_loop())
+
+        aclose.assert_awaited_once()
+        self.assertIsNot(client._http, first)
+        asyncio.run(client.aclose())
+
+
+class ReconcilePendingTransactionsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, total_amount=500)
+
+    def create_transaction(self, checkout_request_id, age=timedelta(minutes=5)):
+        payment = Payment.objects.create(
+            user=self.user, amount=500, payment_type='ORDER', payment_method='MPESA', order=self.order
+        )
+        return MpesaTransaction.objects.create(
+            payment=payment, phone_number='254700000000', amount=500, reference='Order-1',
+            description='Test', checkout_request_id=checkout_request_id,
+            created_at=timezone.now() - age
+        )
+
+    def test_applies_query_results(self):
+        paid = self.create_transaction('ws_CO_paid')
+        cancelled = self.create_transaction('ws_CO_cancelled')
+        processing = self.create_transaction('ws_CO_processing')
+        recent = self.create_transaction('ws_CO_recent', age=timedelta(seconds=10))
+        responses = {
+            'ws_CO_paid': {'ResultCode': '0', 'ResultDesc': 'Processed'},
+            'ws_CO_cancelled': {'ResultCode': '1032', 'ResultDesc': 'Cancelled by user'},
+            'ws_CO_processing': {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'},
+        }
+
+        stats = reconcile_pending_transactions(batch_size=2, concurrency=2, query=responses.__getitem__)
+
+        self.assertEqual(stats['checked'], 3)
+        self.assertEqual(stats['pending'], 1)
+        paid.refresh_from_db()
+        cancelled.refresh_from_db()
+        processing.refresh_from_db()
+        recent.refresh_from_db()
+        self.assertEqual(paid.status, 'COMPLETED')
+        self.assertEqual(cancelled.status, 'CANCELLED')
+        self.assertEqual(processing.status, 'PENDING')
+        self.assertEqual(recent.status, 'PENDING')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'PAID')
+
+
+class ExpirePendingTransactionsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, total_amount=500)
+
+    def create_transactions(self, count, age):
+        for i in range(count):
+            payment = Payment.objects.create(
+                user=self.user, amount=500, payment_type='ORDER', payment_method='MPESA', order=self.order
+            )
+            MpesaTransaction.objects.create(
+                payment=payment, phone_number='254700000000', amount=500, reference='Order-1',
+                description='Test', checkout_request_id=f'ws_CO_{age}_{i}',
+                created_at=timezone.now() - age
+            )
+
+    def test_expires_stale_transactions_in_batches(self):
+        self.create_transactions(5, timedelta(hours=2))
+        self.create_transactions(2, timedelta(minutes=5))
+
+        # Each chunk runs a select, two updates and one insert inside a savepoint,
+        # and a final empty select ends the loop
+        with self.assertNumQueries(6 * 3 + 3):
+            count = expire_pending_transactions(batch_size=2)
+
+        self.assertEqual(count, 5)
+        self.assertEqual(MpesaTransaction.objects.filter(status='FAILED').count(), 5)
+        self.assertEqual(Payment.objects.filter(status='FAILED').count(), 5)
+        self.assertEqual(Notification.objects.filter(title='Payment Failed').count(), 5)
+        self.assertEqual(MpesaTransaction.objects.filter(status='PENDING').count(), 2)
+
+    def test_dry_run_only_counts(self):
+        self.create_transactions(3, timedelta(hours=2))
+
+        self.assertEqual(expire_pending_transactions(dry_run=True), 3)
+        self.assertEqual(MpesaTransaction.objects.filter(status='PENDING').count(), 3)
+        self.assertFalse(Notification.objects.exists())
+
+
+class MpesaCallbackTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='buyer@example.com', name='Buyer', password='pass')
+        self.order = Order.objects.create(user=self.user, total_amount=500)
+        payment = Payment.objects.create(
+            user=self.user, amount=500, payment_type='ORDER', payment_method='MPESA', order=self.order
+        )
+        self.transaction = MpesaTransaction.objects.create(
+            payment=payment, phone_number='254700000000', amount=500, reference='Order-1',
+            description='Test', checkout_request_id='ws_CO_1'
+        )
+        self.url = reverse('mpesa-callback')
+
+    def callback(self, result_code=0):
+        stk_callback = {
+            'MerchantRequestID': 'mr-1',
+            'CheckoutRequestID': 'ws_CO_1',
+            'ResultCode': result_code,
+            'ResultDesc': 'The service request is processed successfully.',
+        }
+        if result_code == 0:
+            stk_callback['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': 500},
+                {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+                {'Name': 'TransactionDate', 'Value': 20191219102115},
+                {'Name': 'PhoneNumber', 'Value': 254700000000},
+            ]}
+        return {'Body': {'stkCallback': stk_callback}}
+
+    def test_callback_completes_transaction_once(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, self.callback(), content_type='application/json')
+        self.assertEqual(response.json(), {'ResultCode': 0, 'ResultDesc': 'Success'})
+
+        # A replay is answered from the cache without touching the database
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, self.callback(), content_type='application/json')
+        self.assertEqual(response.json()['ResultCode'], 0)
+
+        self.transaction.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'COMPLETED')
+        self.assertEqual(self.transaction.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(self.order.status, 'PAID')
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_late_failure_does_not_override_completed_transaction(self):
+        self.client.post(self.url, self.callback(), content_type='application/json')
+        cache.clear()
+
+        self.client.post(self.url, self.callback(result_code=1032), content_type='application/json')
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'COMPLETED')
+        self.assertEqual(Notification.objects.count(), 1)
+
+    @override_settings(MPESA_CALLBACK_MODE='queue')
+    def test_queue_mode_defers_processing(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, self.callback(), content_type='application/json')
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'PENDING')
+
+        self.client.post(self.url, self.callback(), content_type='application/json')
+        stats = drain_callback_queue()
+
+        self.assertEqual(stats, {'processed': 2, 'failed': 0})
+        self.assertFalse(MpesaCallback.objects.filter(processed_at__isnull=True).exists())
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, 'COMPLETED')
+        self.assertEqual(Notification.objects.count(), 1)
+
+    @override_settings(MPESA_CALLBACK_MODE='queue')
+    def test_queue_mode_asks_for_a_retry_when_the_callback_cannot_be_stored(self):
+        with mock.patch('payment.mpesa_views.enqueue_callback', side_effect=Exception('database is down')):
+            response = self.client.post(self.url, self.callback(), content_type='application/json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertNotEqual(response.json()['ResultCode'], 0)
+
+
+class ReportExportTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(email='admin@example.com', name='Admin', password='pass', role='ADMIN')
+        self.hoodie = Merchandise.objects.create(
+            name='Hoodie', description='Hoodie', price=1500, image='https://example.com/hoodie.png',
+            category='clothing', stock=10, created_by=self.admin
+        )
+        for i in range(3):
+            order = Order.objects.create(user=self.admin, total_amount=3000, status='PAID')
+            OrderItem.objects.create(order=order, merchandise=self.hoodie, quantity=2, unit_price=1500)
+            payment = Payment.objects.create(user=self.admin, amount=3000, payment_type='ORDER',
+                                             payment_method='MPESA', status='COMPLETED', order=order)
+            MpesaTransaction.objects.create(
+                payment=payment, phone_number='254700000000', amount=3000, reference=f"Order-{order.id}",
+                description='Order payment', status='COMPLETED', mpesa_receipt_number=f'RCP{i}'
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        self.url = reverse('payment-report')
+
+    def export(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, params)
+            content = b''.join(response.streaming_content).decode()
+        return response, list(csv.reader(io.StringIO(content))), len(queries)
+
+    def test_sales_report_is_one_query(self):
+        response, rows, _ = self.export(report='sales')
+        _, _, queries = self.export(report='sales', start_date='2000-01-01')
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(rows[0][0], 'Order ID')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual([row[-1] for row in rows[1:]], ['RCP0', 'RCP1', 'RCP2'])
+        self.assertEqual(queries, 1)
+
+    def test_payments_report_date_range(self):
+        Payment.objects.filter(amount=3000).update(created_at=timezone.now() - timedelta(days=10))
+        today = timezone.localdate().isoformat()
+
+        _, rows, _ = self.export(report='payments', start_date=today, end_date=today)
+
+        self.assertEqual(len(rows), 1)
+
+    def test_rejects_invalid_dates(self):
+        response = self.client.get(self.url, {'start_date': '2024-13-01'})
+
+        self.assertEqual(response.status_code, 400)
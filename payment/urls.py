@@ -2,6 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import PaymentViewSet, MembershipPaymentViewSet, NotificationViewSet, FeedbackViewSet
 from .mpesa_views import MpesaTransactionViewSet, mpesa_callback
+from .async_views import initiate_order_payment_async
 
 router = DefaultRouter()
 router.register(r'payments', PaymentViewSet)
@@ -10,7 +11,10 @@ router.register(r'notifications', NotificationViewSet)
 router.register(r'feedback', FeedbackViewSet)
 router.register(r'mpesa', MpesaTransactionViewSet)
 
+# Explicit paths come before the router so they are not captured by the mpesa detail route
 urlpatterns = [
-    path('', include(router.urls)),
     path('mpesa/callback/', mpesa_callback, name='mpesa-callback'),
+    path('mpesa/initiate-order-payment-async/', initiate_order_payment_async,
+         name='mpesa-initiate-order-payment-async'),
+    path('', include(router.urls)),
 ]
@@ -3,12 +3,82 @@ Utility functions for payment processing.
 """
 import logging
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
+from merchandise.analytics import record_payment_status_change
+from merchandise.stock import InsufficientStockError, change_order_status
+from .callback_parser import CallbackParseError, parse_stk_callback
 from .models import Payment, MpesaTransaction, Notification
 
 logger = logging.getLogger('payment.utils')
 
+# ResultCode returned by M-Pesa when the customer cancels the STK prompt
+MPESA_RESULT_CANCELLED = '1032'
+
+# How long a processed CheckoutRequestID is remembered to short-circuit replayed callbacks
+MPESA_CALLBACK_DEDUP_TTL = getattr(settings, 'MPESA_CALLBACK_DEDUP_TTL', 60 * 60 * 24)
+
+
+def get_status_for_result_code(result_code):
+    """
+    Map an M-Pesa ResultCode to an MpesaTransaction status
+    
+    Args:
+        result_code: ResultCode from a callback or STK query (int or str)
+        
+    Returns:
+        str: COMPLETED, CANCELLED or FAILED, or None if no result code was given
+    """
+    if result_code is None:
+        return None
+    
+    result_code = str(result_code)
+    if result_code == '0':
+        return 'COMPLETED'
+    elif result_code == MPESA_RESULT_CANCELLED:
+        return 'CANCELLED'
+    return 'FAILED'
+
+
+def apply_stk_query_result(mpesa_transaction, status_response):
+    """
+    Apply the response of an STK status query to a transaction
+    
+    Responses without a ResultCode (errors, or "transaction is being processed")
+    leave the transaction untouched, as do results for transactions that are no
+    longer pending.
+    
+    Args:
+        mpesa_transaction: The MpesaTransaction that was queried
+        status_response: Response dict from query_stk_status
+        
+    Returns:
+        str: The new transaction status, or None if the transaction was not updated
+    """
+    if 'error' in status_response:
+        return None
+    
+    result_code = status_response.get('ResultCode')
+    new_status = get_status_for_result_code(result_code)
+    if new_status is None:
+        return None
+    
+    updated = transition_pending_transaction(
+        {'pk': mpesa_transaction.pk},
+        status=new_status,
+        result_code=result_code,
+        result_description=status_response.get('ResultDesc')
+    )
+    if updated is None:
+        # The callback or another worker already resolved this transaction
+        return None
+    
+    mpesa_transaction.status = new_status
+    return new_status
+
+
 def update_transaction_status(mpesa_transaction, status, receipt_number=None, transaction_date=None, 
                              result_code=None, result_description=None):
     """
@@ -40,9 +110,35 @@ def update_transaction_status(mpesa_transaction, status, receipt_number=None, tr
     mpesa_transaction.updated_at = timezone.now()
     mpesa_transaction.save()
     
+    update_payment_for_transaction(mpesa_transaction, status, receipt_number, result_description)
+    
+    logger.info(f"Updated transaction {mpesa_transaction.id} to status: {status}")
+    return mpesa_transaction
+
+
+def update_payment_for_transaction(mpesa_transaction, status, receipt_number=None, result_description=None):
+    """
+    Update the payment (and order) linked to an M-Pesa transaction and notify the user
+    
+    Args:
+        mpesa_transaction: The MpesaTransaction whose status changed
+        status: New transaction status (COMPLETED, FAILED, CANCELLED)
+        receipt_number: M-Pesa receipt number (for completed transactions)
+        result_description: Result description from M-Pesa
+    """
     # Update associated payment record
-    payment = mpesa_transaction.payment
-    if payment:
+    if mpesa_transaction.payment_id is None:
+        return
+    
+    with transaction.atomic():
+        # Lock the row so an admin status update cannot interleave with this one
+        payment = Payment.objects.select_for_update(of=('self',)).select_related(
+            'order', 'user'
+        ).get(pk=mpesa_transaction.payment_id)
+        mpesa_transaction.payment = payment
+        was_completed = payment.status == 'COMPLETED'
+        completed_at = payment.updated_at
+        
         # Update payment status based on transaction status
         if status == 'COMPLETED':
             payment.status = 'COMPLETED'
@@ -51,17 +147,27 @@ def update_transaction_status(mpesa_transaction, status, receipt_number=None, tr
             # Update order status if this is an order payment
             if payment.payment_type == 'ORDER' and payment.order:
                 order = payment.order
-                order.status = 'PAID'
-                order.save()
-                
-                # Create notification for order payment
-                Notification.objects.create(
-                    user=payment.user,
-                    title='Order Payment Successful',
-                    content=f'Your payment of {payment.amount} KES for order #{order.id} has been completed successfully.',
-                    type='PAYMENT',
-                    reference_id=str(payment.id)
-                )
+                try:
+                    change_order_status(order, 'PAID')
+                except InsufficientStockError:
+                    # The order was cancelled and its stock sold before the payment arrived
+                    logger.error(f"Payment {payment.id} completed for cancelled order {order.id} whose stock is gone")
+                    Notification.objects.create(
+                        user=payment.user,
+                        title='Order Could Not Be Fulfilled',
+                        content=f'Your payment of {payment.amount} KES for order #{order.id} was received after the order expired and its items are no longer in stock. Your payment will be refunded.',
+                        type='PAYMENT',
+                        reference_id=str(payment.id)
+                    )
+                else:
+                    # Create notification for order payment
+                    Notification.objects.create(
+                        user=payment.user,
+                        title='Order Payment Successful',
+                        content=f'Your payment of {payment.amount} KES for order #{order.id} has been completed successfully.',
+                        type='PAYMENT',
+                        reference_id=str(payment.id)
+                    )
         else:
             payment.status = 'FAILED'
             
@@ -75,33 +181,178 @@ def update_transaction_status(mpesa_transaction, status, receipt_number=None, tr
             )
         
         payment.save()
+        
+        # Add the sale to the analytics rollups, or take it back out
+        record_payment_status_change(payment, was_completed, completed_at)
+
+
+def transition_pending_transaction(lookup, status, receipt_number=None, transaction_date=None,
+                                   result_code=None, result_description=None, raw_response=None):
+    """
+    Move a PENDING M-Pesa transaction to a final status exactly once
+    
+    The status change is a conditional ``UPDATE ... WHERE status='PENDING'``, so
+    when the same result arrives more than once (replayed callbacks, or a callback
+    racing the reconcile worker) only the first one updates the payment, order and
+    notifications.
+    
+    Args:
+        lookup: Filter kwargs identifying the transaction, e.g. {'checkout_request_id': ...}
+        status: New status (COMPLETED, FAILED, CANCELLED)
+        receipt_number: M-Pesa receipt number (for completed transactions)
+        transaction_date: Date of transaction from M-Pesa
+        result_code: Result code from M-Pesa
+        result_description: Result description from M-Pesa
+        raw_response: Raw payload to store on the transaction
+        
+    Returns:
+        MpesaTransaction: The updated transaction, or None if no pending transaction matched
+    """
+    fields = {'status': status, 'updated_at': timezone.now()}
+    if result_code is not None:
+        fields['result_code'] = str(result_code)
+    if result_description:
+        fields['result_description'] = result_description
+    if receipt_number:
+        fields['mpesa_receipt_number'] = receipt_number
+    if transaction_date:
+        fields['transaction_date'] = transaction_date
+    if raw_response is not None:
+        fields['raw_response'] = raw_response
+    
+    with transaction.atomic():
+        claimed = MpesaTransaction.objects.filter(status='PENDING', **lookup).update(**fields)
+        if not claimed:
+            return None
+        
+        mpesa_transaction = MpesaTransaction.objects.select_related(
+            'payment__order', 'payment__user'
+        ).get(**lookup)
+        update_payment_for_transaction(mpesa_transaction, status, receipt_number, result_description)
     
     logger.info(f"Updated transaction {mpesa_transaction.id} to status: {status}")
     return mpesa_transaction
 
 
-def expire_pending_transactions():
+def ingest_callback(callback_data):
+    """
+    Apply an M-Pesa STK callback idempotently
+    
+    Replays of an already processed CheckoutRequestID are answered from the cache
+    without touching the database; cache misses fall back to the conditional
+    update in transition_pending_transaction.
+    
+    Args:
+        callback_data (dict): The callback payload from M-Pesa
+        
+    Returns:
+        str: 'applied', 'duplicate', 'unknown' or 'invalid'
+    """
+    try:
+        callback = parse_stk_callback(callback_data)
+    except CallbackParseError as e:
+        logger.error(f"Error processing M-Pesa callback: {e}")
+        return 'invalid'
+    
+    checkout_request_id = callback.checkout_request_id
+    cache_key = f"mpesa:callback:{checkout_request_id}"
+    if cache.get(cache_key):
+        logger.info(f"Ignoring replayed M-Pesa callback for transaction {checkout_request_id}")
+        return 'duplicate'
+    
+    mpesa_transaction = transition_pending_transaction(
+        {'checkout_request_id': checkout_request_id},
+        status=get_status_for_result_code(callback.result_code),
+        receipt_number=callback.mpesa_receipt_number,
+        transaction_date=callback.transaction_date,
+        result_code=callback.result_code,
+        result_description=callback.result_desc,
+        raw_response=callback_data
+    )
+    
+    if mpesa_transaction is not None:
+        outcome = 'applied'
+        logger.info(f"Processed M-Pesa callback for transaction {checkout_request_id}: {mpesa_transaction.status}")
+    elif MpesaTransaction.objects.filter(checkout_request_id=checkout_request_id).exists():
+        outcome = 'duplicate'
+        logger.info(f"Ignoring duplicate M-Pesa callback for transaction {checkout_request_id}")
+    else:
+        # Not remembered, so the callback is retried if the transaction appears later
+        logger.warning(f"Received callback for unknown transaction: {checkout_request_id}")
+        return 'unknown'
+    
+    transaction.on_commit(lambda: cache.set(cache_key, True, timeout=MPESA_CALLBACK_DEDUP_TTL))
+    return outcome
+
+
+def expire_pending_transactions(batch_size=500, max_age=timedelta(hours=1), dry_run=False):
     """
     Mark old pending transactions as failed after a certain time period.
-    This should be run as a scheduled task.
+    This should be run as a scheduled task (see the expire_mpesa management command).
+    
+    Expired transactions are processed in chunks of ``batch_size``: each chunk is
+    updated with one UPDATE on transactions, one UPDATE on their payments and a
+    single bulk insert of notifications, inside its own database transaction.
+    
+    Args:
+        batch_size: Number of transactions expired per chunk
+        max_age: Age after which a pending transaction is considered expired
+        dry_run: Only count the transactions that would be expired
+        
+    Returns:
+        int: Number of transactions expired (or that would be expired)
     """
-    # Transactions older than 1 hour are considered expired
-    expiry_time = timezone.now() - timedelta(hours=1)
+    expiry_time = timezone.now() - max_age
+    result_description = 'Transaction expired due to no response from M-Pesa'
     
-    # Get all pending transactions older than expiry time
-    pending_transactions = MpesaTransaction.objects.filter(
+    expired = MpesaTransaction.objects.filter(
         status='PENDING',
         created_at__lt=expiry_time
     )
     
+    if dry_run:
+        count = expired.count()
+        logger.info(f"Dry run: {count} pending M-Pesa transactions would be expired")
+        return count
+    
     count = 0
-    for transaction in pending_transactions:
-        update_transaction_status(
-            transaction, 
-            status='FAILED',
-            result_description='Transaction expired due to no response from M-Pesa'
-        )
-        count += 1
+    while True:
+        with transaction.atomic():
+            # Lock only the transactions: PostgreSQL refuses FOR UPDATE on the
+            # nullable side of the outer join to payments
+            rows = list(
+                expired.select_for_update(of=('self',))
+                .order_by('created_at')
+                .values_list('id', 'payment_id', 'payment__user_id', 'payment__amount')[:batch_size]
+            )
+            if not rows:
+                break
+            
+            now = timezone.now()
+            transaction_ids = [row[0] for row in rows]
+            payment_ids = [row[1] for row in rows if row[1] is not None]
+            
+            count += MpesaTransaction.objects.filter(id__in=transaction_ids, status='PENDING').update(
+                status='FAILED',
+                result_description=result_description,
+                updated_at=now
+            )
+            Payment.objects.filter(id__in=payment_ids, status='PENDING').update(
+                status='FAILED',
+                updated_at=now
+            )
+            Notification.objects.bulk_create([
+                Notification(
+                    user_id=user_id,
+                    title='Payment Failed',
+                    content=f'Your payment of {amount} KES was not completed. Reason: {result_description}',
+                    type='PAYMENT',
+                    reference_id=str(payment_id),
+                    created_at=now
+                )
+                for _, payment_id, user_id, amount in rows
+                if payment_id is not None
+            ])
     
     logger.info(f"Expired {count} pending M-Pesa transactions")
     return count
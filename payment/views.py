@@ -1,10 +1,16 @@
+import logging
 from rest_framework import viewsets, permissions, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.db import transaction
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
 
+from merchandise.analytics import record_payment_status_change
+from merchandise.stock import InsufficientStockError, change_order_status
 from .models import Payment, MembershipPayment, Notification, Feedback
+from .reports import REPORT_FORMATS, REPORTS, date_range, iter_csv, write_xlsx
 from membership.models import Member
 from .serializers import (
     PaymentListSerializer, PaymentDetailSerializer, PaymentCreateSerializer,
@@ -12,17 +18,22 @@ from .serializers import (
     NotificationListSerializer, NotificationDetailSerializer, NotificationCreateSerializer,
     NotificationReadUpdateSerializer, FeedbackSerializer, FeedbackCreateSerializer
 )
+from jkuelc_backend.pagination import CreatedAtCursorPagination
 from users.permissions import IsAdminOrManager, IsAdminOrManagerOrOwner
 
+logger = logging.getLogger('payment.views')
+
 
 class PaymentViewSet(viewsets.ModelViewSet):
     """
     API endpoint for payments management
     """
     queryset = Payment.objects.all().order_by('-created_at')
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = CreatedAtCursorPagination
+    # Keyset pages need a fixed, unique ordering, so client ordering is not offered
+    ordering = ('-created_at', '-id')
+    filter_backends = [filters.SearchFilter]
     search_fields = ['user__name', 'user__email', 'transaction_id']
-    ordering_fields = ['created_at', 'amount']
     
     def get_serializer_class(self):
         if self.action == 'create':
@@ -36,7 +47,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
     def get_permissions(self):
         if self.action in ['update', 'partial_update', 'destroy']:
             return [permissions.IsAuthenticated(), IsAdminOrManager()]
-        elif self.action == 'update_status':
+        elif self.action in ['update_status', 'report']:
             return [permissions.IsAuthenticated(), IsAdminOrManager()]
         return [permissions.IsAuthenticated()]
     
@@ -85,6 +96,61 @@ class PaymentViewSet(viewsets.ModelViewSet):
         serializer = PaymentListSerializer(queryset, many=True)
         return Response(serializer.data)
     
+    @action(detail=False, methods=['get'])
+    def report(self, request):
+        """
+        Stream a finance report (admin only)
+        
+        Query parameters: report ('sales' or 'payments'), start_date and end_date
+        (inclusive, YYYY-MM-DD) and file_format ('csv' or 'xlsx').
+        """
+        report = request.query_params.get('report', 'payments')
+        if report not in REPORTS:
+            return Response(
+                {"detail": f"report must be one of: {', '.join(REPORTS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in REPORT_FORMATS:
+            return Response(
+                {"detail": f"file_format must be one of: {', '.join(REPORT_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        dates = {}
+        for param in ('start_date', 'end_date'):
+            value = request.query_params.get(param)
+            if value:
+                try:
+                    dates[param] = parse_date(value)
+                except ValueError:
+                    dates[param] = None
+                if dates[param] is None:
+                    return Response(
+                        {"detail": f"{param} must be a date in the format YYYY-MM-DD."},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+        start, end = date_range(dates.get('start_date'), dates.get('end_date'))
+        filename = f"{report}-report.{file_format}"
+        
+        if file_format == 'csv':
+            response = StreamingHttpResponse(iter_csv(report, start, end), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+        
+        try:
+            output = write_xlsx(report, start, end)
+        except ImportError:
+            return Response(
+                {"detail": "XLSX reports need openpyxl, which is not installed."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return FileResponse(
+            output, as_attachment=True, filename=filename,
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+    
     @transaction.atomic
     @action(detail=True, methods=['patch'])
     def update_status(self, request, pk=None):
@@ -92,12 +158,19 @@ class PaymentViewSet(viewsets.ModelViewSet):
         Update a payment's status (admin only)
         """
         payment = self.get_object()
+        # Lock the row so the M-Pesa callback cannot change the status between our read and save
+        payment = Payment.objects.select_for_update(of=('self',)).select_related('order', 'user').get(pk=payment.pk)
+        was_completed = payment.status == 'COMPLETED'
+        completed_at = payment.updated_at
         serializer = self.get_serializer(payment, data=request.data, partial=True)
         
         if serializer.is_valid():
             # Save the payment with updated status
             payment = serializer.save()
             
+            # Add the sale to the analytics rollups, or take it back out
+            record_payment_status_change(payment, was_completed, completed_at)
+            
             # If the payment is for membership and is now completed, update the member's status
             if payment.payment_type == 'MEMBERSHIP' and payment.status == 'COMPLETED':
                 try:
@@ -144,17 +217,27 @@ class PaymentViewSet(viewsets.ModelViewSet):
             # If the payment is for an order and is now completed, update the order status
             elif payment.payment_type == 'ORDER' and payment.status == 'COMPLETED' and payment.order:
                 order = payment.order
-                order.status = 'PAID'
-                order.save()
-                
-                # Create a notification for the user
-                Notification.objects.create(
-                    user=payment.user,
-                    title='Order Payment Successful',
-                    content=f'Your payment for order #{order.id} has been processed successfully. Your order status is now "Paid".',
-                    type='PAYMENT',
-                    reference_id=str(payment.id)
-                )
+                try:
+                    change_order_status(order, 'PAID')
+                except InsufficientStockError as e:
+                    # The order was cancelled and its stock is gone; the payment stays completed for a refund
+                    logger.error(f"Payment {payment.id} completed for cancelled order {order.id} whose stock is gone")
+                    Notification.objects.create(
+                        user=payment.user,
+                        title='Order Could Not Be Fulfilled',
+                        content=f'Your payment for order #{order.id} was received but the order has been cancelled. {e} Your payment will be refunded.',
+                        type='PAYMENT',
+                        reference_id=str(payment.id)
+                    )
+                else:
+                    # Create a notification for the user
+                    Notification.objects.create(
+                        user=payment.user,
+                        title='Order Payment Successful',
+                        content=f'Your payment for order #{order.id} has been processed successfully. Your order status is now "Paid".',
+                        type='PAYMENT',
+                        reference_id=str(payment.id)
+                    )
             
             return Response(PaymentDetailSerializer(payment).data)
         